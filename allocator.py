@@ -0,0 +1,104 @@
+"""
+Allocation of the IDs used by generated configs: VLAN IDs, GRE keys and
+interface numbers.
+IDs only need to be unique within a scope, ie. VLAN IDs per site and GRE keys
+per pair of pods, so each scope has the full range of IDs to itself.
+Allocations are deterministic, and the previous run's allocations are kept
+wherever possible, so that an unchanged bridge keeps its IDs when other
+bridges are added or removed.
+"""
+
+
+# VLAN 1 is the wan bridge's PVID
+VLAN_IDS = (2, 4094)
+GRE_KEYS = (1, 2**32 - 1)
+
+
+class AllocationError(Exception):
+    """Raised when every ID in a scope is taken"""
+
+
+class Pool:
+    """
+    IDs from first to last, allocated to keys, per scope.
+    previous is the {scope: {key: id}} allocated by the previous run.
+    """
+    def __init__(self, name, first, last, previous=None):
+        self.name = name
+        self.first = first
+        self.last = last
+        self.previous = previous or {}
+        self.allocated = {}
+        # scope -> the IDs it has used, those its previous run had, and where
+        # searches for the lowest free ID left off
+        self.scopes = {}
+
+    def scope(self, scope):
+        """
+        Returns the bookkeeping of a scope, creating it if need be
+        """
+        if scope not in self.scopes:
+            self.scopes[scope] = {"used": set(),
+                                  "reserved": set(self.previous.get(scope, {}).values()),
+                                  "cursors": {}}
+        return self.scopes[scope]
+
+    def get(self, scope, key, ids=None):
+        """
+        Returns the ID allocated to key within scope, allocating it if need be.
+        ids, (first, last), narrows the IDs that key may have, ie. to a tenant's range.
+        A key keeps its previous ID unless it was taken. New keys avoid IDs
+        that were allocated last time, until there are no others left.
+        """
+        allocated = self.allocated.setdefault(scope, {})
+        if key in allocated:
+            return allocated[key]
+        first, last = ids or (self.first, self.last)
+        used = self.scope(scope)["used"]
+        wanted = self.previous.get(scope, {}).get(key)
+        if wanted is None or wanted in used or not first <= wanted <= last:
+            wanted = self.lowest_free(scope, first, last)
+        allocated[key] = wanted
+        used.add(wanted)
+        return wanted
+
+    def lowest_free(self, scope, first, last):
+        """
+        Returns the lowest ID from first to last that isn't used, preferring
+        ones that weren't allocated last time.
+        Neither set shrinks during a run, so each search resumes where the
+        last one of the scope and range left off, rather than from first
+        """
+        bookkeeping = self.scope(scope)
+        used, reserved = bookkeeping["used"], bookkeeping["reserved"]
+        for avoid_reserved in (True, False):
+            cursor = (first, avoid_reserved)
+            candidate = bookkeeping["cursors"].get(cursor, first)
+            while candidate <= last and (candidate in used or
+                                         (avoid_reserved and candidate in reserved)):
+                candidate += 1
+            bookkeeping["cursors"][cursor] = candidate
+            if candidate <= last:
+                return candidate
+        raise AllocationError(f"no {self.name} left in {scope}, "
+                              f"{first}-{last} are all in use")
+
+
+class Allocations:  # pylint: disable=too-few-public-methods
+    """
+    The pools that a config is generated from
+    """
+    def __init__(self, previous=None):
+        previous = previous or {}
+        self.vlans = Pool("VLAN IDs", *VLAN_IDS, previous.get("vlans"))
+        self.gre_keys = Pool("GRE keys", *GRE_KEYS, previous.get("gre_keys"))
+        # gretap<n> and veth<n> must fit in the 15 character interface name limit
+        self.tunnels = Pool("gretap interfaces", 1, 999999999, previous.get("tunnels"))
+        self.veths = Pool("veth pairs", 0, 99999999, previous.get("veths"))
+
+    def to_dict(self):
+        """
+        Returns this run's allocations, to be passed as previous to the next run
+        """
+        return {"vlans": self.vlans.allocated, "gre_keys": self.gre_keys.allocated,
+                "tunnels": self.tunnels.allocated, "veths": self.veths.allocated}
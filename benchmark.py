@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks config generation and changer planning against synthetic fabrics.
+The fabrics use the same hardware.yaml/config.yaml schema as example-configs/.
+Each case times gen_config, create_tarball and changer.py's plan construction,
+against a fresh pod, with exec_cmd mocked, and records the peak memory of each.
+With --emulate, which needs root, each case's pods are also emulated by
+emulator.py, and configuring them, then reconfiguring them, is timed.
+Results are written as JSON, and a markdown summary is printed.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+import changer
+import configure
+import emulator
+import topology_sim
+import transport
+from allocator import Allocations
+from pod_state import file_hash, plan_payloads
+from podlog import PodLog
+from profiler import Profiler
+
+# case name -> (sites, pods per site, bridges)
+CASES = {
+    "tiny": (1, 1, 4),
+    "small": (10, 5, 100),
+    "medium": (50, 20, 1000),
+    "large": (200, 50, 4000),
+}
+PORTS = ["lan1", "lan2", "lan3", "lan4"]
+
+
+def synthetic_hardware(sites, pods_per_site):
+    """
+    Returns a hardware config with 2 DUTs, of 2 ports each, per pod
+    """
+    hardware = {"sites": {}, "power": {}}
+    for site_num in range(sites):
+        site = f"site{site_num}"
+        pods = {}
+        for pod_num in range(pods_per_site):
+            pod = f"{site}-pod{pod_num}"
+            pods[pod] = {
+                "host": f"10.{site_num // 256}.{site_num % 256}.{pod_num + 1}",
+                "trunk_ports": ["wan"],
+                # the tunneling pod joins the mesh between sites
+                "wan_bridge": {"name": "br-lan",
+                               "members": ["wan", "mesh0"] if pod_num == 0 else ["wan"]},
+                "ethernet": {port: {"dut_name": f"{pod}-dut{index // 2}",
+                                    "dut_port": f"eth{index % 2}"}
+                             for index, port in enumerate(PORTS)},
+                "phy": {"phy0": {"band": 2}, "phy1": {"band": 5}},
+                "serial": {},
+            }
+            for dut in range(2):
+                hardware["power"][f"{pod}-dut{dut}"] = {"host": "127.0.0.1", "type": "tasmota"}
+        hardware["sites"][site] = {"tunneling_pod": f"{site}-pod0", "pods": pods}
+    return hardware
+
+
+def synthetic_config(hardware, bridges, seed=0):
+    """
+    Returns a user config with bridges between 2 random DUT ports, usually
+    at different sites. Every tenth bridge has a simulated wired client,
+    and every twentieth has WAN access
+    """
+    rand = random.Random(seed)
+    duts = [(pod, info["dut_name"], info["dut_port"])
+            for site in hardware["sites"].values()
+            for pod, pod_info in site["pods"].items()
+            for info in pod_info["ethernet"].values()]
+    rand.shuffle(duts)
+    sites = sorted(hardware["sites"])
+    config = {"bridges": {}, "sim_wireless_clients": [], "power_on": []}
+    for bridge_num in range(bridges):
+        members = [{"type": "dut", "dut_name": duts[index % len(duts)][1],
+                    "dut_port": duts[index % len(duts)][2]}
+                   for index in (2 * bridge_num, 2 * bridge_num + 1)]
+        if bridge_num % 10 == 0:
+            members.append({"type": "sim_wired_client", "pod": duts[bridge_num % len(duts)][0],
+                            "namespace": f"client{bridge_num}"})
+        config["bridges"][f"bridge{bridge_num}"] = {
+            "members": members,
+            "wan": rand.choice(sites) if bridge_num % 20 == 0 else None,
+        }
+    return config
+
+
+def fresh_pod_exec_cmd(command):
+    """
+    Stands in for changer.exec_cmd, describing a pod with nothing configured
+    """
+    if command[1:] == ["-j", "netns"]:
+        return "[]"
+    if command[0] == changer.BRIDGE:
+        return json.dumps([{"ifname": "br-lan", "vlans": [
+            {"vlan": 1, "flags": ["PVID", "Egress Untagged"]}]}])
+    if "show" in command and "type" in command:
+        return "[]"
+    if "show" in command:
+        links = [{"ifname": "br-lan", "flags": ["UP"],
+                  "linkinfo": {"info_kind": "bridge", "info_data": {"vlan_filtering": 1}}}]
+        links += [{"ifname": port, "flags": [], "master": "br-lan" if port == "wan" else None}
+                  for port in ["wan"] + PORTS]
+        return json.dumps([{key: value for key, value in link.items() if value is not None}
+                           for link in links])
+    return ""
+
+
+def measure(func):
+    """
+    Returns func's result, and how long it took and its peak memory.
+    Memory is measured in a second run, as tracing slows it down
+    """
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {"seconds": round(seconds, 6), "peak_bytes": peak}
+
+
+def plan_pod(pod_config):
+    """
+    Plan a pod's changes, as the changer would on a fresh pod
+    """
+    with mock.patch.object(changer, "exec_cmd", fresh_pod_exec_cmd), \
+            mock.patch.object(changer, "get_phys", lambda: ["phy0", "phy1"]):
+        live = changer.read_live_state(pod_config, None)
+        return changer.plan_changes(pod_config, live)
+
+
+def tarball_pods(generated, count):
+    """
+    Create the tarballs of up to count pods, then clean them up
+    """
+    pods = sorted(generated)[:count]
+    for pod in pods:
+        os.remove(configure.create_tarball(pod, generated[pod]))
+        shutil.rmtree(f"/tmp/{pod}")
+    return pods
+
+
+def run_case(name, tarballs):
+    """
+    Benchmark a single case
+    """
+    sites, pods_per_site, bridges = CASES[name]
+    hardware = synthetic_hardware(sites, pods_per_site)
+    config = synthetic_config(hardware, bridges)
+    index = topology_sim.HardwareIndex(hardware)
+    generated, gen_stats = measure(lambda: topology_sim.gen_config(config, index))
+    pods, tarball_stats = measure(lambda: tarball_pods(generated, tarballs))
+    tarball_stats["pods"] = len(pods)
+    # the busiest pod is the one with the most to plan
+    busiest = max(sorted(generated), key=lambda pod: len(generated[pod]["bridges"]))
+    plan, plan_stats = measure(lambda: plan_pod(generated[busiest]))
+    plan_stats.update(pod=busiest, commands=len(plan.commands()))
+    return {
+        "case": name, "sites": sites, "pods_per_site": pods_per_site, "bridges": bridges,
+        "pods": len(generated),
+        "gen_config": gen_stats, "create_tarball": tarball_stats, "plan": plan_stats,
+    }
+
+
+def configure_emulated(index, generated, last_applied, args):
+    """
+    Configure the emulated pods whose config changed, quietly.
+    Returns how long it took, and the pods that failed
+    """
+    payloads = plan_payloads(generated, last_applied, args.changer_hash)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = configure.configure_pods_ssh(
+            index, payloads, args, transport.NetnsTransport(index))
+    for pod, payload in payloads.items():
+        last_applied[pod] = {"payload_hash": payload["hash"], "changer_hash": args.changer_hash}
+    return round(time.perf_counter() - start, 6), len(payloads), \
+        sorted(pod for pod, result in results.items() if result["status"] != "ok")
+
+
+def emulated_case(name, workers):
+    """
+    Time configuring a case's emulated pods, then reconfiguring them
+    after one bridge is removed
+    """
+    sites, pods_per_site, bridges = CASES[name]
+    hardware = synthetic_hardware(sites, pods_per_site)
+    config = synthetic_config(hardware, bridges)
+    index = topology_sim.HardwareIndex(hardware)
+    fabric = emulator.Emulator(hardware)
+    os.makedirs("logs", exist_ok=True)
+    # pods' output is logged, as it is by create, so that its overhead is included
+    args = argparse.Namespace(full=False, workers=workers, timeout=600, profile=None,
+                              profiler=Profiler(), changer_hash=file_hash("changer.py"),
+                              pod_log=PodLog(live=False))
+    ret = {"case": name, "pods": len(fabric.pods)}
+    start = time.perf_counter()
+    try:
+        fabric.up()
+        ret["up_seconds"] = round(time.perf_counter() - start, 6)
+        allocations = Allocations()
+        last_applied = {}
+        ret["create_seconds"], _, ret["create_failed"] = configure_emulated(
+            index, topology_sim.gen_config(config, index, allocations), last_applied, args)
+        del config["bridges"][sorted(config["bridges"])[0]]
+        allocations = Allocations(allocations.to_dict())
+        ret["reconfigure_seconds"], ret["reconfigured_pods"], ret["reconfigure_failed"] = \
+            configure_emulated(index, topology_sim.gen_config(config, index, allocations),
+                               last_applied, args)
+    finally:
+        args.pod_log.close()
+        start = time.perf_counter()
+        fabric.down()
+        ret["down_seconds"] = round(time.perf_counter() - start, 6)
+    return ret
+
+
+def summary(results):
+    """
+    Returns a markdown table of the results
+    """
+    lines = ["| case | pods | bridges | gen_config s | gen_config MiB | "
+             "create_tarball s | plan s | plan commands |",
+             "|---|---|---|---|---|---|---|---|"]
+    for result in results["cases"]:
+        lines.append(
+            f"| {result['case']} | {result['pods']} | {result['bridges']} "
+            f"| {result['gen_config']['seconds']:.3f} "
+            f"| {result['gen_config']['peak_bytes'] / 2**20:.1f} "
+            f"| {result['create_tarball']['seconds']:.3f} "
+            f"| {result['plan']['seconds']:.3f} | {result['plan']['commands']} |")
+    if results.get("emulated"):
+        lines += ["", "| emulated case | pods | up s | create s | reconfigure s | "
+                  "reconfigured pods | failed pods | down s |",
+                  "|---|---|---|---|---|---|---|---|"]
+        for result in results["emulated"]:
+            failed = len(set(result["create_failed"]) | set(result["reconfigure_failed"]))
+            lines.append(
+                f"| {result['case']} | {result['pods']} | {result['up_seconds']:.3f} "
+                f"| {result['create_seconds']:.3f} | {result['reconfigure_seconds']:.3f} "
+                f"| {result['reconfigured_pods']} | {failed} | {result['down_seconds']:.3f} |")
+    return "\n".join(lines)
+
+
+def regressions(results, baseline, tolerance, min_slowdown=0.0):
+    """
+    Returns a description of each measurement that's more than tolerance
+    times slower than the baseline's, and by more than min_slowdown seconds,
+    so that the noise in measurements of a few milliseconds isn't reported
+    """
+    ret = []
+    baseline_cases = {case["case"]: case for case in baseline["cases"]}
+    for result in results["cases"]:
+        base = baseline_cases.get(result["case"])
+        if not base:
+            continue
+        for stage in ["gen_config", "create_tarball", "plan"]:
+            seconds, base_seconds = result[stage]["seconds"], base[stage]["seconds"]
+            if base_seconds and seconds > base_seconds * tolerance and \
+                    seconds - base_seconds > min_slowdown:
+                ret.append(f"{result['case']} {stage}: {seconds:.3f}s, "
+                           f"baseline {base_seconds:.3f}s")
+    return ret
+
+
+def get_args():
+    """
+    Process command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", default="tiny,small,medium",
+                        help=f"comma separated cases to run, of: {', '.join(CASES)}")
+    parser.add_argument("--output", default="benchmark.json", help="where results are written")
+    parser.add_argument("--tarballs", type=int, default=20,
+                        help="number of pods per case whose tarball is created")
+    parser.add_argument("--emulate", action="store_true",
+                        help="also configure each case's pods, emulated as namespaces, "
+                        "which needs root")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="maximum number of emulated pods configured at once")
+    parser.add_argument("--baseline", help="results to compare against")
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="how many times slower than the baseline is a regression")
+    parser.add_argument("--min-slowdown", type=float, default=0.05,
+                        help="seconds slower than the baseline that a regression must "
+                        "also be, as the shortest measurements are mostly noise")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Run the benchmarks, write the results and report regressions
+    """
+    args = get_args()
+    # create_tarball copies changer.py from the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results = {"python": platform.python_version(), "cases": []}
+    for name in args.cases.split(","):
+        results["cases"].append(run_case(name, args.tarballs))
+    if args.emulate:
+        results["emulated"] = [emulated_case(name, args.workers)
+                               for name in args.cases.split(",")]
+    with open(args.output, "w", encoding="utf8") as file_handle:
+        json.dump(results, file_handle, indent=4)
+    print(summary(results))
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf8") as file_handle:
+            found = regressions(results, json.load(file_handle), args.tolerance,
+                                args.min_slowdown)
+        for regression in found:
+            print(f"regression: {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,55 +4,233 @@
 """
 Runs on pod, in order to construct L2 segments
 """
+# changer.py is shipped to pods as a single file
+# pylint: disable=too-many-lines
 
 from os import listdir
+import argparse
+import contextlib
 import json
-import sys
 import os
+import re
+import subprocess
+import sys
+import time
 
 IP = "/sbin/ip"
-BRCTL = "/usr/sbin/brctl"
 IW = "/usr/sbin/iw"
 EBTABLES = "/usr/sbin/ebtables"
 BRIDGE = "/usr/sbin/bridge"
+# the wireless phys of the namespace that sysfs was mounted in
+PHY_CLASS = "/sys/class/ieee80211"
+
+# Tools that can read commands from stdin via -batch, so that a run of
+# consecutive commands for one of them costs a single process
+BATCH_TOOLS = (IP, BRIDGE)
+
+# The last config successfully applied to this pod. Live state can't tell us
+# what a namespace contains without entering it, so this record is consulted
+# for namespace contents and for veth peers that were moved into a namespace.
+# /tmp is cleared on reboot, as is the network state it describes.
+APPLIED_CONFIG = "/tmp/topology-sim-applied.json"
+
+# The apply in progress: the configs it's between, then a line per operation
+# done. It's removed once the pod is known to match a config again, so one
+# left behind means the changer was interrupted, or couldn't roll back.
+JOURNAL = "/tmp/topology-sim-journal.json"
+# the namespaces that a command creates, deletes, or moves something into or out of
+NAMESPACE_RE = re.compile(r"\bnetns (?:add |del |exec |name )?(\S+)")
+
+
+class Stats:
+    """
+    Counts the processes spawned, and times each phase of a run
+    and each process spawned
+    """
+    processes = 0
+    phases = []
+    commands = []
+    started = time.monotonic()
+
+    @classmethod
+    def reset(cls):
+        """Start counting a new run"""
+        cls.processes = 0
+        cls.phases = []
+        cls.commands = []
+        cls.started = time.monotonic()
+
+    @classmethod
+    @contextlib.contextmanager
+    def spawn(cls, command):
+        """Count a spawned process, and record how long it ran for"""
+        cls.processes += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            cls.commands.append({"type": command_type(command),
+                                 "start": round(start - cls.started, 6),
+                                 "seconds": round(time.monotonic() - start, 6)})
+
+    @classmethod
+    @contextlib.contextmanager
+    def phase(cls, name):
+        """Record the wall time and processes spawned within a phase"""
+        start, processes = time.monotonic(), cls.processes
+        try:
+            yield
+        finally:
+            cls.phases.append({"name": name,
+                               "start": round(start - cls.started, 6),
+                               "seconds": round(time.monotonic() - start, 6),
+                               "processes": cls.processes - processes})
+
+    @classmethod
+    def report(cls):
+        """Print the process count and wall time of each phase"""
+        for phase in cls.phases:
+            print(f"phase {phase['name']}: {phase['processes']} processes, "
+                  f"{phase['seconds']:.3f}s")
+        print(f"total: {cls.processes} processes")
+
+    @classmethod
+    def profile(cls):
+        """
+        Returns the phases and commands of the run, with times relative to its start,
+        the count and total time of each type of command, and the run's total time
+        """
+        counts = {}
+        for command in cls.commands:
+            count = counts.setdefault(command["type"], {"count": 0, "seconds": 0})
+            count["count"] += 1
+            count["seconds"] = round(count["seconds"] + command["seconds"], 6)
+        return {"phases": cls.phases, "commands": cls.commands, "counts": counts,
+                "processes": cls.processes,
+                "seconds": round(time.monotonic() - cls.started, 6)}
+
+
+def command_type(command):
+    """
+    Summarize a command as its tool and subcommand, ie. "ip link" or "ip -batch"
+    """
+    tool = command[0].rsplit("/", 1)[-1]
+    if "-batch" in command:
+        return f"{tool} -batch"
+    subcommand = [arg for arg in command[1:] if not arg.startswith("-")][:1]
+    return " ".join([tool] + subcommand)
 
 
 def exec_cmd(command):
     """
     Executes a command and returns the command's stdout
     """
-    return os.popen(" ".join(command)).read().strip()
+    with Stats.spawn(command):
+        try:
+            return subprocess.run(command, stdout=subprocess.PIPE, check=False,
+                                  universal_newlines=True).stdout.strip()
+        except FileNotFoundError:
+            return ""
 
 
-def get_ifnames_by_type(if_type):
+def run_command(command):
     """
-    Returns an iterable of interface names of the specified type
+    Executes a command, returning None on success or an error message
     """
-    for interface_info in json.loads(
-            exec_cmd([IP, "-j", "link", "show", "type", if_type])):
-        if interface_info:
-            yield interface_info["ifname"]
+    with Stats.spawn(command):
+        try:
+            proc = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  check=False, universal_newlines=True)
+        except FileNotFoundError as error:
+            return str(error)
+    if proc.returncode:
+        return proc.stderr.strip() or f"exit code {proc.returncode}"
+    return None
+
+
+def exec_batch(tool, commands):
+    """
+    Executes commands of a single tool in one process via -batch.
+    Stops at the first failure. Returns (index of the failed command, error),
+    or (None, None) when every command succeeded.
+    """
+    lines = "".join(" ".join(command[1:]) + "\n" for command in commands)
+    with Stats.spawn([tool, "-batch", "-"]):
+        try:
+            proc = subprocess.run([tool, "-batch", "-"], input=lines, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE, check=False, universal_newlines=True)
+        except FileNotFoundError as error:
+            return 0, str(error)
+    if not proc.returncode:
+        return None, None
+    match = re.search(r"Command failed -:(\d+)", proc.stderr)
+    if not match:
+        return 0, proc.stderr.strip()
+    return int(match.group(1)) - 1, proc.stderr[:match.start()].strip()
+
+
+def exec_in_namespaces(command):
+    """
+    Executes a command in every namespace, from a single ip process,
+    and returns each namespace's stdout, keyed by namespace
+    """
+    outputs = {}
+    namespace = None
+    for line in exec_cmd([IP, "-all", "netns", "exec"] + command).split("\n"):
+        if line.startswith("netns: "):
+            namespace = line[len("netns: "):]
+            outputs[namespace] = []
+        elif namespace is not None:
+            outputs[namespace].append(line)
+    return {namespace: "\n".join(lines).strip() for namespace, lines in outputs.items()}
+
+
+def get_links():
+    """
+    Returns detailed info for all interfaces in the current namespace
+    """
+    links = exec_cmd([IP, "-d", "-j", "link", "show"])
+    return json.loads(links) if links else []
 
 
 def get_bridge_vlan_filtering_info():
     """
     Returns vlan filtering configuration
     """
-    return json.loads(exec_cmd([BRIDGE, "-j", "vlan"]))
+    return json.loads(exec_cmd([BRIDGE, "-j", "vlan"]) or "[]")
+
+
+def get_phys():
+    """
+    Returns the wireless phys in the current namespace
+    """
+    try:
+        return listdir(PHY_CLASS)
+    except FileNotFoundError:
+        return []
+
+
+def get_namespace_phys():
+    """
+    Returns the wireless phys in each namespace, keyed by namespace.
+    ip netns exec remounts /sys, so that it shows the namespace's phys
+    """
+    return {namespace: output.split() for namespace, output in exec_in_namespaces(
+        ["sh", "-c", f"ls {PHY_CLASS} 2>/dev/null"]).items()}
 
 
 def remove_vlan_filter(net_interface, vlan_id):
     """
     Removes vid from vlan filter for specified interface
     """
-    exec_cmd([BRIDGE, "vlan", "del", "dev", net_interface, "vid", str(vlan_id)])
+    return [[BRIDGE, "vlan", "del", "dev", net_interface, "vid", str(vlan_id)]]
 
 
 def remove_vlan_filter_self(net_interface, vlan_id):
     """
     Removes vid from vlan filter for specified bridge interface (CPU port)
     """
-    exec_cmd([BRIDGE, "vlan", "del", "dev", net_interface, "self", "vid", str(vlan_id)])
+    return [[BRIDGE, "vlan", "del", "dev", net_interface, "self", "vid", str(vlan_id)]]
 
 
 def clean_wan_bridge_vlans(conf):
@@ -67,6 +245,7 @@ def clean_wan_bridge_vlans(conf):
     isn't untagged in order to get back to the boot-up, clean state
     """
     curr = get_bridge_vlan_filtering_info()
+    commands = []
     for port_info in curr:
         if port_info["ifname"] == conf["wan_bridge"]["name"]:
             for vlan_info in port_info["vlans"]:
@@ -75,47 +254,51 @@ def clean_wan_bridge_vlans(conf):
                     # is a physical device, so this probably
                     # won't work when the wan bridge is software-only
                     # ie. a single pod site with no Internet connection
-                    remove_vlan_filter_self(
-                        port_info["ifname"], vlan_info["vlan"])
+                    commands += remove_vlan_filter_self(port_info["ifname"], vlan_info["vlan"])
             break
+    run_commands(commands)
 
 
-def prohibit_gre_forwarding(conf):
+def remove_legacy_gre_rule(conf, applied):
     """
-    For all sites involved in a layer 2 segment, we have a full mesh
-    of VPN tunnels. When there are more than 2 sites, this there would
-    be a loop without this
+    Older versions prohibited forwarding between all gre tunnels with
+    an ebtables rule. Full mesh tunnels are now isolated bridge ports
+    instead, and hub/tree tunnel layouts must forward between tunnels,
+    so the rule is removed if it's present.
+    A pod whose applied config has per tunnel isolation is already clean.
     """
     if not conf["tunnels"]:
         return
-    if '-i gretap+ -o gretap+ -j DROP' not in exec_cmd(
+    if applied and applied["tunnels"] and \
+            all("isolated" in tunnel for tunnel in applied["tunnels"].values()):
+        return
+    if '-i gretap+ -o gretap+ -j DROP' in exec_cmd(
             [EBTABLES, "-L", "FORWARD", "-t", "filter"]):
-        exec_cmd([EBTABLES, "-A", "FORWARD", "-i",
+        exec_cmd([EBTABLES, "-D", "FORWARD", "-i",
                  "gretap+", "-o", "gretap+", "-j", "DROP"])
 
 
 def del_interface(if_name):
     """Delete a virtual netdev specified by if_name"""
-    exec_cmd([IP, "link", "del", if_name])
+    return [[IP, "link", "del", if_name]]
 
 
-def del_namespace(name):
-    """Delete a namespace specified by parameter 'name'"""
+def del_namespace(name, phys=()):
+    """
+    Delete a namespace specified by parameter 'name'.
+    phys are the wireless phys in it, per get_namespace_phys
+    """
     # work around: move any phys into the default namespace
     # or else the phys will be "lost" when the ns is deleted
-    # This still works on when the pod is just a switch.
-    # iw doesn't exist, but neither will wireless phys
-    list_out = exec_cmd([IP, "netns", "exec", name, "iw", "list"])
-    for line in list_out.split("\n"):
-        if line.startswith("Wiphy"):
-            exec_cmd([IP, "netns", "exec", name, "iw", 'phy', line.split()[1],
-                      "set", "netns", "1"])
-    exec_cmd([IP, "netns", "del", name])
+    commands = [[IP, "netns", "exec", name, "iw", "phy", phy, "set", "netns", "1"]
+                for phy in phys]
+    commands.append([IP, "netns", "del", name])
+    return commands
 
 
 def add_namespace(name):
     """Add a namespace specified by parameter 'name'"""
-    exec_cmd([IP, "netns", "add", name])
+    return [[IP, "netns", "add", name]]
 
 
 def get_namespaces():
@@ -130,62 +313,63 @@ def get_namespaces():
 
 def add_bridge(name):
     """
-    Creates a bridge if it does not already exist.
-    Enables vlan filtering and brings the bridge up,
-    regardless if it pre-existed or not.
+    Creates a bridge, enables vlan filtering and brings the bridge up
     """
-    if name not in get_ifnames_by_type("bridge"):
-        exec_cmd([BRCTL, "addbr", name])
-    exec_cmd([IP, "link", "set", "dev", name, "up"])
-    enable_vlan_filtering(name)
+    return [[IP, "link", "add", "name", name, "type", "bridge"]] + set_bridge_up(name)
 
 
-def enable_vlan_filtering(bridge_interface):
+def set_bridge_up(name):
     """
-    enables vlan filtering for a specified bridge
+    Brings a pre-existing bridge up with vlan filtering enabled
     """
-    exec_cmd([IP, "link", "set", "dev", bridge_interface,
-             "type", "bridge", "vlan_filtering", "1"])
+    return [[IP, "link", "set", "dev", name, "up"]] + enable_vlan_filtering(name)
 
 
-def bridge_members(bridge_name):
+def enable_vlan_filtering(bridge_interface):
     """
-    Returns an iterator of all members of a specified bridge
+    enables vlan filtering for a specified bridge
     """
-    for entry in listdir(f"/sys/devices/virtual/net/{bridge_name}"):
-        if entry.startswith("lower_"):
-            yield entry[len("lower_"):]
+    return [[IP, "link", "set", "dev", bridge_interface,
+             "type", "bridge", "vlan_filtering", "1"]]
 
 
-def del_bridge(name, conf):
+def del_bridge(name, conf, members=()):
     """
     Deletes a bridge, unless it's a WAN bridge.
     For WAN bridges, just remove all members that
     do not provide connectivity to WAN
     """
+    commands = []
     if name == conf["wan_bridge"]["name"]:
-        for bridge_member in bridge_members(name):
+        for bridge_member in members:
             if bridge_member not in conf["wan_bridge"]["members"]:
-                del_bridge_if(name, bridge_member)
+                commands += del_bridge_if(bridge_member)
     else:
-        exec_cmd([IP, "link", "set", "dev", name, "down"])
-        exec_cmd([BRCTL, "delbr", name])
+        commands.append([IP, "link", "set", "dev", name, "down"])
+        commands.append([IP, "link", "del", name])
+    return commands
 
 
 def add_bridge_if(bridge_name, member_name):
     """
-    Adds a member to a bridge if it's not already apart
+    Adds a member to a bridge
     """
-    if member_name in bridge_members(bridge_name):
-        return
     # This is for GRE tunnels. Otherwise we are have a MTU blackhole
-    exec_cmd([IP, "link", "set", "dev", member_name, "up", "mtu", "1500"])
-    exec_cmd([BRCTL, "addif", bridge_name, member_name])
+    return [[IP, "link", "set", "dev", member_name, "up", "mtu", "1500"],
+            [IP, "link", "set", "dev", member_name, "master", bridge_name]]
 
 
-def del_bridge_if(bridge_name, member_name):
+def del_bridge_if(member_name):
     """Removes the specified member from a bridge"""
-    exec_cmd([BRCTL, "delif", bridge_name, member_name])
+    return [[IP, "link", "set", "dev", member_name, "nomaster"]]
+
+
+def set_port_isolation(member_name, isolated):
+    """
+    Isolated bridge ports can only forward to non-isolated ports
+    """
+    return [[IP, "link", "set", "dev", member_name, "type", "bridge_slave",
+             "isolated", "on" if isolated else "off"]]
 
 
 def add_tunnel(name, local, remote, key):
@@ -196,51 +380,140 @@ def add_tunnel(name, local, remote, key):
     nopmtudisc and ignore-df are used in order to provide 1500 MTU
     to the user. Otherwise, we will suffer from a MTU blackhole
     """
-    exec_cmd([IP, "link", "add", name, "type", "gretap", "local",
-             local, "remote", remote, "key", key, "nopmtudisc", "ignore-df"])
+    return [[IP, "link", "add", name, "type", "gretap", "local",
+             local, "remote", remote, "key", key, "nopmtudisc", "ignore-df"]]
 
 
 def add_veth(first_name, second_name):
     """
     Create a veth pair, named after the params.
     """
-    exec_cmd([IP, "link", "add", first_name, "type",
-             "veth", "peer", "name", second_name])
+    return [[IP, "link", "add", first_name, "type",
+             "veth", "peer", "name", second_name]]
+
+
+def vlan_ifname(interface_name, vlan_id):
+    """Name of the vlan interface for a vid on top of an interface"""
+    return f"{interface_name}.{vlan_id}"
 
 
 def add_vlan(interface_name, vlan_id):
     """Create a vlan interface"""
     # ip link add link eth0 name eth0.100 type vlan id 100
-    if_name = f"{interface_name}.{vlan_id}"
-    exec_cmd([IP, "link", "add", "link", interface_name, "name",
-             if_name, "type", "vlan", "id", str(vlan_id)])
-    return if_name
+    return [[IP, "link", "add", "link", interface_name, "name",
+             vlan_ifname(interface_name, vlan_id), "type", "vlan", "id", str(vlan_id)]]
 
 
 def allow_vlan_trunk(interface_name, vlan_id):
     """Allow a tagged vid for specified bridge member"""
-    exec_cmd([BRIDGE, "vlan", "add", "dev", interface_name, "vid", str(vlan_id)])
+    return [[BRIDGE, "vlan", "add", "dev", interface_name, "vid", str(vlan_id)]]
 
 
 def allow_vlan_trunk_self(interface_name, vlan_id):
     """Allow a tagged vid for hardware bridge (CPU port)"""
-    exec_cmd([BRIDGE, "vlan", "add", "dev", interface_name, "self", "vid", str(vlan_id)])
+    return [[BRIDGE, "vlan", "add", "dev", interface_name, "self", "vid", str(vlan_id)]]
 
 
 def set_pvid(interface_name, vlan_id):
     """Set the PVID of a bridge member"""
-    exec_cmd([BRIDGE, "vlan", "add", "dev", interface_name,
-             "vid", str(vlan_id), "pvid", "untagged"])
+    return [[BRIDGE, "vlan", "add", "dev", interface_name,
+             "vid", str(vlan_id), "pvid", "untagged"]]
 
 
 def move_phy_to_namespace(phy, net_namespace):
     """Move a specified wireless phy to a specified network namespace"""
-    exec_cmd([IW, "phy", phy, "set", "netns", "name", net_namespace])
+    return [[IW, "phy", phy, "set", "netns", "name", net_namespace]]
 
 
 def move_eth_to_namespace(netdev, net_namespace):
     """Move a netdev to a network namespace"""
-    exec_cmd([IP, "link", "set", netdev, "netns", net_namespace])
+    return [[IP, "link", "set", netdev, "netns", net_namespace]]
+
+
+def operation_result(command, error, seconds, batch=1):
+    """
+    Describe the outcome of a single command.
+    seconds is the wall time of the process that ran it, which was
+    shared by every command of its batch.
+    """
+    return {
+        "command": " ".join(command),
+        "status": "failed" if error else "ok",
+        "error": error,
+        "seconds": round(seconds, 6),
+        "batch": batch,
+    }
+
+
+def timed_run_command(command):
+    """Run a single command and describe its outcome"""
+    start = time.monotonic()
+    error = run_command(command)
+    return operation_result(command, error, time.monotonic() - start)
+
+
+def skipped_result(command):
+    """Describe a command that wasn't run, as an earlier one failed"""
+    return {"command": " ".join(command), "status": "skipped", "error": None, "seconds": 0,
+            "batch": 0}
+
+
+def run_batch(tool, commands, fallback=True):
+    """
+    Execute commands of a single tool in one batch. If one fails,
+    fall back to running the rest one at a time, so that a single
+    failure doesn't prevent the remaining commands from being applied,
+    or without fallback, stop there.
+    Returns a result for each command that was run.
+    """
+    if len(commands) == 1:
+        return [timed_run_command(commands[0])]
+    start = time.monotonic()
+    failed_index, error = exec_batch(tool, commands)
+    seconds = time.monotonic() - start
+    if failed_index is None:
+        failed_index = len(commands)
+    results = [operation_result(command, None, seconds, len(commands))
+               for command in commands[:failed_index]]
+    if failed_index < len(commands):
+        results.append(operation_result(commands[failed_index], error, seconds, len(commands)))
+        if fallback:
+            results += [timed_run_command(command) for command in commands[failed_index + 1:]]
+    return results
+
+
+def run_commands(commands, on_results=None, stop_on_failure=False):
+    """
+    Execute a list of commands in order.
+    Consecutive commands for a tool that supports -batch are run together.
+    on_results is called with the results of each process as it finishes.
+    With stop_on_failure, the commands after the first that fails are skipped.
+    Returns a result for each command.
+    """
+    results = []
+    start = 0
+    while start < len(commands):
+        tool = commands[start][0]
+        end = start + 1
+        if tool in BATCH_TOOLS:
+            while end < len(commands) and commands[end][0] == tool:
+                end += 1
+            done = run_batch(tool, commands[start:end], fallback=not stop_on_failure)
+        else:
+            done = [timed_run_command(commands[start])]
+        if on_results:
+            on_results(done)
+        results += done
+        start = end
+        if stop_on_failure and failures(done):
+            results += [skipped_result(command) for command in commands[len(results):]]
+            break
+    return results
+
+
+def failures(results):
+    """Returns the results of the commands that failed"""
+    return [result for result in results if result["status"] == "failed"]
 
 
 def clean_configuration(conf):
@@ -250,80 +523,753 @@ def clean_configuration(conf):
     clean_wan_bridge_vlans(conf)
 
     # Blow away all virtual interfaces and namespaces
+    commands = []
+    links = get_links()
+    deleted = set()
+    for kind in ("gretap", "veth", "vlan", "bridge"):
+        for link in links:
+            if link.get("linkinfo", {}).get("info_kind") != kind:
+                continue
+            if kind == "bridge":
+                commands += del_bridge(link["ifname"], conf, [
+                    port["ifname"] for port in links if port.get("master") == link["ifname"]])
+            # deleting one end of a veth pair deletes both
+            elif link.get("link") not in deleted:
+                commands += del_interface(link["ifname"])
+                deleted.add(link["ifname"])
+
+    namespace_phys = get_namespace_phys()
+    for namespace in get_namespaces():
+        commands += del_namespace(namespace, namespace_phys.get(namespace, []))
+
+    run_commands(commands)
 
-    for interface in get_ifnames_by_type("gretap"):
-        del_interface(interface)
 
-    for interface in get_ifnames_by_type("veth"):
-        del_interface(interface)
+def load_applied_config():
+    """
+    Returns the last config applied to this pod, or None if there isn't one
+    """
+    try:
+        with open(APPLIED_CONFIG, encoding="utf8") as file_handle:
+            return json.load(file_handle)
+    except (FileNotFoundError, ValueError):
+        return None
 
-    for interface in get_ifnames_by_type("vlan"):
-        del_interface(interface)
 
-    for interface in get_ifnames_by_type("bridge"):
-        del_bridge(interface, conf)
+def save_applied_config(conf):
+    """
+    Record the config that was just applied to this pod
+    """
+    with open(APPLIED_CONFIG, "w", encoding="utf8") as file_handle:
+        json.dump(conf, file_handle)
 
-    for namespace in get_namespaces():
-        del_namespace(namespace)
 
+def begin_journal(previous, target, done=()):
+    """
+    Start journaling an apply from previous, the last config applied
+    successfully, if any, to target. done carries over the operations of
+    an apply that didn't finish
+    """
+    with open(JOURNAL, "w", encoding="utf8") as file_handle:
+        file_handle.write(json.dumps({"previous": previous, "target": target}) + "\n")
+        for command in done:
+            file_handle.write(json.dumps(command) + "\n")
 
-def create_interfaces(conf):
-    """create all virtual interfaces that that are not bridges"""
 
-    for tunnel, tunnel_info in conf["tunnels"].items():
-        add_tunnel(tunnel, tunnel_info["local"], tunnel_info["remote"], str(tunnel_info["key"]))
+def journal_results(results):
+    """
+    Journal the operations that were done
+    """
+    with open(JOURNAL, "a", encoding="utf8") as file_handle:
+        for result in results:
+            if result["status"] == "ok":
+                file_handle.write(json.dumps(result["command"]) + "\n")
 
-    for first, second in conf["veth_pairs"].items():
-        add_veth(first, second)
 
+def load_journal():
+    """
+    Returns the journal of an apply that didn't finish, as
+    {"previous", "target", "done"}, or None if there isn't one
+    """
+    try:
+        with open(JOURNAL, encoding="utf8") as file_handle:
+            lines = file_handle.read().splitlines()
+        journal = json.loads(lines[0])
+    except (FileNotFoundError, IndexError, ValueError):
+        return None
+    journal["done"] = []
+    for line in lines[1:]:
+        try:
+            journal["done"].append(json.loads(line))
+        except ValueError:
+            # the changer was killed part way through writing it
+            break
+    return journal
 
-def main():
+
+def clear_journal():
     """
-    Configure L2 segements per config passed in via stdin
+    Remove the journal, as the pod matches a config again
     """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(JOURNAL)
 
-    # serialize the config
-    config = json.loads(sys.stdin.read())
 
-    # clean up current config first
-    clean_configuration(config)
+def journaled_config(journal):
+    """
+    Returns what's known to be applied to a pod part way through a journaled
+    apply: the veth pairs of both configs, and the namespaces of the previous
+    config that no operation done touched. Any other namespace's contents are unknown.
+    """
+    previous = journal["previous"] or {"tunnels": {}, "veth_pairs": {}, "namespaces": {}}
+    touched = {namespace for command in journal["done"]
+               for namespace in NAMESPACE_RE.findall(command)}
+    return {**previous,
+            "veth_pairs": {**journal["target"]["veth_pairs"], **previous["veth_pairs"]},
+            "namespaces": {namespace: ns_info
+                           for namespace, ns_info in previous["namespaces"].items()
+                           if namespace not in touched}}
+
 
-    # Do not allow forwarding from one gre tunnel to another
-    prohibit_gre_forwarding(config)
+def load_applied_state():
+    """
+    Returns what's known to be applied to this pod, or None if nothing is,
+    taking into account an apply that didn't finish
+    """
+    journal = load_journal()
+    return journaled_config(journal) if journal else load_applied_config()
+
+
+def empty_config(conf):
+    """
+    The config of a pod that has no segments, as it is after booting
+    """
+    return {**conf, "bridges": {}, "tunnels": {}, "namespaces": {}, "veth_pairs": {}}
 
-    wan = config["wan_bridge"]["name"]
-    # Enable vlan filtering for the WAN bridge
-    enable_vlan_filtering(wan)
 
-    for namespace, ns_info in config["namespaces"].items():
-        add_namespace(namespace)
+def gre_key(key):
+    """
+    ip -j reports gre keys in dotted quad notation
+    """
+    if isinstance(key, int):
+        return key
+    if "." not in key:
+        return int(key)
+    value = 0
+    for octet in key.split("."):
+        value = (value << 8) + int(octet)
+    return value
 
-    create_interfaces(config)
 
-    for bridge, bridge_info in config["bridges"].items():
-        physical_members = bridge_info['physical_members']
-        virtual_members = bridge_info['virtual_members']
-        vid = bridge_info['vid']
-        add_bridge(bridge)
+def new_state():
+    """
+    Returns an empty state.
+    Both the desired state, derived from the config, and the live state,
+    read from the pod, are described this way so that they can be diffed.
+    """
+    return {
+        # bridge name -> {"up": bool, "vlan_filtering": bool}
+        "bridges": {},
+        # bridge name -> set of member names
+        "members": {},
+        # gretap name -> (local, remote, key)
+        "tunnels": {},
+        # veth name -> peer name (None if unknown)
+        "veths": {},
+        # vlan interface name -> (link, vid)
+        "vlans": {},
+        # bridge port -> {vid: flags}
+        "port_vids": {},
+        # bridge ports that may only forward to non-isolated ports
+        "isolated": set(),
+        # vids allowed on the wan bridge itself (CPU port)
+        "self_vids": set(),
+        # namespace name -> namespace config (None if unknown)
+        "namespaces": {},
+        # netdevs and phys visible in this namespace
+        "netdevs": set(),
+        "phys": set(),
+    }
+
+
+def desired_state(conf):
+    """
+    Derive the state that conf describes
+    """
+    wan = conf["wan_bridge"]["name"]
+    state = new_state()
+    state["bridges"][wan] = {"up": True, "vlan_filtering": True}
+    state["members"][wan] = set(conf["wan_bridge"]["members"])
+    state["self_vids"].add(1)
+    for tunnel, tunnel_info in conf["tunnels"].items():
+        state["tunnels"][tunnel] = (
+            tunnel_info["local"], tunnel_info["remote"], int(tunnel_info["key"]))
+        if tunnel_info.get("isolated"):
+            state["isolated"].add(tunnel)
+    state["veths"] = dict(conf["veth_pairs"])
+    state["namespaces"] = dict(conf["namespaces"])
+
+    for bridge, bridge_info in conf["bridges"].items():
+        vid = bridge_info["vid"]
+        state["bridges"][bridge] = {"up": True, "vlan_filtering": True}
+        members = state["members"].setdefault(bridge, set())
         if bridge != wan:
-            for trunk_port in config["trunk_ports"]:
-                allow_vlan_trunk(trunk_port, vid)
-            allow_vlan_trunk_self(wan, vid)
-            vlan_if_name = add_vlan(wan, vid)
-            add_bridge_if(bridge, vlan_if_name)
-
-        for member in physical_members:
-            add_bridge_if(wan, member)
-            remove_vlan_filter(member, 1)
-            set_pvid(member, vid)
-        for member in virtual_members:
-            add_bridge_if(bridge, member)
-
-    for namespace, ns_info in config["namespaces"].items():
-        if ns_info["client_type"] == "wireless":
-            move_phy_to_namespace(ns_info["phy"], namespace)
-        elif ns_info["client_type"] == "wired":
-            move_eth_to_namespace(ns_info["port"], namespace)
+            vlan_if_name = vlan_ifname(wan, vid)
+            state["vlans"][vlan_if_name] = (wan, vid)
+            members.add(vlan_if_name)
+            state["self_vids"].add(vid)
+            for trunk_port in conf["trunk_ports"]:
+                state["port_vids"].setdefault(trunk_port, {})[vid] = []
+        for member in bridge_info["physical_members"]:
+            state["members"][wan].add(member)
+            state["port_vids"][member] = {vid: ["PVID", "Egress Untagged"]}
+        members.update(bridge_info["virtual_members"])
+    return state
+
+
+def read_live_links(state, applied_veths):
+    """
+    Fill in the state of the interfaces in the current namespace
+    """
+    for link in get_links():
+        name = link["ifname"]
+        state["netdevs"].add(name)
+        if "master" in link:
+            state["members"].setdefault(link["master"], set()).add(name)
+            if link.get("linkinfo", {}).get("info_slave_data", {}).get("isolated"):
+                state["isolated"].add(name)
+        kind = link.get("linkinfo", {}).get("info_kind")
+        info = link.get("linkinfo", {}).get("info_data", {})
+        if kind == "bridge":
+            state["bridges"][name] = {
+                "up": "UP" in link["flags"],
+                "vlan_filtering": bool(info.get("vlan_filtering")),
+            }
+            state["members"].setdefault(name, set())
+        elif kind == "gretap":
+            state["tunnels"][name] = (
+                info.get("local"), info.get("remote"), gre_key(info.get("ikey", 0)))
+        elif kind == "veth":
+            state["veths"][name] = link.get("link", applied_veths.get(name))
+        elif kind == "vlan":
+            state["vlans"][name] = (link.get("link"), info.get("id"))
+
+
+def read_live_vlans(state, wan):
+    """
+    Fill in the vlan filters of the bridge ports and the wan bridge itself
+    """
+    for port_info in get_bridge_vlan_filtering_info():
+        vids = {}
+        for vlan_info in port_info["vlans"]:
+            for vid in range(vlan_info["vlan"], vlan_info.get("vlanEnd", vlan_info["vlan"]) + 1):
+                vids[vid] = vlan_info.get("flags", [])
+        if port_info["ifname"] == wan:
+            state["self_vids"] = set(vids)
+        else:
+            state["port_vids"][port_info["ifname"]] = vids
+
+
+def read_live_state(conf, applied):
+    """
+    Read the current state of the pod.
+    applied is the last config applied to the pod, if any.
+    """
+    state = new_state()
+    read_live_links(state, applied["veth_pairs"] if applied else {})
+    read_live_vlans(state, conf["wan_bridge"]["name"])
+    state["phys"] = set(get_phys())
+    applied_namespaces = applied["namespaces"] if applied else {}
+    for namespace in get_namespaces():
+        # we can only vouch for the contents of namespaces that we created
+        state["namespaces"][namespace] = applied_namespaces.get(namespace)
+    return state
+
+
+def read_namespace(state, ifnames, name, links, phys):
+    """
+    Fill in the config of a namespace per what it holds, its links and phys:
+    a wired client's veth end or a wireless client's phy, or None if it holds
+    anything else. The peer of a wired client's veth end is found by its
+    ifindex, per ifnames.
+    """
+    veths = [link for link in links if link.get("linkinfo", {}).get("info_kind") == "veth"]
+    state["namespaces"][name] = None
+    if len(veths) == 1 and not phys:
+        state["namespaces"][name] = {"client_type": "wired", "port": veths[0]["ifname"]}
+        peer = ifnames.get(veths[0].get("link_index"))
+        if peer in state["veths"]:
+            state["veths"][peer] = veths[0]["ifname"]
+    elif len(phys) == 1 and not veths:
+        state["namespaces"][name] = {"client_type": "wireless", "phy": phys[0]}
+
+
+def snapshot_state(conf):
+    """
+    Read the current state of the pod, looking inside every namespace
+    rather than vouching only for those that were applied.
+    Used for the controller's drift reports, and as the live state of a later apply
+    """
+    state = read_live_state(conf, load_applied_state())
+    ifnames = {link.get("ifindex"): link["ifname"] for link in get_links()}
+    namespace_links = exec_in_namespaces([IP, "-d", "-j", "link", "show"])
+    namespace_phys = get_namespace_phys()
+    for namespace in state["namespaces"]:
+        read_namespace(state, ifnames, namespace,
+                       json.loads(namespace_links.get(namespace) or "[]"),
+                       namespace_phys.get(namespace, []))
+    return state
+
+
+class Plan:
+    """
+    An ordered list of changes, each with a summary line and its commands
+    """
+    def __init__(self):
+        self.changes = []
+
+    def add(self, summary, commands):
+        """Append a change to the plan"""
+        self.changes.append((summary, commands))
+
+    def commands(self):
+        """Returns all of the plan's commands, in order"""
+        return [command for _, commands in self.changes for command in commands]
+
+    def summary(self):
+        """Returns the summary lines of the plan"""
+        return [summary for summary, _ in self.changes]
+
+
+def drop_netdev(live, name):
+    """
+    Reflect the removal of a netdev in the live state
+    """
+    live["netdevs"].discard(name)
+    for members in live["members"].values():
+        members.discard(name)
+    live["port_vids"].pop(name, None)
+    live["isolated"].discard(name)
+    live["tunnels"].pop(name, None)
+    live["vlans"].pop(name, None)
+    peer = live["veths"].pop(name, None)
+    if peer:
+        # deleting one end of a veth pair deletes both
+        live["veths"].pop(peer, None)
+        live["netdevs"].discard(peer)
+        for members in live["members"].values():
+            members.discard(peer)
+
+
+def plan_namespace_removals(plan, desired, live):
+    """
+    Remove namespaces that are not wanted, or whose contents differ.
+    The phys in every namespace are found in one pass, if any is removed.
+    """
+    kept_ports = {ns_info["port"] for namespace, ns_info in live["namespaces"].items()
+                  if ns_info and ns_info["client_type"] == "wired"
+                  and desired["namespaces"].get(namespace) == ns_info}
+    removed = {namespace: ns_info for namespace, ns_info in live["namespaces"].items()
+               if desired["namespaces"].get(namespace) != ns_info}
+    namespace_phys = get_namespace_phys() if removed else {}
+    for namespace, ns_info in sorted(removed.items()):
+        if ns_info is None:
+            # We don't know which veth end was moved into this namespace,
+            # so remove every veth whose peer isn't accounted for.
+            # Otherwise it would be destroyed behind our back.
+            for veth, peer in sorted(live["veths"].items()):
+                if veth in live["veths"] and peer not in live["netdevs"] \
+                        and peer not in kept_ports:
+                    plan.add(f"- veth {veth}", del_interface(veth))
+                    drop_netdev(live, veth)
+        plan.add(f"- namespace {namespace}",
+                 del_namespace(namespace, namespace_phys.get(namespace, [])))
+        del live["namespaces"][namespace]
+        if ns_info and ns_info["client_type"] == "wired":
+            # the namespace's veth end is destroyed along with it
+            for first, second in list(live["veths"].items()):
+                if ns_info["port"] in (first, second):
+                    drop_netdev(live, first)
+        elif ns_info and ns_info["client_type"] == "wireless":
+            live["phys"].add(ns_info["phy"])
+
+
+def plan_interface_removals(plan, desired, live):
+    """
+    Remove gretaps, veths and vlan interfaces that are not wanted,
+    or whose parameters differ
+    """
+    for tunnel, tunnel_info in sorted(live["tunnels"].items()):
+        if desired["tunnels"].get(tunnel) != tunnel_info:
+            plan.add(f"- tunnel {tunnel}", del_interface(tunnel))
+            drop_netdev(live, tunnel)
+
+    for veth, peer in sorted(live["veths"].items()):
+        if veth not in live["veths"]:
+            # already removed along with its peer
+            continue
+        if desired["veths"].get(veth) != peer and desired["veths"].get(peer) != veth:
+            plan.add(f"- veth {veth}", del_interface(veth))
+            drop_netdev(live, veth)
+
+    for vlan, vlan_info in sorted(live["vlans"].items()):
+        if desired["vlans"].get(vlan) != vlan_info:
+            plan.add(f"- vlan {vlan}", del_interface(vlan))
+            drop_netdev(live, vlan)
+
+
+def plan_bridge_removals(plan, conf, desired, live):
+    """
+    Remove bridges and bridge members that are not wanted
+    """
+    wan = conf["wan_bridge"]["name"]
+    for bridge in sorted(live["bridges"]):
+        if bridge == wan or bridge in desired["bridges"]:
+            continue
+        plan.add(f"- bridge {bridge}", del_bridge(bridge, conf))
+        for member in live["members"].pop(bridge, set()):
+            live["port_vids"].pop(member, None)
+        del live["bridges"][bridge]
+
+    for bridge, members in sorted(live["members"].items()):
+        if bridge not in live["bridges"]:
+            continue
+        for member in sorted(members - desired["members"].get(bridge, set())):
+            plan.add(f"- member {member} of {bridge}", del_bridge_if(member))
+            members.discard(member)
+            live["port_vids"].pop(member, None)
+            live["isolated"].discard(member)
+
+
+def plan_vlan_removals(plan, conf, desired, live):
+    """
+    Remove vids that are no longer used from the wan bridge, trunk ports
+    and DUT facing ports
+    """
+    wan = conf["wan_bridge"]["name"]
+    stale_vids = live["self_vids"] - desired["self_vids"]
+    for vid in sorted(stale_vids):
+        commands = remove_vlan_filter_self(wan, vid)
+        for trunk_port in conf["trunk_ports"]:
+            if vid in live["port_vids"].get(trunk_port, {}):
+                commands += remove_vlan_filter(trunk_port, vid)
+                del live["port_vids"][trunk_port][vid]
+        plan.add(f"- vid {vid}", commands)
+        live["self_vids"].discard(vid)
+
+    for port, vids in sorted(desired["port_vids"].items()):
+        if port in conf["trunk_ports"] or port not in live["port_vids"]:
+            continue
+        for vid in sorted(set(live["port_vids"][port]) - set(vids)):
+            plan.add(f"- vid {vid} on {port}", remove_vlan_filter(port, vid))
+            del live["port_vids"][port][vid]
+
+
+def plan_interface_additions(plan, desired, live):
+    """
+    Add namespaces, gretaps and veths that are missing
+    """
+    for namespace in sorted(desired["namespaces"]):
+        if namespace not in live["namespaces"]:
+            plan.add(f"+ namespace {namespace}", add_namespace(namespace))
+
+    for tunnel, (local, remote, key) in sorted(desired["tunnels"].items()):
+        if tunnel not in live["tunnels"]:
+            plan.add(f"+ tunnel {tunnel} (key {key}, {local} -> {remote})",
+                     add_tunnel(tunnel, local, remote, str(key)))
+            live["netdevs"].add(tunnel)
+
+    for first, second in sorted(desired["veths"].items()):
+        if live["veths"].get(first) != second:
+            plan.add(f"+ veth {first} <-> {second}", add_veth(first, second))
+            live["netdevs"].update([first, second])
+
+
+def plan_bridges(plan, conf, desired, live):
+    """
+    Add bridges that are missing, and bring up existing ones
+    """
+    wan = conf["wan_bridge"]["name"]
+    for bridge, bridge_state in sorted(desired["bridges"].items()):
+        if bridge not in live["bridges"]:
+            plan.add(f"+ bridge {bridge}", add_bridge(bridge))
+        elif bridge == wan and not live["bridges"][bridge]["vlan_filtering"]:
+            plan.add(f"+ bridge {bridge} vlan filtering", enable_vlan_filtering(bridge))
+        elif bridge != wan and live["bridges"][bridge] != bridge_state:
+            plan.add(f"+ bridge {bridge} up, vlan filtering", set_bridge_up(bridge))
+
+
+def plan_bridge_additions(plan, conf, desired, live):
+    """
+    Add vlan interfaces and bridge members that are missing
+    """
+    wan = conf["wan_bridge"]["name"]
+    for vid in sorted(desired["self_vids"] - live["self_vids"]):
+        plan.add(f"+ vid {vid}", allow_vlan_trunk_self(wan, vid))
+
+    for vlan, (link, vid) in sorted(desired["vlans"].items()):
+        if vlan not in live["vlans"]:
+            plan.add(f"+ vlan {vlan}", add_vlan(link, vid))
+
+    for bridge, members in sorted(desired["members"].items()):
+        for member in sorted(members - live["members"].get(bridge, set())):
+            if bridge == wan and member in conf["wan_bridge"]["members"]:
+                # provides connectivity, so never touched
+                continue
+            plan.add(f"+ member {member} of {bridge}", add_bridge_if(bridge, member))
+            # a new bridge port starts out with the default PVID, and not isolated
+            live["port_vids"][member] = {1: ["PVID", "Egress Untagged"]}
+            live["isolated"].discard(member)
+
+
+def plan_port_isolation(plan, desired, live):
+    """
+    Isolate tunnel ports from each other, per the tunnel layout
+    """
+    for port in sorted(desired["isolated"] - live["isolated"]):
+        plan.add(f"+ isolated {port}", set_port_isolation(port, True))
+    for port in sorted(live["isolated"] - desired["isolated"]):
+        if port not in desired["tunnels"]:
+            # only tunnel ports are managed
+            continue
+        plan.add(f"- isolated {port}", set_port_isolation(port, False))
+
+
+def plan_vlan_additions(plan, conf, desired, live):
+    """
+    Add vids to trunk ports and DUT facing ports
+    """
+    for port, vids in sorted(desired["port_vids"].items()):
+        live_vids = live["port_vids"].get(port, {})
+        for vid, flags in sorted(vids.items()):
+            if vid in live_vids and set(flags) <= set(live_vids[vid]):
+                continue
+            if flags:
+                plan.add(f"+ vid {vid} pvid on {port}", set_pvid(port, vid))
+            else:
+                plan.add(f"+ vid {vid} on {port}", allow_vlan_trunk(port, vid))
+        if port not in conf["trunk_ports"] and 1 in live_vids and 1 not in vids:
+            plan.add(f"- vid 1 on {port}", remove_vlan_filter(port, 1))
+
+
+def plan_namespace_moves(plan, desired, live):
+    """
+    Move wired ports and wireless phys into their namespaces
+    """
+    for namespace, ns_info in sorted(desired["namespaces"].items()):
+        if ns_info["client_type"] == "wireless" and \
+                (namespace not in live["namespaces"] or ns_info["phy"] in live["phys"]):
+            plan.add(f"+ phy {ns_info['phy']} in {namespace}",
+                     move_phy_to_namespace(ns_info["phy"], namespace))
+        elif ns_info["client_type"] == "wired" and \
+                (namespace not in live["namespaces"] or ns_info["port"] in live["netdevs"]):
+            plan.add(f"+ port {ns_info['port']} in {namespace}",
+                     move_eth_to_namespace(ns_info["port"], namespace))
+
+
+def plan_changes(conf, live):
+    """
+    Build the plan that takes the pod from its live state to conf.
+    live is updated to reflect the removals as they are planned.
+    """
+    desired = desired_state(conf)
+    plan = Plan()
+    plan_namespace_removals(plan, desired, live)
+    plan_interface_removals(plan, desired, live)
+    plan_bridge_removals(plan, conf, desired, live)
+    plan_vlan_removals(plan, conf, desired, live)
+    plan_interface_additions(plan, desired, live)
+    plan_bridges(plan, conf, desired, live)
+    plan_bridge_additions(plan, conf, desired, live)
+    plan_port_isolation(plan, desired, live)
+    plan_vlan_additions(plan, conf, desired, live)
+    plan_namespace_moves(plan, desired, live)
+    return plan
+
+
+def serialize_state(state):
+    """
+    Convert a state into something that can be dumped as JSON
+    """
+    ret = {}
+    for key, value in state.items():
+        if isinstance(value, set):
+            ret[key] = sorted(value)
+        elif isinstance(value, dict):
+            ret[key] = {
+                str(name): sorted(info) if isinstance(info, set) else info
+                for name, info in value.items()
+            }
+        else:
+            ret[key] = value
+    return ret
+
+
+def deserialize_state(data):
+    """
+    Convert a state that was dumped as JSON back into a state
+    """
+    state = new_state()
+    state.update({
+        "bridges": dict(data["bridges"]),
+        "members": {bridge: set(members) for bridge, members in data["members"].items()},
+        "tunnels": {name: tuple(info) for name, info in data["tunnels"].items()},
+        "veths": dict(data["veths"]),
+        "vlans": {name: tuple(info) for name, info in data["vlans"].items()},
+        "port_vids": {port: {int(vid): flags for vid, flags in vids.items()}
+                      for port, vids in data["port_vids"].items()},
+        "namespaces": dict(data["namespaces"]),
+    })
+    for key in ("isolated", "self_vids", "netdevs", "phys"):
+        state[key] = set(data[key])
+    return state
+
+
+def roll_back(previous):
+    """
+    Take this pod back to previous, after the journaled apply failed part way.
+    The changes are planned from the live state, as they are for an apply,
+    so only what the failed apply changed is undone.
+    Returns a structured description of the rollback
+    """
+    with Stats.phase("rollback"):
+        live = read_live_state(previous, journaled_config(load_journal()))
+        plan = plan_changes(previous, live)
+        results = run_commands(plan.commands(), on_results=journal_results)
+    if not failures(results):
+        save_applied_config(previous)
+        clear_journal()
+    return {"status": "failed" if failures(results) else "ok",
+            "changes": plan.summary(), "operations": results}
+
+
+def apply_config(config, full=False, dry_run=False, final_state=False, live_state=None):
+    """
+    Take this pod from its live state to config.
+    full tears everything down first, dry_run only plans the changes and
+    final_state reads back the pod's state once the changes are applied.
+    live_state is a serialized snapshot, taken by the controller, that is
+    planned from instead of reading the pod's state again. It's ignored after
+    an apply that didn't finish, or with full.
+    Changes are journaled as they're made, and applying stops at the first
+    that fails, at which point the pod is rolled back to the last config
+    applied successfully, or to no segments if there isn't one.
+    Returns a structured description of the run.
+    """
+    Stats.reset()
+    journal = load_journal()
+    previous = journal["previous"] if journal else load_applied_config()
+    applied = journaled_config(journal) if journal else previous
+    if not dry_run:
+        begin_journal(previous, config, journal["done"] if journal else ())
+    if full and not dry_run:
+        with Stats.phase("clean"):
+            clean_configuration(config)
+        applied = None
+
+    with Stats.phase("discover"):
+        if not dry_run:
+            remove_legacy_gre_rule(config, applied)
+        live = deserialize_state(live_state) if live_state and not journal and not full \
+            else read_live_state(config, applied)
+
+    with Stats.phase("plan"):
+        plan = plan_changes(config, live)
+
+    results = []
+    rollback = None
+    if not dry_run:
+        with Stats.phase("apply"):
+            results = run_commands(plan.commands(), on_results=journal_results,
+                                   stop_on_failure=True)
+        if failures(results):
+            rollback = roll_back(previous or empty_config(config))
+        else:
+            save_applied_config(config)
+            clear_journal()
+
+    status = "failed" if failures(results) else "ok"
+    if rollback and rollback["status"] == "ok":
+        status = "rolled_back"
+    ret = {
+        "status": status,
+        "changes": plan.summary(),
+        "operations": results,
+        "rollback": rollback,
+        "phases": Stats.phases,
+        "processes": Stats.processes,
+        "profile": Stats.profile(),
+    }
+    if final_state:
+        ret["state"] = serialize_state(read_live_state(config, load_applied_state()))
+    return ret
+
+
+def result_summary(result):
+    """
+    The outcome of an apply, for the controller: its status and the operations that failed
+    """
+    summary = {"status": result["status"], "failed": failures(result["operations"])}
+    if result["rollback"]:
+        summary["rollback"] = {"status": result["rollback"]["status"],
+                               "changes": len(result["rollback"]["changes"]),
+                               "failed": failures(result["rollback"]["operations"])}
+    return summary
+
+
+def get_args():
+    """
+    Process command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full", action="store_true",
+                        help="tear down all virtual interfaces and namespaces, then rebuild")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the changes that would be made, without making them")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the timing of each phase and command as JSON")
+    parser.add_argument("--state", action="store_true",
+                        help="print a snapshot of the pod's live state as JSON, "
+                        "without changing anything")
+    parser.add_argument("--live-state", action="store_true",
+                        help="stdin is {\"config\", \"state\"}, where state is a snapshot "
+                        "to plan from, rather than reading the pod's state")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Configure L2 segements per config passed in via stdin
+    """
+    args = get_args()
+
+    # serialize the config
+    config = json.loads(sys.stdin.read())
+    if args.state:
+        print(f"state: {json.dumps(serialize_state(snapshot_state(config)))}")
+        return
+    live_state = None
+    if args.live_state:
+        config, live_state = config["config"], config["state"]
+
+    result = apply_config(config, full=args.full, dry_run=args.dry_run, live_state=live_state)
+    for line in result["changes"]:
+        print(line)
+    if not result["changes"]:
+        print("no changes")
+    for failure in failures(result["operations"]):
+        print(f"failed: {failure['command']}: {failure['error']}")
+    if result["rollback"]:
+        for failure in failures(result["rollback"]["operations"]):
+            print(f"rollback failed: {failure['command']}: {failure['error']}")
+        print(f"rollback: {result['rollback']['status']}, "
+              f"{len(result['rollback']['changes'])} changes")
+    Stats.report()
+    if args.profile:
+        print(f"profile: {json.dumps(result['profile'])}")
+    print(f"result: {json.dumps(result_summary(result))}")
+    if result["status"] != "ok":
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""
+On disk cache of parsed config files, and of what's derived from them, so that
+interactive commands such as client and serial don't parse YAML, or generate
+configs, on every run.
+An entry is used while the files it was derived from have the same size and
+mtime, or failing that, the same contents.
+"""
+
+import hashlib
+import os
+import pickle
+
+from pod_state import STATE_DIR, file_hash
+
+CACHE_DIR = f"{STATE_DIR}/cache"
+# bumped when what's cached changes, so that older entries aren't used
+VERSION = 1
+
+
+def load_yaml(path):
+    """
+    Parse a YAML file, with libyaml when PyYAML was built with it
+    """
+    # imported here, as it's only needed when the cache is stale
+    import yaml  # pylint: disable=import-outside-toplevel
+    with open(path, encoding="utf8") as file_handle:
+        return yaml.load(file_handle, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def stat_key(path):
+    """
+    The size and mtime of a file, which change whenever it's written
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def entry_path(kind, paths):
+    """
+    Where the entry derived from paths is cached
+    """
+    key = "\n".join(os.path.abspath(path) for path in paths)
+    return os.path.join(CACHE_DIR, f"{kind}-{hashlib.sha256(key.encode('utf8')).hexdigest()[:16]}"
+                        ".pickle")
+
+
+def load_entry(path):
+    """
+    Returns a cache entry, or None if there isn't a usable one
+    """
+    try:
+        with open(path, "rb") as file_handle:
+            entry = pickle.load(file_handle)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    return entry if isinstance(entry, dict) and entry.get("version") == VERSION else None
+
+
+def save_entry(path, entry):
+    """
+    Atomically replace a cache entry, best effort
+    """
+    tmp_path = f"{path}.{os.getpid()}"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as file_handle:
+            pickle.dump(entry, file_handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def cached(kind, paths, build):
+    """
+    Returns build(), from the cache for as long as the files at paths are unchanged.
+    What build() returns must be plain data, ie. dicts, lists and tuples
+    """
+    path = entry_path(kind, paths)
+    # taken before building, so that files written meanwhile are seen as changed next time
+    stats = [stat_key(file_path) for file_path in paths]
+    entry = load_entry(path)
+    hashes = None
+    if entry is not None:
+        if entry["stats"] == stats:
+            return entry["value"]
+        # touched, ie. by a checkout, but not necessarily changed
+        hashes = [file_hash(file_path) for file_path in paths]
+        if entry["hashes"] == hashes:
+            save_entry(path, {**entry, "stats": stats})
+            return entry["value"]
+    value = build()
+    save_entry(path, {"version": VERSION, "stats": stats,
+                      "hashes": hashes or [file_hash(file_path) for file_path in paths],
+                      "value": value})
+    return value
+
+
+def load_config(path):
+    """
+    Returns a parsed YAML config file, from the cache while it's unchanged
+    """
+    return cached("yaml", [path], lambda: load_yaml(path))
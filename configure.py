@@ -0,0 +1,329 @@
+"""
+Applying generated configs to pods, over the pod agents, multiplexed ssh,
+or the legacy connect.expect script.
+What each pod outputs is streamed to the controller's pod log as it's output
+"""
+
+import concurrent.futures
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from transport import POD_DIR, AgentPool, SSHTransport, pod_transport, run_streaming
+
+# exit code of the remote command when the pod's copy of changer.py is stale
+STALE_CHANGER = 75
+
+
+def create_tarball(pod, pod_config):
+    """
+    Create a tarball to be delivered to a pod
+    Each tarball is named after the pod name,
+    and contains:
+    - the intermediate config for the pod
+    - the changer script
+    """
+    tarball_name = f"/tmp/{pod}.tar.gz"
+    dir_path = f"/tmp/{pod}"
+    if os.path.isdir(dir_path):
+        shutil.rmtree(dir_path)
+    os.mkdir(dir_path)
+    shutil.copyfile("changer.py", f"{dir_path}/changer.py")
+    with open(f"{dir_path}/config.json", 'w', encoding="utf8") as file_handle:
+        json.dump(pod_config, file_handle, indent=4)
+    # imported here, as only the expect transport sends tarballs
+    import tarfile  # pylint: disable=import-outside-toplevel
+    with tarfile.open(tarball_name, "w:gz") as tar:
+        tar.add(dir_path, arcname=os.path.basename(dir_path))
+    return tarball_name
+
+
+def parse_changer_result(stdout):
+    """
+    Returns the result line that changer.py printed, or None if it didn't print one
+    """
+    for line in stdout.decode("utf8", "replace").splitlines():
+        if line.startswith("result: "):
+            try:
+                return json.loads(line[len("result: "):])
+            except ValueError:
+                return None
+    return None
+
+
+def error_result(error):
+    """
+    The result of a pod that couldn't be configured at all
+    """
+    return {"status": "error", "error": error, "failed": []}
+
+
+def proc_result(proc):
+    """
+    The result of running the changer on a pod: what it reported, or an
+    error if it failed before it could
+    """
+    result = parse_changer_result(proc.stdout)
+    if result is None:
+        stderr = proc.stderr.decode("utf8", "replace").strip().splitlines()
+        result = {"status": "ok", "failed": []} if not proc.returncode else \
+            error_result(stderr[-1] if stderr else f"resulted in {proc.returncode} exit_code")
+    result["exit_code"] = proc.returncode
+    return result
+
+
+def agent_result(response):
+    """
+    The result of configuring a pod through its agent
+    """
+    if response["status"] == "error":
+        return error_result(response["error"])
+    # imported here, as only agent responses need it
+    import changer  # pylint: disable=import-outside-toplevel
+    return changer.result_summary(response)
+
+
+def describe_result(result):
+    """
+    A short description of a pod's result
+    """
+    if result["status"] == "ok":
+        return "done"
+    if result["status"] == "error":
+        return result["error"]
+    failure = f"failed: {result['failed'][0]['command']}: {result['failed'][0]['error']}" \
+        if result["failed"] else "failed"
+    if result["status"] == "rolled_back":
+        return f"{failure}, rolled back to its previous config"
+    return f"{failure}, and its rollback failed, so it's part way between configs"
+
+
+def format_failures(index, failed):
+    """
+    Returns a line per pod that failed to configure, and per operation
+    that failed while rolling it back
+    """
+    lines = []
+    for pod, result in sorted(failed.items()):
+        lines.append(f"pod: {pod}, host: {index.pod_host(pod)} {describe_result(result)}")
+        for failure in result.get("rollback", {}).get("failed", []):
+            lines.append(f"pod: {pod}, host: {index.pod_host(pod)} rollback failed: "
+                         f"{failure['command']}: {failure['error']}")
+    return "\n".join(lines)
+
+
+def configure_pods_agent(index, generated, args, live_states=None):
+    """
+    Configure all pods through their agents, planning from the snapshots
+    in live_states where there are any. Up to args.workers pods are sent
+    their configs at once, each allowed args.timeout seconds, and agents that
+    don't run the controller's changer.py refuse, as stale.
+    Each pod's response is kept in logs/<pod>.json, and its failed
+    operations are recorded in the pod log
+    """
+    pool = AgentPool(index, args.agent_token, args.timeout, args.workers)
+    args.pod_log.begin(generated)
+    for pod in generated:
+        args.pod_log.phase(pod, "apply")
+    try:
+        responses = pool.apply_all(generated, args.full, live_states, args.changer_hash)
+    finally:
+        pool.close()
+    finished = time.monotonic()
+    for pod, response in responses.items():
+        if "profile" in response:
+            args.profiler.add_changer_profile(pod, finished, response["profile"])
+        with open(f"logs/{pod}.json", "w", encoding="utf8") as file_handle:
+            json.dump(response, file_handle, indent=4)
+        prefix = f"pod: {pod}, host: {index.pod_host(pod)}"
+        if response["status"] == "error":
+            args.pod_log.done(pod, False, f"{prefix}: {response['error']}")
+            continue
+        failures = [f"failed: {operation['command']}: {operation['error']}"
+                    for operation in response["operations"] if operation["status"] == "failed"]
+        for failure in failures:
+            args.pod_log.line(pod, "stderr", failure)
+        args.pod_log.done(pod, not failures, f"{prefix} {failures[0]}" if failures else
+                          f"{prefix} done")
+    args.pod_log.end()
+    return responses
+
+
+class PodTimeout(Exception):
+    """
+    Raised when a pod takes longer than allowed to configure
+    """
+
+
+class PodCommandError(Exception):
+    """
+    Raised when a command run on a pod fails
+    """
+
+
+def changer_input(payload):
+    """
+    What the changer is fed over stdin: the pod's config, along with the
+    controller's snapshot of the pod's live state, if there is one
+    """
+    if "live_state" in payload:
+        return json.dumps({"config": payload["config"], "state": payload["live_state"]})
+    return json.dumps(payload["config"])
+
+
+@contextlib.contextmanager
+def step(args, pod, name):
+    """
+    Time a step of configuring a pod on its track of args.profiler, and
+    tag what the pod outputs meanwhile with it in args.pod_log
+    """
+    args.pod_log.phase(pod, name)
+    with args.profiler.span(pod, name):
+        yield
+
+
+def configure_pod_ssh(transport, pod, host, payload, args):
+    """
+    Configure a single pod over ssh: push the changer script if needed,
+    then stream the pod's config to it over stdin.
+    The pod's copy of the changer is checked against the expected hash
+    before it's run, so a pod that lost it, ie. by rebooting, gets it pushed.
+    A snapshot of the pod's live state, if the payload has one, is sent along
+    so that the changer plans from it rather than reading the pod's state again.
+    Each step is timed, and tags the pod's output.
+    Returns the changer's subprocess.CompletedProcess
+    """
+    deadline = time.monotonic() + args.timeout
+    changer_path = f"{POD_DIR}/changer.py"
+    command = f"echo '{args.changer_hash}  {changer_path}' | sha256sum -c - >/dev/null 2>&1" \
+        f" || exit {STALE_CHANGER}; python3 {changer_path}" + (" --full" if args.full else "") + \
+        (" --profile" if args.profile else "") + \
+        (" --live-state" if "live_state" in payload else "")
+    push_changer = payload["push_changer"]
+    profiler = args.profiler
+    try:
+        with profiler.span(pod, "configure"):
+            with step(args, pod, "connect"):
+                transport.ensure_master(host, max(deadline - time.monotonic(), 0))
+            for _ in range(2):
+                if push_changer:
+                    with step(args, pod, "push changer"):
+                        proc = transport.push_file(host, "changer.py", changer_path,
+                                                   max(deadline - time.monotonic(), 0))
+                    if proc.returncode:
+                        return proc
+                with step(args, pod, "run changer"):
+                    proc = transport.run(host, command, changer_input(payload).encode("utf8"),
+                                         max(deadline - time.monotonic(), 0))
+                if proc.returncode != STALE_CHANGER or push_changer:
+                    profiler.add_changer_output(pod, time.monotonic(), proc.stdout)
+                    return proc
+                push_changer = True
+            return proc
+    except subprocess.TimeoutExpired as error:
+        raise PodTimeout(f"timed out after {args.timeout}s") from error
+
+
+def configure_pods_ssh(index, payloads, args, transport=None):
+    """
+    Configure pods concurrently over multiplexed ssh connections,
+    at most args.workers at a time, allowing each args.timeout seconds.
+    Each pod's output is streamed to args.pod_log, and each pod is reported
+    as it finishes.
+    Returns the result of each pod, with the exit code of its changer,
+    or None if it timed out.
+    """
+    transport = transport or SSHTransport()
+    # output is tagged with the pod its worker thread is configuring, rather
+    # than by host, as pods can share one, ie. behind port forwards
+    configuring = threading.local()
+    transport.on_output = lambda host, stream, line: \
+        args.pod_log.line(configuring.pod, stream, line)
+
+    def configure_pod(pod, payload):
+        configuring.pod = pod
+        return configure_pod_ssh(transport, pod, index.pod_host(pod), payload, args)
+
+    args.pod_log.begin(payloads)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        futures = {
+            executor.submit(configure_pod, pod, payload): (pod, time.monotonic())
+            for pod, payload in payloads.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            pod, start = futures[future]
+            progress = f"[{len(results) + 1}/{len(futures)}] pod: {pod}, " \
+                f"host: {index.pod_host(pod)}"
+            try:
+                proc = future.result()
+            except PodTimeout as error:
+                results[pod] = {**error_result(str(error)), "exit_code": None}
+                args.pod_log.done(pod, False, f"{progress} {error}")
+                continue
+            results[pod] = proc_result(proc)
+            args.pod_log.done(pod, results[pod]["status"] == "ok",
+                              f"{progress} {describe_result(results[pod])} "
+                              f"({time.monotonic() - start:.1f}s)")
+    args.pod_log.end()
+    return results
+
+
+def configure_pod_expect(pod, host, args):
+    """
+    Run connect.expect for a single pod, streaming its output to args.pod_log.
+    Returns its exit code
+    """
+    with step(args, pod, "expect"):
+        return run_streaming(["./connect.expect", "configure", host, pod], b"", None,
+                             lambda stream, line: args.pod_log.line(pod, stream, line)).returncode
+
+
+def configure_pods_expect(index, generated, args):
+    """
+    Configure pods by shipping a tarball and running the changer
+    through connect.expect, one process per pod, all at once.
+    Output is streamed to args.pod_log
+    Returns the exit code of each pod's expect process
+    """
+    for pod, pod_config in generated.items():
+        with args.profiler.span(pod, "create tarball"):
+            create_tarball(pod, pod_config)
+    args.pod_log.begin(generated)
+    exit_codes = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(generated), 1)) as executor:
+        futures = {executor.submit(configure_pod_expect, pod, index.pod_host(pod), args): pod
+                   for pod in generated}
+        for future in concurrent.futures.as_completed(futures):
+            pod = futures[future]
+            exit_codes[pod] = future.result()
+            args.pod_log.done(pod, not exit_codes[pod],
+                              f"pod: {pod}, host: {index.pod_host(pod)} resulted in "
+                              f"{exit_codes[pod]} exit_code")
+    args.pod_log.end()
+    return exit_codes
+
+
+def apply_payloads(index, payloads, args):
+    """
+    Apply payloads to their pods with the selected transport.
+    Returns the result of each pod, whose status is "ok" when it was configured
+    successfully
+    """
+    if args.transport == "agent":
+        responses = configure_pods_agent(
+            index, {pod: payload["config"] for pod, payload in payloads.items()}, args,
+            {pod: payload["live_state"] for pod, payload in payloads.items()
+             if "live_state" in payload})
+        return {pod: agent_result(response) for pod, response in responses.items()}
+    if args.transport == "expect":
+        exit_codes = configure_pods_expect(
+            index, {pod: payload["config"] for pod, payload in payloads.items()}, args)
+        return {pod: {"status": "ok", "failed": []} if not exit_code else
+                error_result(f"resulted in {exit_code} exit_code")
+                for pod, exit_code in exit_codes.items()}
+    return configure_pods_ssh(index, payloads, args, pod_transport(index, args.transport))
@@ -0,0 +1,270 @@
+"""
+Snapshots of what's live on the pods, normalised into the generated config's
+schema, and the drift between that and what's intended.
+Snapshots are kept in .topology-sim/snapshots.json, so that a create soon
+after can plan from them rather than having every pod read its state again.
+"""
+
+import concurrent.futures
+import json
+import subprocess
+import time
+
+from pod_state import load_snapshots, save_snapshots
+from transport import POD_DIR, AgentPool, pod_transport
+
+# the sections of a generated config that the changer manages, and what each entry is
+SECTIONS = {"bridges": "bridge", "tunnels": "tunnel", "veth_pairs": "veth",
+            "namespaces": "namespace"}
+
+
+class SnapshotError(Exception):
+    """
+    Raised when a pod's live state can't be read
+    """
+
+
+def port_pvid(vids):
+    """
+    Returns the PVID of a bridge port, or None if it doesn't have one
+    """
+    for vid, flags in vids.items():
+        if "PVID" in flags:
+            return int(vid)
+    return None
+
+
+def live_bridges(state, conf):
+    """
+    The bridges of a live state, as they'd be in a generated config.
+    A bridge's vid is that of its vlan interface on the wan bridge, and its
+    physical members are the wan bridge ports whose PVID is that vid.
+    The wan bridge is only listed when segments use it, or conf says it should be
+    """
+    wan = conf["wan_bridge"]["name"]
+    unmanaged = set(conf["wan_bridge"]["members"]) | set(conf["trunk_ports"])
+    virtual = set(state["tunnels"]) | set(state["veths"]) | set(state["vlans"])
+    wan_ports = [port for port in sorted(state["members"].get(wan, [])) if port not in unmanaged]
+    bridges = {}
+    for bridge in sorted(state["bridges"]):
+        if bridge == wan:
+            vid = 1
+            virtual_members = [port for port in wan_ports if port in virtual]
+        else:
+            members = state["members"].get(bridge, [])
+            vlans = [member for member in members if member in state["vlans"]
+                     and state["vlans"][member][0] == wan]
+            vid = state["vlans"][vlans[0]][1] if vlans else None
+            virtual_members = sorted(set(members) - set(vlans))
+        physical_members = [port for port in wan_ports if port not in virtual and vid
+                            and port_pvid(state["port_vids"].get(port, {})) == vid]
+        if bridge == wan and not physical_members + virtual_members \
+                and wan not in conf["bridges"]:
+            continue
+        bridges[bridge] = {"vid": vid, "physical_members": physical_members,
+                           "virtual_members": virtual_members}
+    return bridges
+
+
+def live_veth_pairs(state, conf):
+    """
+    The veth pairs of a live state, named from the same end as in conf
+    where it has the pair
+    """
+    pairs = {}
+    for veth, peer in sorted(state["veths"].items()):
+        if conf["veth_pairs"].get(peer) == veth or pairs.get(peer) == veth:
+            continue
+        pairs[veth] = peer
+    return pairs
+
+
+def live_config(state, conf):
+    """
+    Normalise a pod's live state, as serialized by the changer, into the
+    generated config's schema. conf, the pod's intended config, supplies
+    the wan bridge and trunk ports, which aren't managed
+    """
+    return {
+        "bridges": live_bridges(state, conf),
+        "tunnels": {
+            tunnel: {"type": "gretap", "key": key, "local": local, "remote": remote,
+                     "isolated": tunnel in state["isolated"]}
+            for tunnel, (local, remote, key) in sorted(state["tunnels"].items())
+        },
+        "veth_pairs": live_veth_pairs(state, conf),
+        "namespaces": dict(state["namespaces"]),
+        "wan_bridge": conf["wan_bridge"],
+        "trunk_ports": conf["trunk_ports"],
+    }
+
+
+def canonical_config(conf):
+    """
+    A generated config with its lists sorted, and its tunnels' optional
+    fields filled in, so that it can be compared with a live one
+    """
+    return {
+        **conf,
+        "bridges": {
+            bridge: {**bridge_info,
+                     "physical_members": sorted(bridge_info["physical_members"]),
+                     "virtual_members": sorted(bridge_info["virtual_members"])}
+            for bridge, bridge_info in conf["bridges"].items()
+        },
+        "tunnels": {
+            tunnel: {**tunnel_info, "key": int(tunnel_info["key"]),
+                     "isolated": bool(tunnel_info.get("isolated"))}
+            for tunnel, tunnel_info in conf["tunnels"].items()
+        },
+    }
+
+
+def diff_config(intended, live):
+    """
+    Returns the drift of live from intended, an entry per bridge, tunnel,
+    veth or namespace that is missing, unexpected or differs
+    """
+    intended = canonical_config(intended)
+    drift = []
+    for section, kind in SECTIONS.items():
+        for name in sorted(set(intended[section]) | set(live[section])):
+            if name not in live[section]:
+                change = "missing"
+            elif name not in intended[section]:
+                change = "unexpected"
+            elif intended[section][name] != live[section][name]:
+                change = "differs"
+            else:
+                continue
+            drift.append({"kind": kind, "name": name, "drift": change,
+                          "intended": intended[section].get(name),
+                          "live": live[section].get(name)})
+    return drift
+
+
+def describe_drift(entry):
+    """
+    A line describing a single entry of drift
+    """
+    line = f"{entry['kind']} {entry['name']}"
+    if entry["drift"] != "differs":
+        return f"{line}: {entry['drift']}"
+    intended, live = entry["intended"], entry["live"]
+    if live is None:
+        return f"{line}: contents unknown"
+    if isinstance(intended, dict) and isinstance(live, dict):
+        return f"{line}: " + ", ".join(
+            f"{field} intended {intended.get(field)}, live {live.get(field)}"
+            for field in sorted(set(intended) | set(live))
+            if intended.get(field) != live.get(field))
+    return f"{line}: intended {intended}, live {live}"
+
+
+def fetch_state(transport, host, pod_config, timeout):
+    """
+    Snapshot a pod's live state with its changer, pushing the changer
+    first if the pod's copy differs
+    """
+    try:
+        proc = transport.push_if_changed(host, "changer.py", f"{POD_DIR}/changer.py", timeout)
+        if not proc.returncode:
+            proc = transport.run(host, f"python3 {POD_DIR}/changer.py --state",
+                                 json.dumps(pod_config).encode("utf8"), timeout)
+    except subprocess.TimeoutExpired as error:
+        raise SnapshotError(f"timed out after {timeout}s") from error
+    for line in proc.stdout.decode("utf8", "replace").splitlines():
+        if line.startswith("state: "):
+            return json.loads(line[len("state: "):])
+    stderr = proc.stderr.decode("utf8", "replace").strip().splitlines()
+    raise SnapshotError(stderr[-1] if stderr else f"resulted in {proc.returncode} exit_code")
+
+
+def fetch_states(index, generated, args):
+    """
+    Snapshot the live state of every pod in generated at once.
+    Returns {pod: {"state"}}, or {pod: {"error"}} for pods that couldn't be read
+    """
+    if args.transport == "agent":
+        pool = AgentPool(index, args.agent_token, args.timeout, args.workers)
+        try:
+            responses = pool.request_all({pod: {"op": "state", "config": pod_config}
+                                          for pod, pod_config in generated.items()})
+        finally:
+            pool.close()
+        return {pod: {"state": response["state"]} if response["status"] == "ok" else
+                {"error": response["error"]} for pod, response in responses.items()}
+
+    transport = pod_transport(index, args.transport)
+
+    def snapshot(pod):
+        try:
+            return {"state": fetch_state(transport, index.pod_host(pod), generated[pod],
+                                         args.timeout)}
+        except SnapshotError as error:
+            return {"error": str(error)}
+
+    pods = sorted(generated)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        return dict(zip(pods, executor.map(snapshot, pods)))
+
+
+def check(index, generated, args):
+    """
+    Snapshot every pod, record the snapshots, and compare each with the
+    pod's generated config.
+    Returns a report per pod, whose status is "in_sync", "drift" or "error"
+    """
+    states = fetch_states(index, generated, args)
+    snapshots = load_snapshots()
+    now = time.time()
+    report = []
+    for pod, fetched in sorted(states.items()):
+        result = {"pod": pod, "host": index.pod_host(pod)}
+        if "error" in fetched:
+            snapshots.pop(pod, None)
+            report.append({**result, "status": "error", "error": fetched["error"]})
+            continue
+        snapshots[pod] = {"time": now, "state": fetched["state"]}
+        drift = diff_config(generated[pod], live_config(fetched["state"], generated[pod]))
+        report.append({**result, "status": "drift" if drift else "in_sync", "drift": drift})
+    save_snapshots(snapshots)
+    return report
+
+
+def format_report(report):
+    """
+    Returns a line per pod, followed by a line per entry of its drift
+    """
+    lines = []
+    for result in report:
+        prefix = f"pod: {result['pod']}, host: {result['host']}"
+        if result["status"] == "error":
+            lines.append(f"{prefix} unreadable: {result['error']}")
+        elif not result["drift"]:
+            lines.append(f"{prefix} in sync")
+        else:
+            lines.append(f"{prefix} {len(result['drift'])} differences")
+            lines += [f"    {describe_drift(entry)}" for entry in result["drift"]]
+    return "\n".join(lines)
+
+
+def attach_snapshots(payloads, max_age, now=None):
+    """
+    Have each payload planned from its pod's snapshot, when the snapshot
+    was taken within max_age seconds
+    """
+    now = time.time() if now is None else now
+    for pod, snapshot in load_snapshots().items():
+        if pod in payloads and now - snapshot["time"] <= max_age:
+            payloads[pod]["live_state"] = snapshot["state"]
+
+
+def forget_snapshots(pods):
+    """
+    Drop the snapshots of pods that were applied, as they no longer hold
+    """
+    snapshots = load_snapshots()
+    if any(pod in snapshots for pod in pods):
+        save_snapshots({pod: snapshot for pod, snapshot in snapshots.items()
+                        if pod not in pods})
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+Emulates the pods of a hardware config as network namespaces on this host,
+so that fabrics of many pods can be built and benchmarked without hardware.
+
+Each pod gets:
+- a network namespace, tsim-<pod>, holding its wan bridge and its ports
+- a persistent mount namespace with private /run/netns and /tmp, so that
+  each pod's client namespaces and changer state are its own, as on hardware
+Each pod port is a veth pair, whose other end is in the tsim-fabric namespace.
+There, one trunk port of each pod (wan, if it's a trunk port) joins its site's
+bridge, acting as the site's switch. Only one is joined, as the pod's wan bridge
+would otherwise make a loop. mesh0 ports share a bridge, acting as the mesh
+between sites.
+DUT facing ports are left unattached, as the ends that traffic is run between.
+
+Pods are configured by running changer.py inside these namespaces, unchanged,
+with `topology-sim create --transport netns`, or `transport: netns` in hardware.yaml.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+import yaml
+
+RUN_DIR = "/run/topology-sim"
+FABRIC = "tsim-fabric"
+MESH_BRIDGE = "mesh"
+MESH_PORT = "mesh0"
+IP = "ip"
+
+
+class EmulatorError(Exception):
+    """Raised when the emulated fabric can't be built"""
+
+
+def pod_netns(pod):
+    """Name of an emulated pod's network namespace"""
+    return f"tsim-{pod}"
+
+
+def pod_mount_ns(pod, run_dir=RUN_DIR):
+    """Path that an emulated pod's mount namespace is bound to"""
+    return os.path.join(run_dir, f"{pod}.mnt")
+
+
+def pod_command(pod, command, run_dir=RUN_DIR):
+    """
+    Returns the command line that runs a shell command inside an emulated pod
+    """
+    return ["nsenter", f"--mount={pod_mount_ns(pod, run_dir)}",
+            f"--net=/run/netns/{pod_netns(pod)}", "sh", "-c", command]
+
+
+def pod_ports(pod_info):
+    """
+    The netdevs that a pod has: its wan bridge members, trunk ports and DUT facing ports
+    """
+    return sorted(set(pod_info["wan_bridge"]["members"]) | set(pod_info["trunk_ports"]) |
+                  set(pod_info.get("ethernet", {})))
+
+
+def uplink_port(pod_info):
+    """
+    The trunk port that connects a pod to its site's switch, if it has one
+    """
+    trunk_ports = pod_info["trunk_ports"]
+    if "wan" in trunk_ports:
+        return "wan"
+    return trunk_ports[0] if trunk_ports else None
+
+
+def fabric_port(pod_num, port_num):
+    """
+    Name of the fabric end of a pod's port_num'th port, within the 15 character
+    limit. Ports are numbered rather than named, as a pod's port names can take
+    up the whole limit themselves, and truncating them can collide
+    """
+    return f"p{pod_num}-{port_num}"
+
+
+def run_command(command, stdin=None):
+    """
+    Run a command, raising EmulatorError if it fails
+    """
+    proc = subprocess.run(command, input=stdin, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=False)
+    if proc.returncode:
+        raise EmulatorError(f"{' '.join(command)}: {proc.stderr.decode('utf8').strip()}")
+    return proc.stdout.decode("utf8")
+
+
+def batch(commands):
+    """
+    Returns ip -batch input for commands
+    """
+    return "".join(" ".join(command) + "\n" for command in commands).encode("utf8")
+
+
+class Emulator:
+    """
+    Builds and tears down the emulated pods of a hardware config
+    """
+    def __init__(self, hardware, run_dir=RUN_DIR, runner=None):
+        self.hardware = hardware
+        self.run_dir = run_dir
+        self.run = runner or run_command
+        # pod -> (number, site, pod config)
+        self.pods = {}
+        for site, site_config in sorted(hardware["sites"].items()):
+            for pod, pod_info in sorted(site_config["pods"].items()):
+                self.pods[pod] = (len(self.pods), site, pod_info)
+        self.sites = sorted(hardware["sites"])
+
+    def site_bridge(self, site):
+        """Name of the fabric bridge that a site's trunk ports share"""
+        return f"site{self.sites.index(site)}"
+
+    def prepare_run_dir(self):
+        """
+        Mount namespaces can only be bound to files on a private mount
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        if not os.path.ismount(self.run_dir):
+            self.run(["mount", "--bind", self.run_dir, self.run_dir])
+        self.run(["mount", "--make-private", self.run_dir])
+
+    def create_mount_ns(self, pod):
+        """
+        Create a pod's persistent mount namespace, with private /run/netns and /tmp
+        """
+        path = pod_mount_ns(pod, self.run_dir)
+        with open(path, "w", encoding="utf8"):
+            pass
+        self.run(["unshare", f"--mount={path}", "--propagation", "private", "sh", "-c",
+                  "mkdir -p /run/netns && mount -t tmpfs tmpfs /run/netns && "
+                  "mount -t tmpfs tmpfs /tmp"])
+
+    def fabric_commands(self):
+        """
+        Commands, run in the fabric namespace, that create the site and mesh bridges
+        and attach the fabric ends of the pod ports
+        """
+        commands = []
+        for bridge in [MESH_BRIDGE] + [self.site_bridge(site) for site in self.sites]:
+            commands += [["link", "add", "name", bridge, "type", "bridge"],
+                         ["link", "set", "dev", bridge, "up"]]
+        for pod_num, site, pod_info in self.pods.values():
+            for port_num, port in enumerate(pod_ports(pod_info)):
+                fabric_end = fabric_port(pod_num, port_num)
+                if port == MESH_PORT:
+                    commands.append(["link", "set", "dev", fabric_end, "master", MESH_BRIDGE])
+                elif port == uplink_port(pod_info):
+                    commands.append(["link", "set", "dev", fabric_end,
+                                     "master", self.site_bridge(site)])
+                commands.append(["link", "set", "dev", fabric_end, "up"])
+        return commands
+
+    @staticmethod
+    def pod_commands(pod_info):
+        """
+        Commands, run in a pod's namespace, that build its wan bridge, the way
+        the pod's own network config would, and give it the pod's address
+        """
+        wan = pod_info["wan_bridge"]["name"]
+        commands = [["link", "set", "dev", "lo", "up"],
+                    ["link", "add", "name", wan, "type", "bridge", "vlan_filtering", "1"]]
+        for member in pod_info["wan_bridge"]["members"]:
+            commands.append(["link", "set", "dev", member, "master", wan])
+        for port in pod_ports(pod_info):
+            commands.append(["link", "set", "dev", port, "up"])
+        # every other pod is reached through the wan bridge
+        commands += [["link", "set", "dev", wan, "up"],
+                     ["address", "add", f"{pod_info['host']}/32", "dev", wan],
+                     ["route", "add", "default", "dev", wan]]
+        return commands
+
+    def up(self):
+        """
+        Build the emulated fabric
+        """
+        self.prepare_run_dir()
+        namespaces = [FABRIC] + [pod_netns(pod) for pod in self.pods]
+        self.run([IP, "-batch", "-"], batch([["netns", "add", ns] for ns in namespaces]))
+        veths = []
+        for pod, (pod_num, _, pod_info) in self.pods.items():
+            self.create_mount_ns(pod)
+            for port_num, port in enumerate(pod_ports(pod_info)):
+                veths.append(["link", "add", port, "netns", pod_netns(pod), "type", "veth",
+                              "peer", "name", fabric_port(pod_num, port_num), "netns", FABRIC])
+        self.run([IP, "-batch", "-"], batch(veths))
+        for pod, (_, _, pod_info) in self.pods.items():
+            self.run([IP, "-n", pod_netns(pod), "-batch", "-"],
+                     batch(self.pod_commands(pod_info)))
+        self.run([IP, "-n", FABRIC, "-batch", "-"], batch(self.fabric_commands()))
+
+    def down(self):
+        """
+        Tear down the emulated fabric. Deleting a pod's network namespace
+        deletes its ports, and unmounting its mount namespace deletes
+        its client namespaces
+        """
+        for pod in self.pods:
+            path = pod_mount_ns(pod, self.run_dir)
+            if os.path.exists(path):
+                self.run(["umount", "--lazy", path])
+                os.remove(path)
+        existing = set(os.listdir("/run/netns")) if os.path.isdir("/run/netns") else set()
+        namespaces = [ns for ns in [FABRIC] + [pod_netns(pod) for pod in self.pods]
+                      if ns in existing]
+        if namespaces:
+            self.run([IP, "-batch", "-"], batch([["netns", "del", ns] for ns in namespaces]))
+
+
+def get_args():
+    """
+    Process command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["up", "down"],
+                        help="build or tear down the emulated pods")
+    parser.add_argument("--hardware", default="hardware.yaml", help="hardware config file")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Build or tear down the emulated pods of a hardware config
+    """
+    args = get_args()
+    with open(args.hardware, encoding="utf8") as file_handle:
+        emulator = Emulator(yaml.safe_load(file_handle))
+    try:
+        if args.command == "up":
+            emulator.up()
+        else:
+            emulator.down()
+    except EmulatorError as error:
+        print(error)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Concurrent fabric health checks.
+Every pod host, every pair of tunneling pods and every smart plug is probed
+at once, so that results come back within one timeout window however many
+of them are down:
+- pods: TCP connect to the port they're configured over, and ICMP from here
+- tunnels: ICMP from one tunneling pod to the other, run on the pod
+- plugs: TCP connect to the plug's control port, and ICMP from here
+"""
+
+import asyncio
+import math
+import os
+import re
+import signal
+import subprocess
+import time
+
+from power import PLUG_TYPES, format_table
+from transport import agent_address, pod_transport
+
+PING_INTERVAL = 0.2
+SSH_PORT = 22
+
+LOSS_RE = re.compile(r"([\d.]+)% packet loss")
+# iputils: rtt min/avg/max/mdev = ..., busybox: round-trip min/avg/max = ...
+RTT_RE = re.compile(r"min/avg/max\S* = [\d.]+/([\d.]+)/")
+
+
+class HealthOptions:  # pylint: disable=too-few-public-methods
+    """
+    How hosts are probed. concurrency caps the probes run at once, which are
+    otherwise all run at once, so that they finish within one timeout
+    """
+    def __init__(self, concurrency=None, timeout=2.0, count=3):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.count = count
+
+
+def ping_command(host, options):
+    """
+    Returns the ping command line that probes host, finishing within the timeout
+    """
+    return ["ping", "-n", "-q", "-c", str(options.count), "-i", str(PING_INTERVAL),
+            "-w", str(max(math.floor(options.timeout), 1)), host]
+
+
+def parse_ping(output):
+    """
+    Returns the (loss %, average rtt ms) reported by ping, where either can be None
+    """
+    loss = LOSS_RE.search(output)
+    rtt = RTT_RE.search(output)
+    return (float(loss.group(1)) if loss else None, float(rtt.group(1)) if rtt else None)
+
+
+def pod_targets(hardware, port):
+    """
+    A probe per pod host. port(pod_info) is the TCP port the pod is configured over,
+    or None if it isn't reached over TCP
+    """
+    return [{"kind": "pod", "name": pod, "host": pod_info["host"], "port": port(pod_info),
+             "remote": None}
+            for _, site_config in sorted(hardware["sites"].items())
+            for pod, pod_info in sorted(site_config["pods"].items())]
+
+
+def tunnel_targets(hardware):
+    """
+    A probe per pair of tunneling pods, pinged from the first to the second
+    """
+    hosts = []
+    for _, site_config in sorted(hardware["sites"].items()):
+        pod = site_config["tunneling_pod"]
+        hosts.append((pod, site_config["pods"][pod]["host"]))
+    return [{"kind": "tunnel", "name": f"{pod1} -> {pod2}", "host": host2, "port": None,
+             "remote": host1}
+            for index, (pod1, host1) in enumerate(hosts) for pod2, host2 in hosts[index + 1:]]
+
+
+def plug_targets(hardware):
+    """
+    A probe per smart plug
+    """
+    targets = []
+    for dut, plug in sorted(hardware.get("power", {}).items()):
+        default_port = PLUG_TYPES[plug["type"]][2] if plug.get("type") in PLUG_TYPES else None
+        targets.append({"kind": "plug", "name": dut, "host": plug["host"],
+                        "port": plug.get("port", default_port), "remote": None})
+    return targets
+
+
+async def tcp_probe(host, port, timeout):
+    """
+    Returns the ms taken to connect to host:port
+    """
+    start = time.monotonic()
+    _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    rtt = (time.monotonic() - start) * 1000
+    writer.close()
+    return rtt
+
+
+async def icmp_probe(command, timeout):
+    """
+    Run a ping command, returning its (loss %, average rtt ms)
+    """
+    # in its own session, so that anything it spawned is killed along with it
+    proc = await asyncio.create_subprocess_exec(
+        *command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        start_new_session=True)
+    try:
+        output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        os.killpg(proc.pid, signal.SIGKILL)
+        await proc.wait()
+        raise
+    loss, rtt = parse_ping(output.decode("utf8", "replace"))
+    if loss is None:
+        lines = output.decode("utf8", "replace").strip().splitlines()
+        raise OSError(lines[-1] if lines else f"ping resulted in {proc.returncode} exit_code")
+    return loss, rtt
+
+
+def describe(error, timeout):
+    """
+    Short description of a failed probe
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return f"timed out after {timeout}s"
+    return str(error) or repr(error)
+
+
+async def probe(target, semaphore, options, remote_command):
+    """
+    Probe a single target, over TCP if it has a port and always over ICMP.
+    Returns a result dict for the summary
+    """
+    result = {**target, "tcp_ms": None, "loss": None, "rtt_ms": None, "ok": False,
+              "error": None}
+    command = ping_command(target["host"], options)
+    if target["remote"]:
+        command = remote_command(target["remote"], " ".join(command))
+    # ping finishes within the whole seconds of its deadline, and a remote one
+    # needs time to connect
+    timeout = options.timeout + (1 if target["remote"] else 0.5)
+    async with semaphore:
+        tcp, icmp = await asyncio.gather(
+            tcp_probe(target["host"], target["port"], options.timeout)
+            if target["port"] else asyncio.sleep(0),
+            icmp_probe(command, timeout), return_exceptions=True)
+    errors = []
+    if isinstance(tcp, BaseException):
+        errors.append(f"tcp: {describe(tcp, options.timeout)}")
+    elif target["port"]:
+        result["tcp_ms"] = round(tcp, 2)
+    if isinstance(icmp, BaseException):
+        errors.append(f"icmp: {describe(icmp, timeout)}")
+    else:
+        result["loss"], result["rtt_ms"] = icmp
+    result["ok"] = result["tcp_ms"] is not None if target["port"] else \
+        result["loss"] is not None and result["loss"] < 100
+    result["error"] = "; ".join(errors) or None
+    return result
+
+
+async def check_all(targets, remote_command, options=None):
+    """
+    Probe every target concurrently.
+    remote_command(host, command) returns the command line that runs command on host.
+    Returns a result per target, in the order of targets
+    """
+    options = options or HealthOptions()
+    semaphore = asyncio.Semaphore(max(options.concurrency or len(targets), 1))
+    return await asyncio.gather(*[probe(target, semaphore, options, remote_command)
+                                  for target in targets])
+
+
+def check(targets, remote_command, options=None):
+    """
+    Synchronous wrapper around check_all
+    """
+    return asyncio.run(check_all(targets, remote_command, options))
+
+
+def pod_port(transport):
+    """
+    Returns a function that gives the TCP port a pod is configured over
+    with transport, or None when it isn't configured over TCP
+    """
+    def port(pod_info):
+        if transport == "netns":
+            return None
+        if transport == "agent":
+            kind, _, address = agent_address(pod_info).partition(":")
+            return int(address.rpartition(":")[2]) if kind == "tcp" else None
+        return SSH_PORT
+    return port
+
+
+def check_fabric(index, transport, options=None, kinds=("pod", "tunnel", "plug")):
+    """
+    Probe the pods, tunneling pod pairs and smart plugs of a HardwareIndex's hardware,
+    where pods are configured over transport
+    """
+    targets = []
+    if "pod" in kinds:
+        targets += pod_targets(index.hardware, pod_port(transport))
+    if "tunnel" in kinds:
+        targets += tunnel_targets(index.hardware)
+    if "plug" in kinds:
+        targets += plug_targets(index.hardware)
+    return check(targets, pod_transport(index, transport).command, options)
+
+
+def format_results(results):
+    """
+    Returns a summary table of health results
+    """
+    return format_table(["kind", "name", "host", "port", "ok", "tcp_ms", "loss", "rtt_ms",
+                         "error"], results)
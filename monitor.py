@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+"""
+Monitors the quality of the GRE tunnels that carry bridges between sites.
+On tunneling pods, `monitor.py sample` prints a JSON line per interval, with
+the counters of each gretap interface, the bridge it's a member of, and the
+RTT to its remote endpoint.
+On the controller, `topology-sim monitor` streams samples from every tunneling
+pod into a ring buffer per tunnel, and exposes per tunnel and per bridge
+throughput and loss as Prometheus metrics over HTTP, and as a JSONL stream.
+Only the standard library is used, as this is run on pods. It's told where
+the changer records the config it applied, so it's deployed on its own.
+"""
+
+import argparse
+import array
+import http.server
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+SYS_CLASS_NET = "/sys/class/net"
+COUNTERS = ("rx_bytes", "tx_bytes", "rx_packets", "tx_packets",
+            "rx_dropped", "tx_dropped", "rx_errors", "tx_errors")
+# the columns of each ring buffer entry
+FIELDS = ("time",) + COUNTERS + ("rtt_ms", "lost")
+RTT_RE = re.compile(r"min/avg/max\S* = [\d.]+/([\d.]+)/")
+
+
+def applied_tunnels(conf):
+    """
+    Returns gretap -> (bridge, remote) of an applied pod config
+    """
+    bridges = {}
+    for bridge, bridge_info in conf.get("bridges", {}).items():
+        for member in bridge_info.get("virtual_members", []):
+            bridges[member] = bridge
+    return {tunnel: (bridges.get(tunnel), tunnel_info["remote"])
+            for tunnel, tunnel_info in conf.get("tunnels", {}).items()}
+
+
+def read_counters(netdev):
+    """
+    Returns a netdev's counters, or None if it doesn't exist
+    """
+    counters = {}
+    for counter in COUNTERS:
+        try:
+            with open(os.path.join(SYS_CLASS_NET, netdev, "statistics", counter),
+                      encoding="utf8") as file_handle:
+                counters[counter] = int(file_handle.read())
+        except (OSError, ValueError):
+            return None
+    return counters
+
+
+def ping_all(remotes, timeout=1):
+    """
+    Ping each remote once, concurrently.
+    Returns remote -> rtt in ms, or None if there was no reply
+    """
+    procs = {remote: subprocess.Popen(  # pylint: disable=consider-using-with
+        ["ping", "-n", "-q", "-c", "1", "-W", str(timeout), remote],
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for remote in remotes}
+    rtts = {}
+    for remote, proc in procs.items():
+        output = proc.communicate()[0].decode("utf8", "replace")
+        match = RTT_RE.search(output)
+        rtts[remote] = float(match.group(1)) if match else None
+    return rtts
+
+
+def sample(applied_config):
+    """
+    Returns the current counters and RTT of each of this pod's tunnels,
+    which are read from the config the changer applied, at applied_config
+    """
+    try:
+        with open(applied_config, encoding="utf8") as file_handle:
+            tunnels = applied_tunnels(json.load(file_handle))
+    except (FileNotFoundError, ValueError):
+        tunnels = {}
+    now = time.time()
+    rtts = ping_all(sorted({remote for _, remote in tunnels.values()}))
+    ret = {}
+    for tunnel, (bridge, remote) in sorted(tunnels.items()):
+        counters = read_counters(tunnel)
+        if counters is not None:
+            ret[tunnel] = {"bridge": bridge, "remote": remote, "rtt_ms": rtts[remote],
+                           **counters}
+    return {"time": now, "tunnels": ret}
+
+
+def sample_forever(interval, applied_config, count=None):
+    """
+    Print a sample as a JSON line every interval seconds
+    """
+    taken = 0
+    while count is None or taken < count:
+        start = time.monotonic()
+        print(json.dumps(sample(applied_config)), flush=True)
+        taken += 1
+        if count is None or taken < count:
+            time.sleep(max(interval - (time.monotonic() - start), 0))
+
+
+class RingBuffer:
+    """
+    The last capacity entries of width floats, kept in a single flat array
+    """
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.values = array.array("d", [math.nan]) * (capacity * width)
+        self.next = 0
+        self.count = 0
+
+    def append(self, entry):
+        """
+        Add an entry, overwriting the oldest once full
+        """
+        start = self.next * self.width
+        self.values[start:start + self.width] = array.array("d", entry)
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def entries(self):
+        """
+        Returns the entries, oldest first
+        """
+        first = (self.next - self.count) % self.capacity
+        return [tuple(self.values[index * self.width:(index + 1) * self.width])
+                for index in ((first + offset) % self.capacity for offset in range(self.count))]
+
+
+def increase(entries, column):
+    """
+    How much a counter increased over entries, allowing for it being reset
+    when its tunnel was recreated
+    """
+    total = 0
+    for previous, current in zip(entries, entries[1:]):
+        delta = current[column] - previous[column]
+        total += delta if delta >= 0 else current[column]
+    return total
+
+
+def tunnel_stats(entries, window):
+    """
+    Throughput, drops and loss of a tunnel over the entries in the last window seconds
+    """
+    entries = [entry for entry in entries if entry[0] >= entries[-1][0] - window]
+    seconds = entries[-1][0] - entries[0][0]
+    column = {field: index for index, field in enumerate(FIELDS)}
+    rtts = [entry[column["rtt_ms"]] for entry in entries
+            if not math.isnan(entry[column["rtt_ms"]])]
+    return {
+        "rx_bps": increase(entries, column["rx_bytes"]) * 8 / seconds if seconds else 0,
+        "tx_bps": increase(entries, column["tx_bytes"]) * 8 / seconds if seconds else 0,
+        "dropped": sum(increase(entries, column[counter])
+                       for counter in ("rx_dropped", "tx_dropped")),
+        "errors": sum(increase(entries, column[counter])
+                      for counter in ("rx_errors", "tx_errors")),
+        "loss": sum(entry[column["lost"]] for entry in entries) / len(entries),
+        "rtt_ms": sum(rtts) / len(rtts) if rtts else None,
+    }
+
+
+class Monitor:
+    """
+    Samples from tunneling pods, kept in a ring buffer per tunnel
+    """
+    def __init__(self, capacity=360, window=60):
+        self.capacity = capacity
+        self.window = window
+        # (pod, tunnel) -> RingBuffer
+        self.buffers = {}
+        # (pod, tunnel) -> (bridge, remote)
+        self.labels = {}
+        self.lock = threading.Lock()
+
+    def add_sample(self, pod, pod_sample):
+        """
+        Record a sample printed by a pod's `monitor.py sample`
+        """
+        with self.lock:
+            for tunnel, info in pod_sample["tunnels"].items():
+                key = (pod, tunnel)
+                if key not in self.buffers:
+                    self.buffers[key] = RingBuffer(self.capacity, len(FIELDS))
+                self.labels[key] = (info["bridge"], info["remote"])
+                rtt = info["rtt_ms"]
+                self.buffers[key].append(
+                    [pod_sample["time"]] + [info[counter] for counter in COUNTERS] +
+                    [math.nan if rtt is None else rtt, 1 if rtt is None else 0])
+
+    def tunnels(self):
+        """
+        Returns the stats of each tunnel, keyed by (pod, tunnel)
+        """
+        with self.lock:
+            return {key: {"bridge": self.labels[key][0], "remote": self.labels[key][1],
+                          "counters": dict(zip(FIELDS, buffer.entries()[-1])),
+                          **tunnel_stats(buffer.entries(), self.window)}
+                    for key, buffer in self.buffers.items()}
+
+    def bridges(self):
+        """
+        Returns the stats of each bridge: the throughput of its tunnels, each
+        counted at the end that sent it, their drops, and their average loss
+        """
+        ret = {}
+        for stats in self.tunnels().values():
+            bridge = ret.setdefault(stats["bridge"], {"tunnels": 0, "bps": 0, "dropped": 0,
+                                                      "loss": 0})
+            bridge["tunnels"] += 1
+            bridge["bps"] += stats["tx_bps"]
+            bridge["dropped"] += stats["dropped"]
+            bridge["loss"] += stats["loss"]
+        for bridge in ret.values():
+            bridge["loss"] /= bridge["tunnels"]
+        return ret
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        tunnels = sorted(self.tunnels().items())
+        for name, kind, value, text in TUNNEL_METRICS:
+            lines += [f"# HELP topology_sim_tunnel_{name} {text}",
+                      f"# TYPE topology_sim_tunnel_{name} {kind}"]
+            for (pod, tunnel), stats in tunnels:
+                if value(stats) is not None:
+                    lines.append(f'topology_sim_tunnel_{name}{{pod="{pod}",tunnel="{tunnel}",'
+                                 f'bridge="{stats["bridge"]}",remote="{stats["remote"]}"}} '
+                                 f'{value(stats):g}')
+        bridges = sorted(self.bridges().items())
+        for name, key, text in BRIDGE_METRICS:
+            lines += [f"# HELP topology_sim_bridge_{name} {text}",
+                      f"# TYPE topology_sim_bridge_{name} gauge"]
+            lines += [f'topology_sim_bridge_{name}{{bridge="{bridge}"}} {stats[key]:g}'
+                      for bridge, stats in bridges]
+        return "\n".join(lines) + "\n"
+
+
+# name, type, value from a tunnel's stats, help
+TUNNEL_METRICS = [
+    ("rx_bytes_total", "counter", lambda stats: stats["counters"]["rx_bytes"],
+     "Bytes received by the tunnel"),
+    ("tx_bytes_total", "counter", lambda stats: stats["counters"]["tx_bytes"],
+     "Bytes sent by the tunnel"),
+    ("dropped_total", "counter",
+     lambda stats: stats["counters"]["rx_dropped"] + stats["counters"]["tx_dropped"],
+     "Packets dropped by the tunnel"),
+    ("rx_bits_per_second", "gauge", lambda stats: stats["rx_bps"],
+     "Receive throughput over the window"),
+    ("tx_bits_per_second", "gauge", lambda stats: stats["tx_bps"],
+     "Send throughput over the window"),
+    ("ping_loss_ratio", "gauge", lambda stats: stats["loss"],
+     "Pings to the remote endpoint that went unanswered over the window"),
+    ("rtt_milliseconds", "gauge", lambda stats: stats["rtt_ms"],
+     "Average RTT to the remote endpoint over the window"),
+]
+
+# name, key of a bridge's stats, help
+BRIDGE_METRICS = [
+    ("bits_per_second", "bps", "Throughput of the bridge's tunnels over the window"),
+    ("dropped", "dropped", "Packets dropped by the bridge's tunnels over the window"),
+    ("loss_ratio", "loss", "Average ping loss of the bridge's tunnels over the window"),
+]
+
+
+class MonitorOptions:  # pylint: disable=too-few-public-methods
+    """
+    How samples are kept and exposed
+    """
+    def __init__(self, capacity=360, window=60, metrics_port=None, output=None,
+                 duration=None):
+        self.capacity = capacity
+        self.window = window
+        self.metrics_port = metrics_port
+        self.output = output
+        self.duration = duration
+
+
+def serve_metrics(monitor, port):
+    """
+    Serve the monitor's metrics at http://<host>:port/metrics, in a thread
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Answers scrapes"""
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Return the metrics"""
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = monitor.prometheus().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            """Scrapes aren't logged"""
+
+    server = http.server.ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stream(monitor, pod, proc, output, output_lock):
+    """
+    Record each sample a pod prints, copying it to output as a JSON line
+    """
+    for line in proc.stdout:
+        try:
+            pod_sample = json.loads(line)
+        except ValueError:
+            continue
+        monitor.add_sample(pod, pod_sample)
+        if output:
+            with output_lock:
+                output.write(json.dumps({"pod": pod, **pod_sample}) + "\n")
+                output.flush()
+
+
+def open_output(path):
+    """
+    Where samples are copied to: stdout for "-", a file, or nowhere
+    """
+    if path == "-":
+        return sys.stdout
+    if not path:
+        return None
+    return open(path, "a", encoding="utf8")  # pylint: disable=consider-using-with
+
+
+def run(commands, options):
+    """
+    Run each pod's sampler, where commands maps pod -> the command line that runs
+    `monitor.py sample` on it, until interrupted or options.duration has passed.
+    Returns the Monitor
+    """
+    monitor = Monitor(options.capacity, options.window)
+    server = serve_metrics(monitor, options.metrics_port) \
+        if options.metrics_port is not None else None
+    procs = {pod: subprocess.Popen(  # pylint: disable=consider-using-with
+        command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True)
+        for pod, command in commands.items()}
+    output = open_output(options.output)
+    output_lock = threading.Lock()
+    threads = [threading.Thread(target=stream, args=(monitor, pod, proc, output, output_lock),
+                                daemon=True) for pod, proc in procs.items()]
+    for thread in threads:
+        thread.start()
+    try:
+        deadline = None if options.duration is None else time.monotonic() + options.duration
+        while any(thread.is_alive() for thread in threads) and \
+                (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        if server:
+            server.shutdown()
+        if output and output is not sys.stdout:
+            output.close()
+    return monitor
+
+
+def get_args():
+    """
+    Process command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["sample"], help="print samples as JSON lines")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between samples")
+    parser.add_argument("--count", type=int, help="samples to take, rather than forever")
+    parser.add_argument("--applied-config", required=True,
+                        help="where the changer records the config it applied")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Sample this pod's tunnels
+    """
+    args = get_args()
+    try:
+        sample_forever(args.interval, args.applied_config, args.count)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+
+"""
+Long running agent, run on a pod, that applies configs sent by the controller.
+This avoids a scp, ssh login and tarball extraction per configuration.
+
+The protocol is newline delimited JSON over a TCP or unix socket.
+Each request is an object with an "op" key:
+- {"op": "ping"}
+- {"op": "apply", "config": {...}, "full": false, "dry_run": false, "state": {...},
+   "changer_hash": "..."}
+- {"op": "state", "config": {...}}
+An apply's optional "state" is a snapshot, previously returned by "state",
+that is planned from rather than reading the pod's state again, and its
+optional "changer_hash" is the sha256 of the changer.py that the controller
+has, which the apply is refused unless the agent runs. A ping's response
+has the agent's "changer_hash".
+Each request gets a single JSON object in response, with a "status" key
+of "ok", "failed" or "error", or "rolled_back" when an apply failed and the
+pod was returned to its previous config.
+"""
+
+import argparse
+import hashlib
+import hmac
+import ipaddress
+import json
+import socketserver
+import threading
+import time
+
+import changer
+
+DEFAULT_PORT = 7070
+# only reachable from the pod itself, unless started with --listen
+DEFAULT_LISTEN = f"tcp:127.0.0.1:{DEFAULT_PORT}"
+
+
+def changer_hash():
+    """
+    Returns the sha256 of the changer.py that the agent runs
+    """
+    with open(changer.__file__, "rb") as file_handle:
+        return hashlib.sha256(file_handle.read()).hexdigest()
+
+
+class AgentState:  # pylint: disable=too-few-public-methods
+    """
+    State shared by all connections to the agent
+    """
+    # only one configuration may be applied at a time
+    lock = threading.Lock()
+    token = None
+    dry_run = False
+    # the changer as it was loaded, even if changer.py was replaced since
+    changer_hash = changer_hash()
+
+
+def valid_token(token):
+    """
+    Whether a request's token is the agent's, compared in constant time
+    """
+    return isinstance(token, str) and \
+        hmac.compare_digest(token.encode("utf8"), AgentState.token.encode("utf8"))
+
+
+def handle_request(request):
+    """
+    Act on a single request, returning the response
+    """
+    if AgentState.token is not None and not valid_token(request.get("token")):
+        return {"status": "error", "error": "invalid token"}
+
+    operation = request.get("op")
+    if operation == "ping":
+        return {"status": "ok", "time": time.time(), "changer_hash": AgentState.changer_hash}
+    if operation == "apply":
+        if request.get("changer_hash") not in (None, AgentState.changer_hash):
+            return {"status": "error",
+                    "error": f"stale agent: it runs changer.py {AgentState.changer_hash[:12]}, "
+                    f"not {request['changer_hash'][:12]}, restart it with the current one"}
+        with AgentState.lock:
+            return changer.apply_config(
+                request["config"], full=request.get("full", False),
+                dry_run=request.get("dry_run", False) or AgentState.dry_run,
+                final_state=True, live_state=request.get("state"))
+    if operation == "state":
+        with AgentState.lock:
+            state = changer.snapshot_state(request["config"])
+        return {"status": "ok", "state": changer.serialize_state(state)}
+    return {"status": "error", "error": f"unknown op: {operation}"}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serves requests from a single controller connection until it closes
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = handle_request(json.loads(line))
+            except (ValueError, KeyError, TypeError) as error:
+                response = {"status": "error", "error": repr(error)}
+            self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
+            self.wfile.flush()
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Threaded TCP agent server"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Threaded unix socket agent server"""
+    daemon_threads = True
+
+
+def make_server(listen):
+    """
+    Create a server for a listen address of the form
+    unix:<path>, tcp:<host>:<port> or tcp:<port>
+    """
+    kind, _, address = listen.partition(":")
+    if kind == "unix":
+        return UnixServer(address, RequestHandler)
+    if kind == "tcp":
+        host, _, port = address.rpartition(":")
+        return TCPServer((host or "0.0.0.0", int(port)), RequestHandler)
+    raise ValueError(f"unrecognized listen address: {listen}")
+
+
+def loopback_only(listen):
+    """
+    Whether a listen address is only reachable from the pod itself
+    """
+    kind, _, address = listen.partition(":")
+    if kind != "tcp":
+        return True
+    host = address.rpartition(":")[0]
+    try:
+        return bool(host) and ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def get_args(argv=None):
+    """
+    Process command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listen", default=DEFAULT_LISTEN,
+                        help="unix:<path>, tcp:<host>:<port> or tcp:<port>, "
+                        f"defaults to {DEFAULT_LISTEN}")
+    parser.add_argument("--token", help="shared secret that requests must carry, "
+                        "required unless the agent only listens on loopback or a unix socket")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="plan changes without making them, ie. as a local stand-in")
+    args = parser.parse_args(argv)
+    if args.token is None and not loopback_only(args.listen):
+        parser.error(f"--listen {args.listen} is reachable from other hosts, "
+                     "so the agent needs a --token")
+    return args
+
+
+def make_agent(args):
+    """
+    Returns the server of an agent started with args
+    """
+    AgentState.token = args.token
+    AgentState.dry_run = args.dry_run
+    return make_server(args.listen)
+
+
+def main():
+    """
+    Serve requests until interrupted
+    """
+    with make_agent(get_args()) as server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+The controller's record of what was last applied to each pod, of the IDs
+allocated to the generated configs, of the pods' last snapshots, and of
+the testers' reservations
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+
+# where the controller keeps its state, relative to the working directory
+STATE_DIR = ".topology-sim"
+POD_STATE = f"{STATE_DIR}/pods.json"
+ALLOCATIONS = f"{STATE_DIR}/allocations.json"
+SNAPSHOTS = f"{STATE_DIR}/snapshots.json"
+LEASES = f"{STATE_DIR}/leases.json"
+LOCK = f"{STATE_DIR}/lock"
+
+
+def file_hash(path):
+    """
+    Returns the sha256 of a file's contents
+    """
+    with open(path, "rb") as file_handle:
+        return hashlib.sha256(file_handle.read()).hexdigest()
+
+
+def payload_hash(pod_config, changer_hash):
+    """
+    Returns a hash that identifies what a pod is sent: its config and the
+    version of the changer that applies it
+    """
+    payload = json.dumps(pod_config, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{changer_hash}\n{payload}".encode("utf8")).hexdigest()
+
+
+def load_state(path):
+    """
+    Returns a JSON state file's contents, or {} if there isn't one
+    """
+    try:
+        with open(path, encoding="utf8") as file_handle:
+            return json.load(file_handle)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    """
+    Atomically replace a JSON state file
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as file_handle:
+        json.dump(state, file_handle, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def state_lock():
+    """
+    Hold an exclusive lock on the controller's state, so that runs which
+    load, change and save it take turns rather than losing each other's changes
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(LOCK, "a", encoding="utf8") as file_handle:
+        try:
+            fcntl.flock(file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("waiting for another run to finish with the controller's state")
+            fcntl.flock(file_handle, fcntl.LOCK_EX)
+        yield
+
+
+def load_pod_state():
+    """
+    Returns what was last applied to each pod, keyed by pod
+    """
+    return load_state(POD_STATE)
+
+
+def save_pod_state(pod_state):
+    """
+    Record what was last applied to each pod
+    """
+    save_state(POD_STATE, pod_state)
+
+
+def load_allocations():
+    """
+    Returns the IDs allocated by the last create
+    """
+    return load_state(ALLOCATIONS)
+
+
+def save_allocations(allocations):
+    """
+    Record the IDs allocated, so that the next create keeps them
+    """
+    save_state(ALLOCATIONS, allocations)
+
+
+def load_snapshots():
+    """
+    Returns the last snapshot of each pod's live state, keyed by pod
+    """
+    return load_state(SNAPSHOTS)
+
+
+def save_snapshots(snapshots):
+    """
+    Record the snapshots of the pods' live state
+    """
+    save_state(SNAPSHOTS, snapshots)
+
+
+def load_leases():
+    """
+    Returns each tenant's lease, keyed by tenant
+    """
+    return load_state(LEASES)
+
+
+def save_leases(leases):
+    """
+    Record the tenants' leases
+    """
+    save_state(LEASES, leases)
+
+
+def plan_payloads(generated, pod_state, changer_hash, force=False):
+    """
+    Decide which pods need their config applied, and which of those also
+    need changer.py pushed. Pods whose payload hash matches the one last
+    applied are left alone, unless forced.
+    Returns {pod: {"config", "hash", "push_changer"}} for the pods to apply
+    """
+    payloads = {}
+    for pod, pod_config in generated.items():
+        curr_hash = payload_hash(pod_config, changer_hash)
+        last = pod_state.get(pod, {})
+        if not force and last.get("payload_hash") == curr_hash:
+            continue
+        payloads[pod] = {
+            "config": pod_config,
+            "hash": curr_hash,
+            "push_changer": force or last.get("changer_hash") != changer_hash,
+        }
+    return payloads
@@ -0,0 +1,125 @@
+"""
+A single log of what every pod output while being configured, in place of a
+file per pod. Each line that a pod outputs, and each phase that it enters, is
+written to logs/pods.jsonl as it happens, as JSON tagged with the pod, its
+phase, the stream and the seconds since the log was opened, by the monotonic
+clock. The log is rotated once it reaches a size.
+On a terminal, a progress line showing how many pods are in each phase is
+kept at the bottom of the output.
+"""
+
+import json
+import logging
+import logging.handlers
+import sys
+import time
+
+POD_LOG = "logs/pods.jsonl"
+# seconds between redraws of the progress line
+REDRAW_INTERVAL = 0.1
+
+
+class PodLog:
+    """
+    Records pods' output and phases, and shows their progress
+    """
+    def __init__(self, path=POD_LOG, max_bytes=10 * 2**20, backups=5, live=None):
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                       backupCount=backups, encoding="utf8",
+                                                       delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        # a logger of its own, so that pod output isn't passed to the root logger's handlers
+        self.logger = logging.Logger("pods")
+        self.logger.addHandler(handler)
+        self.start = time.monotonic()
+        # pod -> the phase it's in, or whether it succeeded once it's finished
+        self.phases = {}
+        # where the progress line is drawn: stderr, when it's a terminal
+        if live is None:
+            live = sys.stderr if sys.stderr.isatty() else None
+        self.live = live
+        self.drawn = 0
+
+    def write(self, pod, stream, line):
+        """
+        Append a line to the log
+        """
+        self.logger.info(json.dumps({
+            "t": round(time.monotonic() - self.start, 6), "pod": pod,
+            "phase": self.phases.get(pod), "stream": stream, "line": line}))
+
+    def begin(self, pods):
+        """
+        Start showing the progress of configuring pods
+        """
+        self.phases = {pod: "waiting" for pod in pods}
+
+    def phase(self, pod, name):
+        """
+        Record that a pod entered a phase
+        """
+        self.phases[pod] = name
+        self.write(pod, "phase", name)
+        self.draw()
+
+    def line(self, pod, stream, line):
+        """
+        Record a line that a pod output
+        """
+        self.write(pod, stream, line)
+
+    def done(self, pod, ok, description):
+        """
+        Record that a pod finished, and print its description above the progress line
+        """
+        self.write(pod, "result", description)
+        self.phases[pod] = "done" if ok else "failed"
+        self.clear()
+        print(description, flush=bool(self.live))
+        self.draw(force=True)
+
+    def progress(self):
+        """
+        Returns a line summarizing how many pods are in each phase
+        """
+        counts = {}
+        for phase in self.phases.values():
+            counts[phase] = counts.get(phase, 0) + 1
+        finished = counts.pop("done", 0) + counts.get("failed", 0)
+        phases = ", ".join(f"{count} {phase}" for phase, count in sorted(counts.items()))
+        return f"{finished}/{len(self.phases)} pods finished: {phases} " \
+            f"({time.monotonic() - self.start:.1f}s)"
+
+    def draw(self, force=False):
+        """
+        Redraw the progress line, at most every REDRAW_INTERVAL seconds unless forced
+        """
+        if not self.live or not self.phases:
+            return
+        now = time.monotonic()
+        if force or now - self.drawn >= REDRAW_INTERVAL:
+            self.drawn = now
+            self.live.write(f"\r\033[K{self.progress()}")
+            self.live.flush()
+
+    def clear(self):
+        """
+        Remove the progress line
+        """
+        if self.live:
+            self.live.write("\r\033[K")
+            self.live.flush()
+
+    def end(self):
+        """
+        Stop showing progress
+        """
+        self.clear()
+        self.phases = {}
+
+    def close(self):
+        """
+        Close the log file
+        """
+        for handler in self.logger.handlers:
+            handler.close()
@@ -0,0 +1,240 @@
+"""
+Concurrent smart plug power control.
+Plugs are switched with a bounded number of requests in flight, each
+with its own timeout and retries, and plugs whose relay is already
+in the requested state are left alone.
+"""
+
+import asyncio
+import json
+import struct
+import time
+
+TASMOTA_PORT = 80
+TP_LINK_PORT = 9999
+
+
+class PowerError(Exception):
+    """Raised when a smart plug can't be queried or switched"""
+
+
+class TPLinkError(PowerError):
+    """Raised when configuration of a tp-link power plug fails"""
+
+
+class TasmotaError(PowerError):
+    """Raised when configuration of a tasmota power plug fails"""
+
+
+def tp_link_encrypt(request):
+    """
+    Encrypt a tp-link smart home protocol request, prefixed by its length
+    """
+    key = 171
+    ret = bytearray()
+    for byte in request:
+        key ^= byte
+        ret.append(key)
+    return struct.pack(">I", len(ret)) + bytes(ret)
+
+
+def tp_link_decrypt(response):
+    """
+    Decrypt a tp-link smart home protocol response, without its length prefix
+    """
+    key = 171
+    ret = bytearray()
+    for byte in response:
+        ret.append(key ^ byte)
+        key = byte
+    return bytes(ret)
+
+
+async def tp_link_request(host, request, port=TP_LINK_PORT):
+    """
+    Send a request to a tp-link plug and return its decoded response
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(tp_link_encrypt(json.dumps(request).encode("utf8")))
+        await writer.drain()
+        length = struct.unpack(">I", await reader.readexactly(4))[0]
+        return json.loads(tp_link_decrypt(await reader.readexactly(length)))
+    finally:
+        writer.close()
+
+
+async def tp_link_get_power(host, port=TP_LINK_PORT):
+    """
+    Returns "on" or "off", per the tp-link plug's relay
+    """
+    response = await tp_link_request(host, {"system": {"get_sysinfo": {}}}, port)
+    try:
+        return "on" if response["system"]["get_sysinfo"]["relay_state"] else "off"
+    except (KeyError, TypeError) as error:
+        raise TPLinkError(f"unexpected response: {response}") from error
+
+
+async def tp_link_set_power(host, state, port=TP_LINK_PORT):
+    """
+    Power on/off a device controlled by a tp-link smart plug host
+    """
+    response = await tp_link_request(
+        host, {"system": {"set_relay_state": {"state": 1 if state == "on" else 0}}}, port)
+    try:
+        err_code = response["system"]["set_relay_state"]["err_code"]
+    except (KeyError, TypeError) as error:
+        raise TPLinkError(f"unexpected response: {response}") from error
+    if err_code:
+        raise TPLinkError(f"err_code: {err_code}")
+
+
+async def tasmota_request(host, command, port=TASMOTA_PORT):
+    """
+    Send a command to a tasmota plug and return its decoded response
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        path = "/cm?cmnd=" + command.replace(" ", "%20")
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode("utf8"))
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    status = head.split(b"\r\n")[0]
+    if b" 200 " not in status + b" ":
+        raise TasmotaError(f"unexpected response: {status!r}")
+    try:
+        return json.loads(body)
+    except ValueError as error:
+        raise TasmotaError(f"unexpected response: {body!r}") from error
+
+
+def tasmota_power(response):
+    """
+    Returns "on" or "off", per a tasmota response to a Power command
+    """
+    for key in ("POWER", "POWER1"):
+        if key in response:
+            return response[key].lower()
+    raise TasmotaError(f"unexpected response: {response}")
+
+
+async def tasmota_get_power(host, port=TASMOTA_PORT):
+    """
+    Returns "on" or "off", per the tasmota plug's relay
+    """
+    return tasmota_power(await tasmota_request(host, "Power", port))
+
+
+async def tasmota_set_power(host, state, port=TASMOTA_PORT):
+    """
+    Power on/off a device controlled by a tasmota smart plug host
+    """
+    power = tasmota_power(await tasmota_request(host, f"Power {state}", port))
+    if power != state:
+        raise TasmotaError(f"relay is {power}, rather than {state}")
+
+
+# plug type -> (get power, set power, default port)
+PLUG_TYPES = {
+    "tasmota": (tasmota_get_power, tasmota_set_power, TASMOTA_PORT),
+    "tp-link": (tp_link_get_power, tp_link_set_power, TP_LINK_PORT),
+}
+
+
+class PowerOptions:  # pylint: disable=too-few-public-methods
+    """
+    How plugs are switched
+    """
+    def __init__(self, concurrency=16, timeout=3.0, retries=2, skip_matching=True):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.skip_matching = skip_matching
+
+
+async def switch_plug(plug, state, options):
+    """
+    Query, then if needed, switch a single plug.
+    Returns the action taken: "skipped" or "switched"
+    """
+    get_power, set_power, default_port = PLUG_TYPES[plug["type"]]
+    port = plug.get("port", default_port)
+    if options.skip_matching:
+        if await asyncio.wait_for(get_power(plug["host"], port), options.timeout) == state:
+            return "skipped"
+    await asyncio.wait_for(set_power(plug["host"], state, port), options.timeout)
+    return "switched"
+
+
+async def set_plug(dut, plug, state, semaphore, options):
+    """
+    Set a DUT's plug to state, retrying failures.
+    Returns a result dict for the summary
+    """
+    result = {"dut": dut, "type": plug.get("type"), "host": plug.get("host"),
+              "target": state, "result": "failed", "attempts": 0, "error": None}
+    start = time.monotonic()
+    if plug.get("type") not in PLUG_TYPES:
+        result["error"] = f"unknown power plug type: {plug.get('type')}"
+    else:
+        async with semaphore:
+            for attempt in range(options.retries + 1):
+                result["attempts"] = attempt + 1
+                try:
+                    result["result"] = await switch_plug(plug, state, options)
+                    result["error"] = None
+                    break
+                except asyncio.TimeoutError:
+                    result["error"] = f"timed out after {options.timeout}s"
+                except (OSError, PowerError, ValueError) as error:
+                    result["error"] = str(error) or repr(error)
+                if attempt < options.retries:
+                    await asyncio.sleep(0.1 * (attempt + 1))
+    result["seconds"] = round(time.monotonic() - start, 3)
+    return result
+
+
+async def set_power_all(targets, power_config, options=None):
+    """
+    Set the plugs of many DUTs concurrently.
+    targets maps dut name -> "on"/"off".
+    Returns a result per DUT, in the order of targets
+    """
+    options = options or PowerOptions()
+    semaphore = asyncio.Semaphore(max(options.concurrency, 1))
+    return await asyncio.gather(*[
+        set_plug(dut, power_config[dut], state, semaphore, options)
+        for dut, state in targets.items()
+    ])
+
+
+def apply_power(targets, power_config, options=None):
+    """
+    Synchronous wrapper around set_power_all
+    """
+    return asyncio.run(set_power_all(targets, power_config, options))
+
+
+def format_table(columns, results):
+    """
+    Returns a table of results, a list of dicts, with a column per key in columns
+    """
+    rows = [[str(result[column] if result[column] is not None else "")
+             for column in columns] for result in results]
+    widths = [max([len(column)] + [len(row[index]) for row in rows])
+              for index, column in enumerate(columns)]
+    lines = ["  ".join(column.upper().ljust(width) for column, width in zip(columns, widths))]
+    for row in rows:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    return "\n".join(lines)
+
+
+def format_results(results):
+    """
+    Returns a summary table of power results
+    """
+    return format_table(["dut", "type", "host", "target", "result", "attempts", "seconds",
+                         "error"], results)
@@ -0,0 +1,146 @@
+"""
+Timing of create, across the controller and the changers run on the pods.
+Spans are recorded per track, where a track is the controller or a pod,
+and written as a Chrome trace, which chrome://tracing and Perfetto open,
+along with a summary of the slowest phases and pods, and of the commands
+that the changers ran.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+CONTROLLER = "controller"
+
+
+class Profiler:
+    """
+    Spans recorded during a run, relative to when the profiler was created
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.spans = []
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, track, name, start, seconds, category=None):
+        """
+        Record a span of seconds, starting start seconds into the run
+        """
+        with self.lock:
+            self.spans.append({"track": track, "name": name, "start": start,
+                               "seconds": seconds, "category": category or track})
+
+    @contextlib.contextmanager
+    def span(self, track, name):
+        """
+        Record the time spent within the block
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(track, name, start - self.start, time.monotonic() - start)
+
+    def add_changer_profile(self, pod, finished, profile):
+        """
+        Record the phases and commands of a pod's changer, from the profile
+        it reported. finished is when the changer returned, by time.monotonic(),
+        which the changer's own times are aligned to.
+        """
+        offset = finished - self.start - profile["seconds"]
+        for phase in profile["phases"]:
+            self.add(pod, f"changer {phase['name']}", offset + phase["start"],
+                     phase["seconds"], "changer")
+        for command in profile["commands"]:
+            self.add(pod, command["type"], offset + command["start"], command["seconds"],
+                     "command")
+        with self.lock:
+            for command_type, count in profile["counts"].items():
+                total = self.counts.setdefault(command_type, {"count": 0, "seconds": 0})
+                total["count"] += count["count"]
+                total["seconds"] += count["seconds"]
+
+    def add_changer_output(self, pod, finished, stdout):
+        """
+        Record the profile that changer.py --profile printed, if it did
+        """
+        profile = parse_changer_profile(stdout)
+        if profile:
+            self.add_changer_profile(pod, finished, profile)
+
+    def tracks(self):
+        """
+        The controller's track, followed by each pod's
+        """
+        return [CONTROLLER] + sorted({span["track"] for span in self.spans} - {CONTROLLER})
+
+    def chrome_trace(self):
+        """
+        Returns the spans in Chrome's trace event format, one thread per track
+        """
+        tids = {track: tid for tid, track in enumerate(self.tracks())}
+        events = [{"ph": "M", "name": "thread_name", "pid": 1, "tid": tid,
+                   "args": {"name": track}} for track, tid in tids.items()]
+        for span in self.spans:
+            events.append({"ph": "X", "name": span["name"], "cat": span["category"],
+                           "pid": 1, "tid": tids[span["track"]], "ts": round(span["start"] * 1e6),
+                           "dur": round(span["seconds"] * 1e6)})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "summary": self.summary()}
+
+    def summary(self, top=5):
+        """
+        Returns the slowest phases of the controller and of the changers,
+        the slowest pods, and the count and total time of each type of command
+        """
+        phases = {}
+        for span in self.spans:
+            if span["category"] in (CONTROLLER, "changer"):
+                phase = phases.setdefault(span["name"], {"name": span["name"], "count": 0,
+                                                         "seconds": 0, "max": 0})
+                phase["count"] += 1
+                phase["seconds"] += span["seconds"]
+                phase["max"] = max(phase["max"], span["seconds"])
+        pods = [{"pod": span["track"], "seconds": span["seconds"]} for span in self.spans
+                if span["track"] != CONTROLLER and span["name"] == "configure"]
+        commands = [{"type": command_type, **count}
+                    for command_type, count in self.counts.items()]
+        return {
+            "phases": sorted(phases.values(), key=lambda phase: -phase["seconds"])[:top],
+            "pods": sorted(pods, key=lambda pod: -pod["seconds"])[:top],
+            "commands": sorted(commands, key=lambda command: -command["seconds"]),
+        }
+
+    def write(self, path):
+        """
+        Write the Chrome trace to path
+        """
+        with open(path, "w", encoding="utf8") as file_handle:
+            json.dump(self.chrome_trace(), file_handle)
+
+
+def parse_changer_profile(stdout):
+    """
+    Returns the profile that changer.py --profile printed, or None
+    """
+    for line in stdout.splitlines():
+        if line.startswith(b"profile: "):
+            return json.loads(line[len(b"profile: "):])
+    return None
+
+
+def format_summary(summary):
+    """
+    Returns the lines of a printable summary
+    """
+    lines = ["slowest phases:"]
+    lines += [f"  {phase['name']}: {phase['seconds']:.3f}s total, {phase['max']:.3f}s max "
+              f"over {phase['count']}" for phase in summary["phases"]]
+    lines.append("slowest pods:")
+    lines += [f"  {pod['pod']}: {pod['seconds']:.3f}s" for pod in summary["pods"]]
+    if summary["commands"]:
+        lines.append("commands:")
+        lines += [f"  {command['type']}: {command['count']} in {command['seconds']:.3f}s"
+                  for command in summary["commands"]]
+    return lines
@@ -0,0 +1,131 @@
+"""
+Rolling configs out to pods in waves, so that a pod is only changed once
+the pods that reach the controller through it have been, and are still
+reachable.
+A site's pods reach the controller through its uplinks: the tunneling pod,
+and pods that carry other pods' traffic, ie. whose wan bridge has mesh0, or
+that have trunk ports besides their own. A bad change to an uplink would cut
+off the pods behind it, so the leaves of every site go first, at once, then
+the pods they depend on. Between waves, the pods changed so far are checked
+for reachability, and a site whose pods failed, or became unreachable, is
+held back from the later waves.
+"""
+
+import health
+from configure import apply_payloads, error_result
+from profiler import CONTROLLER
+from transport import pod_transport
+
+
+def carries_others(pod_info):
+    """
+    Whether a pod's wan bridge carries other pods' traffic: it has a mesh
+    backhaul, or trunk ports besides its uplink
+    """
+    return "mesh0" in pod_info["wan_bridge"]["members"] or len(pod_info["trunk_ports"]) > 1
+
+
+def dependencies(hardware):
+    """
+    The dependency graph of a hardware config's pods: pod -> the pods that
+    it reaches the controller through.
+    Pods depend on their site's tunneling pod, and pods that don't carry
+    other pods' traffic also depend on those that do
+    """
+    graph = {}
+    for _, site_config in sorted(hardware["sites"].items()):
+        tunneling_pod = site_config["tunneling_pod"]
+        uplinks = {pod for pod, pod_info in site_config["pods"].items()
+                   if carries_others(pod_info)} | {tunneling_pod}
+        for pod in site_config["pods"]:
+            if pod == tunneling_pod:
+                graph[pod] = set()
+            elif pod in uplinks:
+                graph[pod] = {tunneling_pod}
+            else:
+                graph[pod] = uplinks
+    return graph
+
+
+def waves(graph, pods):
+    """
+    Order pods into waves, each pod coming after every one of pods that depends
+    on it, so that leaves are first. The pods of a wave don't depend on one
+    another, so they're applied at once
+    """
+    dependents = {pod: [] for pod in pods}
+    for pod in pods:
+        for uplink in graph.get(pod, ()):
+            if uplink in dependents:
+                dependents[uplink].append(pod)
+    depths = {}
+
+    def depth(pod):
+        # the longest chain of pods that depend on pod
+        if pod not in depths:
+            depths[pod] = 1 + max((depth(dependent) for dependent in dependents[pod]),
+                                  default=-1)
+        return depths[pod]
+
+    ordered = {}
+    for pod in sorted(pods):
+        ordered.setdefault(depth(pod), []).append(pod)
+    return [ordered[wave] for wave in sorted(ordered)]
+
+
+def unreachable(index, pods, transport, options):
+    """
+    Returns pod -> error for the pods that can't be reached over transport
+    """
+    targets = [target for target in health.pod_targets(index.hardware,
+                                                       health.pod_port(transport))
+               if target["name"] in pods]
+    results = health.check(targets, pod_transport(index, transport).command, options)
+    return {result["name"]: result["error"] for result in results if not result["ok"]}
+
+
+def apply_wave(index, payloads, held_back, args):
+    """
+    Apply a wave's payloads, other than those of sites held back, which
+    maps site -> why. Returns the result of each pod
+    """
+    results = {}
+    for pod in payloads:
+        site = index.get_pod_site(pod)
+        if site in held_back:
+            results[pod] = error_result(f"held back, as {held_back[site]}")
+    wave = {pod: payload for pod, payload in payloads.items() if pod not in results}
+    if wave:
+        results.update(apply_payloads(index, wave, args))
+    return results
+
+
+def apply_in_waves(index, payloads, args, options=None):
+    """
+    Apply payloads to their pods in waves, checking that the pods applied so
+    far are reachable, per health options, between waves, unless options is None.
+    Returns the result of each pod, where those of sites that were held
+    back are errors
+    """
+    ordered = waves(dependencies(index.hardware), payloads)
+    results = {}
+    held_back = {}
+    for number, wave in enumerate(ordered, 1):
+        if len(ordered) > 1:
+            print(f"wave {number}/{len(ordered)}: {', '.join(wave)}")
+        with args.profiler.span(CONTROLLER, f"wave {number}"):
+            results.update(apply_wave(index, {pod: payloads[pod] for pod in wave},
+                                      held_back, args))
+        for pod in wave:
+            if results[pod]["status"] != "ok":
+                held_back.setdefault(index.get_pod_site(pod), f"pod: {pod} failed")
+        if number == len(ordered) or options is None:
+            continue
+        with args.profiler.span(CONTROLLER, f"wave {number} reachability"):
+            lost = unreachable(index, [pod for pod in results
+                                       if index.get_pod_site(pod) not in held_back],
+                               args.transport, options)
+        for pod, error in sorted(lost.items()):
+            print(f"pod: {pod}, host: {index.pod_host(pod)} unreachable: {error}")
+            held_back.setdefault(index.get_pod_site(pod), f"pod: {pod} became unreachable")
+    return results
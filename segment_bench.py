@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+"""
+Measures a bridge's capacity, between the sim_wired_client namespaces on it.
+On pods, run within a client's namespace, this is a UDP traffic generator:
+- server: receives traffic, and answers MTU probes
+- send: sends traffic to a server, for a duration and at a rate
+- mtu: sends probes of increasing size, with DF set, and counts the answers
+On the controller, `topology-sim bench-segment` gives each client a temporary
+address, and measures throughput, PPS, jitter and loss from each client to the
+first, with this generator or iperf3 when every pod has it. MTU probes show
+which frame sizes make it across the segment, ie. through the
+nopmtudisc ignore-df gretap tunnels between sites.
+Only the standard library is used, as this is run on pods.
+"""
+
+import argparse
+import json
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+# kind, sequence number, send time in ns or probe size
+HEADER = struct.Struct("!BIQ")
+DATA, PROBE, ACK = 0, 1, 2
+# IP_MTU_DISCOVER and IP_PMTUDISC_DO from linux/in.h, which Python doesn't always have
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+SOCKET_BUFFER = 4 * 1024 * 1024
+# RFC 2544 benchmarking addresses, given to clients for the length of a run
+BENCH_NETWORK = "198.18"
+BENCH_PREFIX = 15
+# the columns of the controller's summary of results
+COLUMNS = ["server", "client", "tool", "mbps", "pps", "jitter_ms", "loss_pct", "max_df_size",
+           "error"]
+
+
+class ReceiveStats:  # pylint: disable=too-many-instance-attributes
+    """
+    Counts received traffic, and its jitter per RFC 3550
+    """
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.reordered = 0
+        self.max_sequence = -1
+        self.transit = None
+        self.jitter = 0.0
+
+    def add(self, sequence, sent, size, arrived):
+        """
+        Record a data packet, sent and arrived in ns
+        """
+        self.packets += 1
+        self.bytes += size
+        self.first = arrived if self.first is None else self.first
+        self.last = arrived
+        if sequence < self.max_sequence:
+            self.reordered += 1
+        self.max_sequence = max(self.max_sequence, sequence)
+        # clock offsets between pods cancel out of the change in transit time
+        transit = arrived - sent
+        if self.transit is not None:
+            self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+        self.transit = transit
+
+    def summary(self):
+        """
+        Returns the counts, and the rates over the time traffic arrived for
+        """
+        seconds = (self.last - self.first) / 1e9 if self.packets > 1 else 0
+        return {"packets": self.packets, "bytes": self.bytes, "reordered": self.reordered,
+                "seconds": round(seconds, 6),
+                "mbps": round(self.bytes * 8 / seconds / 1e6, 3) if seconds else 0,
+                "pps": round(self.packets / seconds, 1) if seconds else 0,
+                "jitter_ms": round(self.jitter / 1e6, 4)}
+
+
+def udp_socket():
+    """
+    A UDP socket with large buffers
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+    return sock
+
+
+def serve(sock, timeout, idle=1.0):
+    """
+    Receive traffic and answer probes, until idle seconds after traffic stops,
+    or timeout seconds have passed. Returns the received traffic's summary
+    """
+    stats = ReceiveStats()
+    sock.settimeout(0.1)
+    deadline = time.monotonic() + timeout
+    last_data = None
+    while time.monotonic() < deadline:
+        if last_data is not None and time.monotonic() - last_data > idle:
+            break
+        try:
+            data, address = sock.recvfrom(65535)
+        except socket.timeout:
+            continue
+        if len(data) < HEADER.size:
+            continue
+        kind, sequence, sent = HEADER.unpack_from(data)
+        if kind == PROBE:
+            sock.sendto(HEADER.pack(ACK, sequence, len(data)), address)
+        elif kind == DATA:
+            last_data = time.monotonic()
+            stats.add(sequence, sent, len(data), time.time_ns())
+    return stats.summary()
+
+
+def send(target, size, duration, rate=0):
+    """
+    Send size byte datagrams to target, a (host, port), for duration seconds,
+    at rate Mbit/s or as fast as possible when rate is 0
+    """
+    sock = udp_socket()
+    payload = bytearray(max(size, HEADER.size))
+    interval = len(payload) * 8 / (rate * 1e6) if rate else 0
+    start = time.monotonic()
+    next_send = start
+    sequence = errors = 0
+    while True:
+        now = time.monotonic()
+        if now - start >= duration:
+            break
+        if interval:
+            if now < next_send:
+                time.sleep(min(next_send - now, 0.001))
+                continue
+            next_send += interval
+        HEADER.pack_into(payload, 0, DATA, sequence, time.time_ns())
+        try:
+            sock.sendto(payload, target)
+            sequence += 1
+        except OSError:
+            # ie. ENOBUFS, when sending faster than the interface can
+            errors += 1
+    sock.close()
+    return {"sent": sequence, "bytes": sequence * len(payload),
+            "seconds": round(time.monotonic() - start, 6), "errors": errors}
+
+
+def await_ack(sock, sequence, timeout):
+    """
+    Returns whether the probe with sequence was answered within timeout
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        sock.settimeout(max(deadline - time.monotonic(), 0.001))
+        try:
+            data = sock.recv(65535)
+        except socket.timeout:
+            return False
+        if len(data) >= HEADER.size and HEADER.unpack_from(data)[:2] == (ACK, sequence):
+            return True
+    return False
+
+
+def probe_mtu(target, sizes, count=3, timeout=0.5):
+    """
+    Send count probes of each size to target, with DF set, so that they are
+    dropped rather than fragmented wherever they don't fit.
+    Returns size -> the probes sent and answered, and any local error
+    """
+    sock = udp_socket()
+    sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+    results = {}
+    sequence = 0
+    for size in sizes:
+        result = results[str(size)] = {"sent": 0, "acked": 0, "error": None}
+        payload = bytearray(max(size, HEADER.size))
+        for _ in range(count):
+            sequence += 1
+            HEADER.pack_into(payload, 0, PROBE, sequence, 0)
+            try:
+                sock.sendto(payload, target)
+            except OSError as error:
+                # EMSGSIZE: bigger than the MTU of the client's own port
+                result["error"] = error.strerror
+                break
+            result["sent"] += 1
+            result["acked"] += await_ack(sock, sequence, timeout)
+    sock.close()
+    return results
+
+
+class BenchOptions:  # pylint: disable=too-few-public-methods
+    """
+    How segments are measured
+    """
+    def __init__(self, duration=5.0, size=1400, rate=0, tool="auto"):
+        self.duration = duration
+        self.size = size
+        self.rate = rate
+        self.tool = tool
+        self.port = 5201
+        # UDP payload sizes probed, where 1472 fills a 1500 byte MTU
+        self.mtu_sizes = (1200, 1400, 1472, 1500, 2000, 4000, 8000)
+
+
+class Endpoint:  # pylint: disable=too-few-public-methods
+    """
+    A sim_wired_client namespace on a pod, and its temporary address
+    """
+    def __init__(self, pod, host, namespace, port, address):
+        self.pod = pod
+        self.host = host
+        self.namespace = namespace
+        self.port = port
+        self.address = address
+
+    def command(self, command):
+        """
+        Returns the shell command that runs command in this client's namespace
+        """
+        return f"ip netns exec {self.namespace} {command}"
+
+    def __str__(self):
+        return f"{self.pod}/{self.namespace}"
+
+
+def bridge_clients(config, generated, bridge, pod_host):
+    """
+    Returns an Endpoint per sim_wired_client on a bridge of a user config,
+    where generated is the config generated from it, and pod_host(pod) gives a pod's host
+    """
+    endpoints = []
+    for member in config["bridges"][bridge]["members"]:
+        if member["type"] == "sim_wired_client":
+            pod, namespace = member["pod"], member["namespace"]
+            number = len(endpoints)
+            endpoints.append(Endpoint(
+                pod, pod_host(pod), namespace, generated[pod]["namespaces"][namespace]["port"],
+                f"{BENCH_NETWORK}.{number // 250}.{number % 250 + 1}"))
+    return endpoints
+
+
+def generator_command(pod_dir, args):
+    """
+    Returns the shell command that runs this script, once pushed to pod_dir
+    """
+    return f"python3 {pod_dir}/segment_bench.py {args}"
+
+
+def run_json(transport, endpoint, command, timeout):
+    """
+    Run a command in an endpoint's namespace, returning the JSON it printed
+    """
+    proc = transport.run(endpoint.host, endpoint.command(command), timeout=timeout)
+    try:
+        return json.loads(proc.stdout)
+    except ValueError:
+        raise RuntimeError(proc.stderr.decode("utf8", "replace").strip() or
+                           f"{command} resulted in {proc.returncode} exit_code") from None
+
+
+def iperf3(transport, server, client, options):
+    """
+    Measure traffic from client to server with iperf3
+    """
+    listener = subprocess.Popen(  # pylint: disable=consider-using-with
+        transport.command(server.host, server.command(f"iperf3 -s -1 -p {options.port}")),
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for attempt in range(5):
+            time.sleep(0.2 * (attempt + 1))
+            report = run_json(transport, client,
+                              f"iperf3 -c {server.address} -p {options.port} -u -J "
+                              f"-b {options.rate}M -l {options.size} -t {options.duration}",
+                              options.duration + 10)
+            if "error" not in report:
+                break
+    finally:
+        listener.kill()
+        listener.wait()
+    if "error" in report:
+        raise RuntimeError(report["error"])
+    total = report["end"]["sum"]
+    return {"mbps": round(total["bits_per_second"] / 1e6, 3),
+            "pps": round(total["packets"] / total["seconds"], 1) if total["seconds"] else 0,
+            "jitter_ms": total["jitter_ms"], "loss_pct": total["lost_percent"],
+            "sent": total["packets"], "received": total["packets"] - total["lost_packets"]}
+
+
+def bench_pair(transport, server, client, options, pod_dir):
+    """
+    Probe the MTU from client to server, then measure traffic between them.
+    Returns the pair's results
+    """
+    result = {"server": str(server), "client": str(client), "tool": options.tool}
+    listener = subprocess.Popen(  # pylint: disable=consider-using-with
+        transport.command(server.host, server.command(generator_command(
+            pod_dir, f"server --port {options.port} --timeout {options.duration + 30}"))),
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        if listener.stdout.readline().strip() != b"ready":
+            raise RuntimeError(f"{server}: traffic generator didn't start")
+        target = f"--target {server.address} --port {options.port}"
+        sizes = ",".join(map(str, options.mtu_sizes))
+        result["mtu"] = run_json(transport, client, generator_command(
+            pod_dir, f"mtu {target} --sizes {sizes}"), 30)
+        if options.tool == "iperf3":
+            listener.kill()
+            result.update(iperf3(transport, server, client, options))
+            return result
+        sent = run_json(transport, client, generator_command(
+            pod_dir, f"send {target} --size {options.size} --duration {options.duration} "
+            f"--rate {options.rate}"), options.duration + 10)
+        received = json.loads(listener.communicate(timeout=options.duration + 40)[0])
+    finally:
+        if listener.poll() is None:
+            listener.kill()
+        listener.wait()
+    result.update({key: received[key] for key in ("mbps", "pps", "jitter_ms")})
+    result.update({"sent": sent["sent"], "received": received["packets"],
+                   "loss_pct": round(100 * (1 - received["packets"] / sent["sent"]), 3)
+                   if sent["sent"] else 0})
+    return result
+
+
+def largest_delivered(mtu):
+    """
+    The largest probe size that was answered, with DF set
+    """
+    delivered = [int(size) for size, probe in mtu.items() if probe["acked"]]
+    return max(delivered) if delivered else None
+
+
+def choose_tool(transport, endpoints, tool):
+    """
+    iperf3 when asked for, or when every pod has it and the tool is auto
+    """
+    if tool != "auto":
+        return tool
+    for host in {endpoint.host for endpoint in endpoints}:
+        if transport.run(host, "command -v iperf3 >/dev/null", timeout=10).returncode:
+            return "python"
+    return "iperf3"
+
+
+def setup_commands(endpoint):
+    """
+    The commands that ready a client's namespace for traffic. A port moved
+    into a namespace arrives down, as does the namespace's loopback
+    """
+    return ["ip link set dev lo up", f"ip link set dev {endpoint.port} up",
+            f"ip addr replace {endpoint.address}/{BENCH_PREFIX} dev {endpoint.port}"]
+
+
+def run(transport, endpoints, options, pod_dir):
+    """
+    Measure traffic from each client to the first, one pair at a time,
+    with the clients given their temporary addresses for the duration.
+    Returns the results of each pair
+    """
+    options.tool = choose_tool(transport, endpoints, options.tool)
+    for endpoint in endpoints:
+        for command in setup_commands(endpoint):
+            transport.run(endpoint.host, endpoint.command(command), timeout=10)
+    results = []
+    try:
+        for client in endpoints[1:]:
+            try:
+                result = bench_pair(transport, endpoints[0], client, options, pod_dir)
+                result["max_df_size"] = largest_delivered(result["mtu"])
+            except (RuntimeError, OSError, ValueError, subprocess.TimeoutExpired) as error:
+                result = {"server": str(endpoints[0]), "client": str(client),
+                          "tool": options.tool, "error": str(error)}
+            results.append(result)
+    finally:
+        for endpoint in endpoints:
+            transport.run(endpoint.host, endpoint.command(
+                f"ip addr del {endpoint.address}/{BENCH_PREFIX} dev {endpoint.port}"),
+                timeout=10)
+    return results
+
+
+def get_args():
+    """
+    Process command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["server", "send", "mtu"])
+    parser.add_argument("--port", type=int, default=5201, help="UDP port")
+    parser.add_argument("--target", help="address of the server")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds the server waits for traffic")
+    parser.add_argument("--size", type=int, default=1400, help="UDP payload bytes")
+    parser.add_argument("--duration", type=float, default=5, help="seconds to send for")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Mbit/s to send at, or 0 for as fast as possible")
+    parser.add_argument("--sizes", default="1200,1400,1472,1500",
+                        help="comma separated UDP payload sizes to probe")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Run the traffic generator, printing its results as JSON
+    """
+    args = get_args()
+    if args.command == "server":
+        sock = udp_socket()
+        sock.bind(("", args.port))
+        print("ready", flush=True)
+        result = serve(sock, args.timeout)
+    elif args.command == "send":
+        result = send((args.target, args.port), args.size, args.duration, args.rate)
+    else:
+        result = probe_mtu((args.target, args.port), [int(size) for size in args.sizes.split(",")])
+    json.dump(result, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
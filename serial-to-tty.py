@@ -1,38 +1,133 @@
 #!/usr/bin/env python3
 
+"""
+Runs on pod, in order to find the tty of a USB serial adapter.
+Only the usb-serial bus is looked at: each of its devices is a tty, whose
+USB device, two levels up, holds the adapter's serial number.
+The serial -> tty map is cached, and rebuilt when a device is plugged or unplugged.
+
+usage:
+    serial-to-tty.py               print every serial -> tty, as JSON
+    serial-to-tty.py serial <id>   print the tty of the adapter with serial number <id>
+    serial-to-tty.py tty <tty>     print <tty>, if it's a USB serial tty
+"""
+
 import json
 import os
 import sys
 
 
 USB_SERIAL_PATH = "/sys/bus/usb-serial/devices"
+DEV_PATH = "/dev"
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serial-to-tty.json")
+
 
 def get_usb_serial_devices():
-    return os.listdir(USB_SERIAL_PATH)
+    """
+    The ttys on the usb-serial bus
+    """
+    try:
+        return sorted(os.listdir(USB_SERIAL_PATH))
+    except FileNotFoundError:
+        return []
+
+
+def fingerprint(ttys):
+    """
+    Identifies the adapters that are plugged in: the usb-serial ttys, and the
+    modification time of /dev, which changes whenever a device node is
+    created or removed, so that a tty unplugged and plugged back in isn't
+    mistaken for the same adapter. The usb-serial bus's own directory isn't
+    used, as sysfs doesn't update its modification time when devices come and go
+    """
+    try:
+        dev_mtime = os.stat(DEV_PATH).st_mtime_ns
+    except FileNotFoundError:
+        dev_mtime = None
+    return {"ttys": ttys, "dev_mtime": dev_mtime}
 
-def get_serial_to_tty():
+
+def read_serial(tty):
+    """
+    Returns the serial number of a tty's USB device, or None if it has none
+    """
+    interface = os.path.dirname(os.path.realpath(os.path.join(USB_SERIAL_PATH, tty)))
+    try:
+        with open(os.path.join(os.path.dirname(interface), "serial"),
+                  encoding="utf8") as file_handle:
+            return file_handle.read().strip()
+    except OSError:
+        return None
+
+
+def get_serial_to_tty(ttys):
+    """
+    Returns the serial -> tty map of ttys
+    """
     ret = {}
-    for dir_path, dirs, files in os.walk("/sys/devices"):
-        for file_name in files:
-            if file_name == "serial":
-                with open(os.path.join(dir_path, "serial")) as file_handle:
-                    serial = file_handle.read().strip()
-                for directory in dirs:
-                    if directory.startswith(os.path.basename(dir_path) + ":"):
-                        for dir_entry in os.listdir(os.path.join(dir_path, directory)):
-                                if dir_entry.startswith("tty"):
-                                    ret[serial] = dir_entry
+    for tty in ttys:
+        serial = read_serial(tty)
+        if serial:
+            ret[serial] = tty
     return ret
 
-serial_to_tty = get_serial_to_tty()
-
-if len(sys.argv) == 1:
-    print(json.dumps(serial_to_tty, indent=4))
-elif sys.argv[1] == "tty":
-    tty = sys.argv[2]
-    if tty in get_usb_serial_devices():
-        print(tty, end="")
-elif sys.argv[1] == "serial":
-    serial = sys.argv[2]
-    if serial in serial_to_tty:
-        print(serial_to_tty[serial], end="")
+
+def load_cache(current):
+    """
+    Returns the cached serial -> tty map, unless the adapters changed since
+    """
+    try:
+        with open(CACHE_PATH, encoding="utf8") as file_handle:
+            cache = json.load(file_handle)
+    except (OSError, ValueError):
+        return None
+    if cache.get("fingerprint") != current:
+        return None
+    return cache.get("serial_to_tty")
+
+
+def save_cache(current, serial_to_tty):
+    """
+    Cache the serial -> tty map, best effort
+    """
+    tmp_path = f"{CACHE_PATH}.{os.getpid()}"
+    try:
+        with open(tmp_path, "w", encoding="utf8") as file_handle:
+            json.dump({"fingerprint": current, "serial_to_tty": serial_to_tty}, file_handle)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError:
+        pass
+
+
+def cached_serial_to_tty():
+    """
+    Returns the serial -> tty map of the adapters plugged in
+    """
+    ttys = get_usb_serial_devices()
+    current = fingerprint(ttys)
+    serial_to_tty = load_cache(current)
+    if serial_to_tty is None:
+        serial_to_tty = get_serial_to_tty(ttys)
+        save_cache(current, serial_to_tty)
+    return serial_to_tty
+
+
+def main():
+    """
+    Print the requested tty, or every serial -> tty
+    """
+    if len(sys.argv) == 1:
+        print(json.dumps(cached_serial_to_tty(), indent=4))
+    elif sys.argv[1] == "tty":
+        tty = sys.argv[2]
+        if tty in get_usb_serial_devices():
+            print(tty, end="")
+    elif sys.argv[1] == "serial":
+        serial_to_tty = cached_serial_to_tty()
+        serial = sys.argv[2]
+        if serial in serial_to_tty:
+            print(serial_to_tty[serial], end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Sweeps step through a sequence of topologies, applying only the changes
+between consecutive ones.
+Steps come from config files, or from generator specs of the form:
+
+    base: config.yaml
+    vary:
+      eth_cable_1:        # bridge -> the alternatives it steps through,
+        - members: [...]  # where null removes the bridge
+          wan: null
+        - null
+
+which step through every combination of the alternatives, or:
+
+    configs:
+      - first.yaml
+      - second.yaml
+
+Steps are ordered to minimize the pods' bridge, tunnel and namespace changes,
+and the DUTs powered on or off, between consecutive steps.
+"""
+
+import copy
+import itertools
+import os
+
+from config_cache import load_yaml
+
+# a DUT power change costs as much as this many netdev changes, as the DUT has to boot
+POWER_WEIGHT = 10
+SECTIONS = ("bridges", "tunnels", "namespaces", "veth_pairs")
+
+
+class SweepError(Exception):
+    """Raised when a sweep spec can't be expanded"""
+
+
+def expand_vary(base, vary, name):
+    """
+    Returns a (name, config) step for every combination of bridge alternatives
+    """
+    bridges = sorted(vary)
+    steps = []
+    for choice in itertools.product(*(range(len(vary[bridge])) for bridge in bridges)):
+        config = copy.deepcopy(base)
+        config.setdefault("bridges", {})
+        for bridge, alternative in zip(bridges, choice):
+            if vary[bridge][alternative] is None:
+                config["bridges"].pop(bridge, None)
+            else:
+                config["bridges"][bridge] = copy.deepcopy(vary[bridge][alternative])
+        label = ", ".join(f"{bridge}={alternative}"
+                          for bridge, alternative in zip(bridges, choice))
+        steps.append((f"{name}[{label}]", config))
+    return steps
+
+
+def load_steps(paths):
+    """
+    Returns the (name, config) of each step of the sweep, from config files and specs
+    """
+    steps = []
+    for path in paths:
+        spec = load_yaml(path)
+        spec_dir = os.path.dirname(path)
+        if "bridges" in spec:
+            steps.append((path, spec))
+        elif "configs" in spec:
+            steps += load_steps([os.path.join(spec_dir, config) for config in spec["configs"]])
+        elif "vary" in spec:
+            base = load_yaml(os.path.join(spec_dir, spec["base"])) if "base" in spec else {}
+            base.setdefault("power_on", [])
+            base.setdefault("sim_wireless_clients", [])
+            steps += expand_vary(base, spec["vary"], path)
+        else:
+            raise SweepError(f"{path}: expected a config, or a spec with configs or vary")
+    return steps
+
+
+def distance(step1, step2):
+    """
+    The cost of changing from one step to another, where a step is
+    (generated config, power targets)
+    """
+    generated1, power1 = step1
+    generated2, power2 = step2
+    changes = 0
+    for pod in set(generated1) | set(generated2):
+        pod1, pod2 = generated1.get(pod, {}), generated2.get(pod, {})
+        for section in SECTIONS:
+            section1, section2 = pod1.get(section, {}), pod2.get(section, {})
+            changes += sum(section1.get(key) != section2.get(key)
+                           for key in set(section1) | set(section2))
+    changes += POWER_WEIGHT * sum(power1.get(dut) != power2.get(dut)
+                                  for dut in set(power1) | set(power2))
+    return changes
+
+
+def path_cost(order, distances):
+    """
+    Total cost of stepping through order
+    """
+    return sum(distances[step1][step2] for step1, step2 in zip(order, order[1:]))
+
+
+def nearest_neighbor(start, distances):
+    """
+    Order steps by repeatedly moving to the cheapest step not yet taken
+    """
+    order = [start]
+    left = set(range(len(distances))) - {start}
+    while left:
+        order.append(min(left, key=lambda step: (distances[order[-1]][step], step)))
+        left.remove(order[-1])
+    return order
+
+
+def reversal_gain(order, first, last, distances):
+    """
+    How much cheaper order gets by reversing the steps from first to last
+    """
+    gain = 0
+    if first > 0:
+        before = order[first - 1]
+        gain += distances[before][order[first]] - distances[before][order[last]]
+    if last < len(order) - 1:
+        after = order[last + 1]
+        gain += distances[order[last]][after] - distances[order[first]][after]
+    return gain
+
+
+def two_opt(order, distances):
+    """
+    Reverse runs of steps while that makes the order cheaper
+    """
+    improved = True
+    while improved:
+        improved = False
+        for first in range(len(order) - 1):
+            for last in range(first + 1, len(order)):
+                if reversal_gain(order, first, last, distances) > 0:
+                    order[first:last + 1] = order[first:last + 1][::-1]
+                    improved = True
+    return order
+
+
+def order_steps(steps):
+    """
+    Returns the indexes of steps, a list of (generated config, power targets),
+    in an order that minimizes the changes between consecutive steps
+    """
+    if not steps:
+        return []
+    distances = [[distance(step1, step2) for step2 in steps] for step1 in steps]
+    order = min((nearest_neighbor(start, distances) for start in range(len(steps))),
+                key=lambda order: path_cost(order, distances))
+    return two_opt(order, distances)
+
+
+def power_changes(previous, targets):
+    """
+    The power targets that differ from the previous step's, or all of them
+    for the first step
+    """
+    if previous is None:
+        return dict(targets)
+    return {dut: state for dut, state in targets.items() if previous.get(dut) != state}
+
+
+def format_report(results):
+    """
+    Returns a printable table of each step's results
+    """
+    lines = [f"{'step':<5} {'converge':>9} {'pods':>5} {'failed':>6} {'power':>5} "
+             f"{'hook':>5}  config"]
+    for number, result in enumerate(results, 1):
+        hook = "-" if result["hook_exit_code"] is None else result["hook_exit_code"]
+        lines.append(f"{number:<5} {result['converge_seconds']:>8.2f}s "
+                     f"{result['pods_applied']:>5} {len(result['failed_pods']):>6} "
+                     f"{result['power_changes']:>5} {hook:>5}  {result['config']}")
+    return "\n".join(lines)
@@ -0,0 +1,199 @@
+"""
+Reservations that let several testers share the fabric at once.
+Each tenant leases DUTs, pods and ranges of VLAN IDs and GRE keys, and
+creates its topology within them. The pods are applied a single config,
+merged from every active tenant's, so that the changer leaves the other
+tenants' bridges and namespaces as they are, and only the tenant's DUTs
+are switched.
+Leases are kept in .topology-sim/leases.json.
+"""
+
+import time
+
+from allocator import GRE_KEYS, VLAN_IDS
+from power import format_table
+
+# claims that no two tenants may share
+EXCLUSIVE = ["duts", "pods"]
+# ranges that no two tenants' may overlap, and the IDs each may be within
+RANGES = {"vlans": VLAN_IDS, "gre_keys": GRE_KEYS}
+
+
+class ReservationError(Exception):
+    """
+    Raised when a reservation, or a tenant's config, conflicts with
+    another tenant's or goes beyond its lease
+    """
+
+
+def parse_range(text, name, limits):
+    """
+    Returns [first, last] of a range given as FIRST-LAST, or a single ID
+    """
+    first, _, last = str(text).partition("-")
+    try:
+        ids = [int(first), int(last or first)]
+    except ValueError:
+        raise ReservationError(f"{name}: {text} isn't a range, ie. 100-199") from None
+    if not limits[0] <= ids[0] <= ids[1] <= limits[1]:
+        raise ReservationError(f"{name}: {text} isn't within {limits[0]}-{limits[1]}")
+    return ids
+
+
+def active(leases, now=None):
+    """
+    Returns the leases that haven't expired
+    """
+    now = time.time() if now is None else now
+    return {tenant: lease for tenant, lease in leases.items() if lease["expires"] > now}
+
+
+def dut_names(index):
+    """
+    Returns every DUT that the hardware config wires, consoles or powers
+    """
+    return {dut for dut, _ in index.member_to_port} | set(index.dut_to_console) | \
+        set(index.hardware["power"])
+
+
+def check_claims(leases, tenant, lease, now=None):
+    """
+    Raise ReservationError if lease claims anything that another tenant's
+    active lease does
+    """
+    conflicts = []
+    for other, other_lease in sorted(active(leases, now).items()):
+        if other == tenant:
+            continue
+        for claim in EXCLUSIVE:
+            for name in sorted(set(lease[claim]) & set(other_lease[claim])):
+                conflicts.append(f"{claim[:-1]}: {name} is leased by {other}")
+        for claim in RANGES:
+            first, last = lease[claim]
+            other_first, other_last = other_lease[claim]
+            if first <= other_last and other_first <= last:
+                conflicts.append(f"{claim}: {first}-{last} overlaps {other}'s "
+                                 f"{other_first}-{other_last}")
+    if conflicts:
+        raise ReservationError("\n".join(conflicts))
+
+
+def config_claims(config):
+    """
+    Returns the DUTs, client pods, bridges, namespaces and WAN sites that a
+    config uses
+    """
+    claims = {"duts": set(config.get("power_on") or []), "pods": set(), "bridges": set(),
+              "namespaces": set(), "wans": set()}
+    for bridge, bridge_config in config["bridges"].items():
+        claims["bridges"].add(bridge)
+        if bridge_config.get("wan"):
+            claims["wans"].add(bridge_config["wan"])
+        for member in bridge_config["members"]:
+            if member["type"] == "dut":
+                claims["duts"].add(member["dut_name"])
+            elif member["type"] == "sim_wired_client":
+                claims["pods"].add(member["pod"])
+                claims["namespaces"].add(member["namespace"])
+    for swc in config.get("sim_wireless_clients") or []:
+        claims["pods"].add(swc["pod"])
+        claims["namespaces"].add(swc["namespace"])
+    return claims
+
+
+def check_config(leases, tenant, config, now=None):
+    """
+    Raise ReservationError unless config only uses the DUTs and pods leased
+    to tenant, and none of the bridge or namespace names of another tenant's.
+    Nor may it use a WAN site that another tenant's does, as the bridges
+    with WAN access all join their site's wan bridge, untagged
+    """
+    leases = active(leases, now)
+    if tenant not in leases:
+        raise ReservationError(f"tenant: {tenant} has no lease, reserve first")
+    claims = config_claims(config)
+    problems = [f"{claim[:-1]}: {name} isn't leased to {tenant}"
+                for claim in EXCLUSIVE
+                for name in sorted(claims[claim] - set(leases[tenant][claim]))]
+    for other, lease in sorted(leases.items()):
+        if other == tenant or not lease.get("config"):
+            continue
+        other_claims = config_claims(lease["config"])
+        for claim in ["bridges", "namespaces", "wans"]:
+            problems += [f"{claim[:-1]}: {name} is already used by {other}"
+                         for name in sorted(claims[claim] & other_claims[claim])]
+    if problems:
+        raise ReservationError("\n".join(problems))
+
+
+def reserve(leases, index, tenant, claims, now=None):
+    """
+    Lease claims, {"duts", "pods", "vlans", "gre_keys", "hours"}, to tenant,
+    or renew its lease with them. The config that the tenant created is
+    kept, so long as it's within the new lease
+    """
+    now = time.time() if now is None else now
+    unknown = [f"dut: {dut} not found in the hardware config"
+               for dut in sorted(set(claims["duts"]) - dut_names(index))]
+    unknown += [f"pod: {pod} not found in the hardware config"
+                for pod in sorted(set(claims["pods"]) - set(index.pods))]
+    if unknown:
+        raise ReservationError("\n".join(unknown))
+    lease = {
+        "duts": sorted(set(claims["duts"])),
+        "pods": sorted(set(claims["pods"])),
+        **{claim: parse_range(claims[claim], claim, limits) for claim, limits in RANGES.items()},
+        "expires": now + claims["hours"] * 3600,
+        "config": leases.get(tenant, {}).get("config"),
+    }
+    check_claims(leases, tenant, lease, now)
+    if lease["config"]:
+        check_config({**leases, tenant: lease}, tenant, lease["config"], now)
+    leases[tenant] = lease
+    return lease
+
+
+def merged_config(leases):
+    """
+    Returns a config with every active tenant's bridges and clients.
+    Each bridge keeps its tenant's tunnel layout, and takes its IDs from
+    its tenant's ranges
+    """
+    merged = {"bridges": {}, "sim_wireless_clients": [], "power_on": []}
+    for _, lease in sorted(active(leases).items()):
+        config = lease.get("config")
+        if not config:
+            continue
+        for bridge, bridge_config in config["bridges"].items():
+            merged["bridges"][bridge] = {
+                **bridge_config,
+                "tunnel_layout": bridge_config.get("tunnel_layout") or config.get("tunnel_layout"),
+                "vlan_range": tuple(lease["vlans"]),
+                "gre_key_range": tuple(lease["gre_keys"]),
+            }
+        merged["sim_wireless_clients"] += config.get("sim_wireless_clients") or []
+        merged["power_on"] += config.get("power_on") or []
+    return merged
+
+
+def expire(leases, now=None):
+    """
+    Drop the leases that have expired, returning the DUTs they held
+    """
+    expired = set(leases) - set(active(leases, now))
+    return sorted({dut for tenant in expired for dut in leases.pop(tenant)["duts"]})
+
+
+def format_leases(leases, now=None):
+    """
+    Returns a table of the active leases
+    """
+    now = time.time() if now is None else now
+    rows = [{"tenant": tenant, "duts": ",".join(lease["duts"]), "pods": ",".join(lease["pods"]),
+             "vlans": "-".join(map(str, lease["vlans"])),
+             "gre_keys": "-".join(map(str, lease["gre_keys"])),
+             "bridges": len((lease.get("config") or {}).get("bridges") or {}),
+             "hours_left": f"{(lease['expires'] - now) / 3600:.1f}"}
+            for tenant, lease in sorted(active(leases, now).items())]
+    return format_table(["tenant", "duts", "pods", "vlans", "gre_keys", "bridges",
+                         "hours_left"], rows)
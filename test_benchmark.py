@@ -0,0 +1,33 @@
+"""
+pytest tests for the benchmark harness
+"""
+
+import copy
+
+import benchmark
+import topology_sim
+
+
+def test_synthetic_fabric_generates():
+    """
+    Synthetic fabrics are valid input to the generator, and a case reports each stage
+    """
+    hardware = benchmark.synthetic_hardware(3, 2)
+    config = benchmark.synthetic_config(hardware, 12)
+    generated = topology_sim.gen_config(config, topology_sim.HardwareIndex(hardware))
+    assert len(generated) == 6
+    assert any(pod_config["tunnels"] for pod_config in generated.values())
+
+    result = benchmark.run_case("tiny", 1)
+    assert result["pods"] == 1
+    assert result["create_tarball"]["pods"] == 1
+    assert result["plan"]["commands"] > 0
+    assert "| tiny |" in benchmark.summary({"cases": [result]})
+    assert not benchmark.regressions({"cases": [result]}, {"cases": [result]}, 2.0)
+    result["plan"]["seconds"] = 0.01
+    slower = copy.deepcopy(result)
+    slower["plan"]["seconds"] = 0.2
+    assert benchmark.regressions({"cases": [slower]}, {"cases": [result]}, 2.0, 0.05) == [
+        "tiny plan: 0.200s, baseline 0.010s"]
+    # too little slower to tell from noise
+    assert not benchmark.regressions({"cases": [slower]}, {"cases": [result]}, 2.0, 1.0)
@@ -0,0 +1,451 @@
+"""
+pytest tests for the pod side changer script
+"""
+
+import itertools
+import json
+
+import pytest
+
+import changer
+import topology_sim
+
+
+class FakePod:  # pylint: disable=too-many-instance-attributes
+    """
+    Just enough of a pod's networking stack to run the changer against
+    """
+    def __init__(self, wan="br-lan", wan_members=("wan",), phys=()):
+        self.links = {}
+        self.vids = {}
+        self.self_vids = {}
+        self.namespaces = {}
+        self.phys = set(phys)
+        self.commands = []
+        self.processes = 0
+        self.failing = set()
+        self.ifindexes = itertools.count(1)
+        self.add_link(wan, "bridge")
+        self.links[wan]["flags"].append("UP")
+        self.self_vids[wan] = {1: ["PVID", "Egress Untagged"]}
+        for port in ["wan", "mesh0", "lan1", "lan2", "lan3", "lan4"]:
+            self.add_link(port, "dsa")
+        for member in wan_members:
+            self.enslave(member, wan)
+
+    def add_link(self, name, kind, **info):
+        """Create a netdev"""
+        self.links[name] = {"ifname": name, "ifindex": next(self.ifindexes),
+                            "flags": ["BROADCAST"],
+                            "linkinfo": {"info_kind": kind, "info_data": info}}
+
+    def enslave(self, name, bridge):
+        """Make name a port of bridge, with the default PVID"""
+        self.links[name]["master"] = bridge
+        self.links[name]["linkinfo"]["info_slave_data"] = {"isolated": False}
+        self.vids[name] = {1: ["PVID", "Egress Untagged"]}
+
+    def del_link(self, name):
+        """Delete a netdev, and its veth peer"""
+        link = self.links.pop(name)
+        self.vids.pop(name, None)
+        self.self_vids.pop(name, None)
+        for other in list(self.links.values()):
+            if other.get("master") == name:
+                del other["master"]
+                self.vids.pop(other["ifname"], None)
+        peer = link.get("peer")
+        if peer in self.links:
+            self.links.pop(peer)
+            self.vids.pop(peer, None)
+        for namespace in self.namespaces.values():
+            namespace.discard(peer)
+
+    def ip_link(self, args):
+        """Handle ip link subcommands"""
+        if args[:2] == ["show", "type"]:
+            return json.dumps([link for link in self.links.values()
+                               if link["linkinfo"]["info_kind"] == args[2]])
+        if args[0] == "show":
+            return json.dumps(list(self.links.values()))
+        if args[0] == "del":
+            self.del_link(args[1])
+        elif args[0] == "add":
+            self.ip_link_add(args[1:])
+        elif args[0] == "set":
+            self.ip_link_set(args[1:])
+        return ""
+
+    def ip_link_add(self, args):
+        """Handle ip link add"""
+        if args[0] == "name":
+            self.add_link(args[1], "bridge")
+        elif args[0] == "link":
+            self.add_link(args[3], "vlan", id=int(args[7]))
+            self.links[args[3]]["link"] = args[1]
+        elif args[2] == "veth":
+            self.add_link(args[0], "veth")
+            self.add_link(args[5], "veth")
+            self.links[args[0]].update(link=args[5], peer=args[5])
+            self.links[args[5]].update(link=args[0], peer=args[0])
+        elif args[2] == "gretap":
+            self.add_link(args[0], "gretap", local=args[4], remote=args[6],
+                          ikey=f"0.0.0.{args[8]}")
+
+    def ip_link_set(self, args):
+        """Handle ip link set"""
+        if args[1] == "netns":
+            self.links.pop(args[0])
+            peer = self.links[[name for name, link in self.links.items()
+                               if link.get("peer") == args[0]][0]]
+            del peer["link"]
+            self.namespaces[args[2]].add(args[0])
+        elif "isolated" in args:
+            self.links[args[1]]["linkinfo"]["info_slave_data"]["isolated"] = args[-1] == "on"
+        elif "master" in args:
+            self.enslave(args[1], args[3])
+        elif "nomaster" in args:
+            del self.links[args[1]]["master"]
+            del self.links[args[1]]["linkinfo"]["info_slave_data"]
+            self.vids.pop(args[1], None)
+        elif "up" in args:
+            self.links[args[1]]["flags"] = ["BROADCAST", "UP"]
+        elif "vlan_filtering" in args:
+            self.links[args[1]]["linkinfo"]["info_data"]["vlan_filtering"] = 1
+
+    def ip_netns(self, args):
+        """Handle ip netns subcommands"""
+        if not args:
+            return json.dumps([{"name": name} for name in self.namespaces])
+        if args[0] == "add":
+            self.namespaces[args[1]] = set()
+        elif args[0] == "del":
+            for netdev in self.namespaces.pop(args[1]):
+                peer = [name for name, link in self.links.items()
+                        if link.get("peer") == netdev]
+                if peer:
+                    self.del_link(peer[0])
+        elif args[2:4] == ["iw", "phy"]:
+            self.namespaces[args[1]].discard(args[4])
+            self.phys.add(args[4])
+        return ""
+
+    def in_namespace(self, namespace, args):
+        """Handle the commands that are run in every namespace"""
+        if args[0] == "sh":
+            return "\n".join(name for name in sorted(self.namespaces[namespace])
+                             if name.startswith("phy"))
+        return json.dumps([{"ifname": name, "linkinfo": {"info_kind": "veth"},
+                            "link_index": peer["ifindex"]}
+                           for name in self.namespaces[namespace]
+                           for peer in self.links.values() if peer.get("peer") == name])
+
+    def bridge_vlan(self, args):
+        """Handle bridge vlan subcommands"""
+        if not args:
+            entries = [{"ifname": name, "vlans": [{"vlan": vid, "flags": flags}
+                                                  for vid, flags in vids.items()]}
+                       for name, vids in {**self.vids, **self.self_vids}.items()]
+            return json.dumps(entries)
+        table = self.self_vids if "self" in args else self.vids
+        vid = int(args[args.index("vid") + 1])
+        if args[0] == "del":
+            del table[args[2]][vid]
+        elif "pvid" in args:
+            for flags in table[args[2]].values():
+                flags.clear()
+            table[args[2]][vid] = ["PVID", "Egress Untagged"]
+        else:
+            table.setdefault(args[2], {})[vid] = []
+        return ""
+
+    def handle(self, command):
+        """Run a command against the fake state"""
+        self.commands.append(command)
+        if " ".join(command) in self.failing:
+            raise ValueError("injected failure")
+        tool, args = command[0], [arg for arg in command[1:] if arg not in ("-j", "-d")]
+        if tool == changer.IP and args[0] == "link":
+            return self.ip_link(args[1:])
+        if tool == changer.IP and args[0] == "netns":
+            return self.ip_netns(args[1:])
+        if tool == changer.IP and args[0] == "-all":
+            return "".join(f"\nnetns: {namespace}\n{self.in_namespace(namespace, args[3:])}\n"
+                           for namespace in self.namespaces)
+        if tool == changer.BRIDGE:
+            return self.bridge_vlan(args[1:])
+        if tool == changer.IW:
+            self.phys.discard(args[1])
+            self.namespaces[args[5]].add(args[1])
+        return ""
+
+    def install(self, monkeypatch, tmp_path):
+        """Run the changer's commands against this pod, rather than the host"""
+        monkeypatch.setattr(changer, "exec_cmd", self.exec_cmd)
+        monkeypatch.setattr(changer, "run_command", self.run_command)
+        monkeypatch.setattr(changer, "exec_batch", self.exec_batch)
+        monkeypatch.setattr(changer, "get_phys", lambda: sorted(self.phys))
+        monkeypatch.setattr(changer, "APPLIED_CONFIG", str(tmp_path / "applied.json"))
+        monkeypatch.setattr(changer, "JOURNAL", str(tmp_path / "journal.json"))
+        return self
+
+    def exec_cmd(self, command):
+        """Stand in for changer.exec_cmd"""
+        self.processes += 1
+        return self.handle(command)
+
+    def run_command(self, command):
+        """Stand in for changer.run_command"""
+        self.processes += 1
+        try:
+            self.handle(command)
+        except (KeyError, ValueError) as error:
+            return str(error)
+        return None
+
+    def exec_batch(self, _tool, commands):
+        """Stand in for changer.exec_batch"""
+        self.processes += 1
+        for index, command in enumerate(commands):
+            try:
+                self.handle(command)
+            except (KeyError, ValueError) as error:
+                return index, str(error)
+        return None, None
+
+
+def pod_config(pod, config=None):
+    """
+    Generate the example config for a pod
+    """
+    hardware = topology_sim.get_config("example-configs/hardware.yaml")
+    if config is None:
+        config = topology_sim.get_config("example-configs/config.yaml")
+    return topology_sim.gen_config(config, topology_sim.HardwareIndex(hardware))[pod]
+
+
+@pytest.fixture(name="fake_pod")
+def fixture_fake_pod(monkeypatch, tmp_path):
+    """
+    A fake bedroom4 pod that the changer's commands are run against
+    """
+    return FakePod(phys=["phy0", "phy1"]).install(monkeypatch, tmp_path)
+
+
+def apply(conf):
+    """
+    Plan and apply conf, the way changer.main does
+    """
+    plan = changer.plan_changes(conf, changer.read_live_state(
+        conf, changer.load_applied_config()))
+    changer.run_commands(plan.commands())
+    changer.save_applied_config(conf)
+    return plan
+
+
+def test_apply_builds_config(fake_pod):
+    """
+    Applying to a clean pod builds every bridge, veth and namespace
+    """
+    apply(pod_config("bedroom4"))
+    assert fake_pod.links["eth_cable_3"]["linkinfo"]["info_kind"] == "bridge"
+    assert fake_pod.links["lan1"]["master"] == "br-lan"
+    assert fake_pod.vids["lan1"] == {4: ["PVID", "Egress Untagged"]}
+    assert fake_pod.links["veth0"]["master"] == "eth_cable_3"
+    assert fake_pod.links["br-lan.4"]["master"] == "eth_cable_3"
+    assert set(fake_pod.self_vids["br-lan"]) == {1, 2, 3, 4}
+    assert fake_pod.namespaces == {"bedroom4_sim_wired_client": {"veth1"},
+                                   "bedroom_5G": {"phy1"}}
+
+
+@pytest.mark.usefixtures("fake_pod")
+def test_reapply_is_a_noop():
+    """
+    Applying the same config twice changes nothing the second time
+    """
+    apply(pod_config("bedroom4"))
+    assert not apply(pod_config("bedroom4")).changes
+
+
+def test_apply_only_changes_the_difference(fake_pod):
+    """
+    Removing one bridge only touches that bridge's interfaces
+    """
+    apply(pod_config("bedroom4"))
+    config = topology_sim.get_config("example-configs/config.yaml")
+    del config["bridges"]["eth_cable_3"]
+    plan = apply(pod_config("bedroom4", config))
+    assert plan.summary() == ["- namespace bedroom4_sim_wired_client",
+                              "- vlan br-lan.4",
+                              "- bridge eth_cable_3",
+                              "- member lan1 of br-lan",
+                              "- vid 4"]
+    assert "eth_cable_3" not in fake_pod.links
+    assert "veth0" not in fake_pod.links
+    assert "master" not in fake_pod.links["lan1"]
+    assert fake_pod.links["lan2"]["master"] == "br-lan"
+    assert not apply(pod_config("bedroom4", config)).changes
+
+
+def test_unknown_namespace_is_recreated(fake_pod):
+    """
+    Namespaces that this changer didn't create are rebuilt
+    """
+    apply(pod_config("bedroom4"))
+    changer.save_applied_config({**pod_config("bedroom4"), "namespaces": {}})
+    plan = apply(pod_config("bedroom4"))
+    assert "- namespace bedroom_5G" in plan.summary()
+    assert "+ namespace bedroom_5G" in plan.summary()
+    assert fake_pod.namespaces["bedroom_5G"] == {"phy1"}
+    assert fake_pod.namespaces["bedroom4_sim_wired_client"] == {"veth1"}
+
+
+def test_apply_batches_commands(fake_pod):
+    """
+    ip and bridge commands are batched, rather than run one process each
+    """
+    plan = apply(pod_config("bedroom4"))
+    assert len(plan.commands()) > 30
+    # 3 to discover, 2 iw calls that can't be batched and few batches
+    assert fake_pod.processes < 15
+
+
+def test_failed_batch_falls_back_to_single_commands(fake_pod):
+    """
+    A failure part way through a batch doesn't stop the rest from running
+    """
+    conf = pod_config("bedroom4")
+    commands = changer.plan_changes(conf, changer.read_live_state(conf, None)).commands()
+    fake_pod.failing.add(" ".join(changer.add_vlan("br-lan", 2)[0]))
+    failed = changer.failures(changer.run_commands(commands))
+    # the vlan interface's bridge membership fails along with it
+    assert [failure["command"].split() for failure in failed] == \
+        changer.add_vlan("br-lan", 2) + changer.add_bridge_if("eth_cable_1", "br-lan.2")
+    assert fake_pod.links["br-lan.4"]["master"] == "eth_cable_3"
+    assert fake_pod.namespaces["bedroom_5G"] == {"phy1"}
+
+
+def snapshot(fake_pod):
+    """
+    The netdevs, bridge ports, vids and namespaces of a fake pod
+    """
+    return ({name: link.get("master") for name, link in fake_pod.links.items()},
+            json.dumps([fake_pod.vids, fake_pod.self_vids], sort_keys=True),
+            {namespace: set(netdevs) for namespace, netdevs in fake_pod.namespaces.items()})
+
+
+def test_failed_apply_is_rolled_back(fake_pod):
+    """
+    Applying stops at the first failure, and the pod is returned to the
+    last config applied, by undoing only what was changed
+    """
+    conf = pod_config("bedroom4")
+    assert changer.apply_config(conf)["status"] == "ok"
+    before = snapshot(fake_pod)
+
+    config = topology_sim.get_config("example-configs/config.yaml")
+    del config["bridges"]["eth_cable_3"]
+    fake_pod.failing.add(" ".join(changer.del_interface("br-lan.4")[0]))
+    result = changer.apply_config(pod_config("bedroom4", config))
+
+    assert result["status"] == "rolled_back"
+    assert [operation["status"] for operation in result["operations"]] == \
+        ["ok", "failed"] + ["skipped"] * 5
+    assert result["rollback"]["changes"] == ["+ namespace bedroom4_sim_wired_client",
+                                             "+ veth veth0 <-> veth1",
+                                             "+ member veth0 of eth_cable_3",
+                                             "+ port veth1 in bedroom4_sim_wired_client"]
+    assert snapshot(fake_pod) == before
+    assert changer.load_applied_config() == conf
+    assert changer.load_journal() is None
+    assert changer.result_summary(result)["rollback"] == {"status": "ok", "changes": 4,
+                                                          "failed": []}
+    fake_pod.failing.clear()
+    assert not changer.apply_config(conf)["changes"]
+
+
+def test_interrupted_apply_is_recovered(fake_pod):
+    """
+    A pod left part way between configs, when even the rollback failed,
+    is taken to the next config applied, with the namespaces that were
+    touched along the way rebuilt
+    """
+    conf = pod_config("bedroom4")
+    changer.apply_config(conf)
+    config = topology_sim.get_config("example-configs/config.yaml")
+    del config["bridges"]["eth_cable_3"]
+    fake_pod.failing.update([" ".join(changer.del_interface("br-lan.4")[0]),
+                             " ".join(changer.add_veth("veth0", "veth1")[0])])
+    result = changer.apply_config(pod_config("bedroom4", config))
+    assert result["status"] == "failed"
+    assert result["rollback"]["status"] == "failed"
+    # the namespace was removed, and recreated empty by the rollback
+    journal = changer.load_journal()
+    assert [command.split()[1:] for command in journal["done"]] == \
+        [["netns", "del", "bedroom4_sim_wired_client"],
+         ["netns", "add", "bedroom4_sim_wired_client"]]
+    assert fake_pod.namespaces["bedroom4_sim_wired_client"] == set()
+    assert set(changer.journaled_config(journal)["namespaces"]) == {"bedroom_5G"}
+
+    fake_pod.failing.clear()
+    assert changer.apply_config(conf)["status"] == "ok"
+    assert changer.load_journal() is None
+    assert fake_pod.namespaces == {"bedroom4_sim_wired_client": {"veth1"},
+                                   "bedroom_5G": {"phy1"}}
+    assert not changer.apply_config(conf)["changes"]
+
+
+def test_teardown_discovers_in_bulk(fake_pod):
+    """
+    A full apply tears the pod down from one read of its links and one of
+    every namespace's phys, returning the phys before their namespaces go
+    """
+    conf = pod_config("bedroom4")
+    changer.apply_config(conf)
+    fake_pod.processes = 0
+    fake_pod.commands.clear()
+    changer.clean_configuration(conf)
+    assert fake_pod.namespaces == {}
+    assert fake_pod.phys == {"phy0", "phy1"}
+    assert set(fake_pod.links) == {"br-lan", "wan", "mesh0", "lan1", "lan2", "lan3", "lan4"}
+    assert [name for name, link in fake_pod.links.items() if "master" in link] == ["wan"]
+    assert [command[1:] for command in fake_pod.commands if "-all" in command] == \
+        [["-all", "netns", "exec", "sh", "-c", f"ls {changer.PHY_CLASS} 2>/dev/null"]]
+    # the wan bridge's vids, the links, the namespaces, and a batch each for bridge and ip
+    assert fake_pod.processes == 6
+
+
+def test_mesh_tunnels_are_isolated(fake_pod):
+    """
+    Full mesh tunnel ports are isolated, and un-isolated when the layout changes
+    """
+    conf = pod_config("bedroom4")
+    conf["tunnels"] = {"gretap1": {"type": "gretap", "key": 1, "local": "192.168.78.99",
+                                   "remote": "192.168.78.48", "isolated": True}}
+    conf["bridges"]["eth_cable_1"]["virtual_members"].append("gretap1")
+    plan = apply(conf)
+    assert "+ isolated gretap1" in plan.summary()
+    assert fake_pod.links["gretap1"]["linkinfo"]["info_slave_data"]["isolated"]
+    assert not apply(conf).changes
+
+    conf["tunnels"]["gretap1"]["isolated"] = False
+    assert apply(conf).summary() == ["- isolated gretap1"]
+    assert not fake_pod.links["gretap1"]["linkinfo"]["info_slave_data"]["isolated"]
+
+
+def test_profile_counts_commands():
+    """
+    Each spawned command is timed, and counted by its tool and subcommand
+    """
+    changer.Stats.reset()
+    with changer.Stats.phase("discover"):
+        for command in (["/sbin/ip", "-d", "-j", "link", "show"], ["bridge", "-batch", "-"],
+                        ["ip", "netns", "exec", "ns", "iw", "list"], ["ip", "-j", "link"]):
+            with changer.Stats.spawn(command):
+                pass
+    profile = changer.Stats.profile()
+    assert {command_type: count["count"] for command_type, count in profile["counts"].items()} \
+        == {"ip link": 2, "bridge -batch": 1, "ip netns": 1}
+    assert profile["processes"] == 4
+    assert [phase["name"] for phase in profile["phases"]] == ["discover"]
+    assert profile["seconds"] >= profile["phases"][0]["seconds"]
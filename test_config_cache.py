@@ -0,0 +1,53 @@
+"""
+pytest tests for the on disk cache of parsed configs
+"""
+
+import os
+
+import config_cache
+
+
+def test_cache_follows_file_changes(tmp_path, monkeypatch):
+    """
+    Entries are used until the file changes, and survive it being touched
+    """
+    monkeypatch.setattr(config_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    path = tmp_path / "config.yaml"
+    path.write_text("bridges: {}\n", encoding="utf8")
+    builds = []
+
+    def build():
+        builds.append(path.read_text(encoding="utf8"))
+        return {"builds": len(builds)}
+
+    assert config_cache.cached("test", [str(path)], build) == {"builds": 1}
+    assert config_cache.cached("test", [str(path)], build) == {"builds": 1}
+
+    # touched, but the same contents
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert config_cache.cached("test", [str(path)], build) == {"builds": 1}
+
+    path.write_text("bridges: {a: {}}\n", encoding="utf8")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert config_cache.cached("test", [str(path)], build) == {"builds": 2}
+    assert len(builds) == 2
+
+
+def test_unusable_entries_are_rebuilt(tmp_path, monkeypatch):
+    """
+    Corrupt entries, and those from another version, are ignored
+    """
+    monkeypatch.setattr(config_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    path = tmp_path / "hardware.yaml"
+    path.write_text("sites:\n  home: {tunneling_pod: pod1}\n", encoding="utf8")
+
+    assert config_cache.load_config(str(path)) == {"sites": {"home": {"tunneling_pod": "pod1"}}}
+    entry_path = config_cache.entry_path("yaml", [str(path)])
+    with open(entry_path, "wb") as file_handle:
+        file_handle.write(b"not a pickle")
+    assert config_cache.load_entry(entry_path) is None
+    assert config_cache.cached("yaml", [str(path)], lambda: "rebuilt") == "rebuilt"
+
+    monkeypatch.setattr(config_cache, "VERSION", config_cache.VERSION + 1)
+    assert config_cache.cached("yaml", [str(path)], lambda: "new version") == "new version"
@@ -0,0 +1,122 @@
+"""
+pytest tests for pod snapshots and drift detection
+"""
+
+import argparse
+import json
+import os
+
+import pytest
+
+import changer
+import drift
+import topology_sim
+from test_changer import FakePod, pod_config
+
+
+@pytest.fixture(name="fake_pod")
+def fixture_fake_pod(monkeypatch, tmp_path):
+    """
+    A fake bedroom4 pod that the changer's commands are run against
+    """
+    return FakePod(phys=["phy0", "phy1"]).install(monkeypatch, tmp_path)
+
+
+def snapshot(conf):
+    """
+    Snapshot the fake pod, as the controller receives it
+    """
+    return json.loads(json.dumps(changer.serialize_state(changer.snapshot_state(conf))))
+
+
+@pytest.mark.usefixtures("fake_pod")
+def test_applied_config_is_in_sync():
+    """
+    A pod's snapshot, normalised, is its generated config, even once the
+    pod has lost its record of what was applied
+    """
+    conf = pod_config("bedroom4")
+    changer.apply_config(conf)
+    os.remove(changer.APPLIED_CONFIG)
+    live = drift.live_config(snapshot(conf), conf)
+    assert live["namespaces"] == conf["namespaces"]
+    assert live["bridges"]["eth_cable_3"] == {"vid": 4, "physical_members": ["lan1"],
+                                              "virtual_members": ["veth0"]}
+    assert not drift.diff_config(conf, live)
+
+
+def test_drift_is_reported(fake_pod):
+    """
+    Removed, unexpected and changed netdevs are each reported against
+    the bridge, tunnel, veth or namespace they belong to
+    """
+    conf = pod_config("bedroom4")
+    changer.apply_config(conf)
+    fake_pod.del_link("veth0")
+    fake_pod.add_link("gretap9", "gretap", local="192.168.78.99", remote="192.168.78.1",
+                      ikey="0.0.0.9")
+    fake_pod.vids["lan1"] = {2: ["PVID", "Egress Untagged"]}
+    report = drift.diff_config(conf, drift.live_config(snapshot(conf), conf))
+    assert [(entry["kind"], entry["name"], entry["drift"]) for entry in report] == [
+        ("bridge", "eth_cable_1", "differs"),
+        ("bridge", "eth_cable_3", "differs"),
+        ("tunnel", "gretap9", "unexpected"),
+        ("veth", "veth0", "missing"),
+        ("namespace", "bedroom4_sim_wired_client", "differs"),
+    ]
+    assert drift.describe_drift(report[1]) == \
+        "bridge eth_cable_3: physical_members intended ['lan1'], live [], " \
+        "virtual_members intended ['veth0'], live []"
+    assert drift.describe_drift(report[4]) == \
+        "namespace bedroom4_sim_wired_client: contents unknown"
+
+
+def test_apply_plans_from_snapshot(fake_pod):
+    """
+    An apply given a snapshot makes the same changes, without reading the pod's state
+    """
+    conf = pod_config("bedroom4")
+    changer.apply_config(conf)
+    config = topology_sim.get_config("example-configs/config.yaml")
+    del config["bridges"]["eth_cable_3"]
+    target = pod_config("bedroom4", config)
+    state = snapshot(conf)
+    planned = changer.plan_changes(target, changer.read_live_state(
+        target, changer.load_applied_config())).summary()
+
+    fake_pod.commands.clear()
+    result = changer.apply_config(target, live_state=state)
+    assert result["status"] == "ok"
+    assert result["changes"] == planned
+    assert not [command for command in fake_pod.commands if command[-2:] == ["link", "show"]]
+    assert not changer.apply_config(target)["changes"]
+
+
+def test_snapshots_are_recorded_and_reused(tmp_path, monkeypatch):
+    """
+    status records a snapshot per readable pod, which create plans from
+    until it's too old, or the pod is applied
+    """
+    monkeypatch.chdir(tmp_path)
+    hardware = topology_sim.get_config(os.path.join(os.path.dirname(__file__),
+                                                    "example-configs/hardware.yaml"))
+    index = topology_sim.HardwareIndex(hardware)
+    generated = {"bedroom4": {"pod": "bedroom4"}, "office1": {"pod": "office1"}}
+    monkeypatch.setattr(drift, "fetch_states", lambda *_: {
+        "bedroom4": {"state": "state of bedroom4"}, "office1": {"error": "timed out"}})
+    monkeypatch.setattr(drift, "diff_config", lambda *_: [])
+    monkeypatch.setattr(drift, "live_config", lambda *_: None)
+    report = drift.check(index, generated, argparse.Namespace())
+    assert [(result["pod"], result["status"]) for result in report] == \
+        [("bedroom4", "in_sync"), ("office1", "error")]
+    assert drift.format_report(report).splitlines()[1] == \
+        f"pod: office1, host: {index.pod_host('office1')} unreadable: timed out"
+
+    payloads = {"bedroom4": {}, "office1": {}}
+    drift.attach_snapshots(payloads, 60)
+    assert payloads == {"bedroom4": {"live_state": "state of bedroom4"}, "office1": {}}
+    payloads = {"bedroom4": {}}
+    drift.attach_snapshots(payloads, 60, now=drift.time.time() + 61)
+    assert payloads == {"bedroom4": {}}
+    drift.forget_snapshots(["bedroom4"])
+    assert drift.load_snapshots() == {}
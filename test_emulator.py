@@ -0,0 +1,91 @@
+"""
+pytest tests for the namespace based pod emulator
+"""
+
+import emulator
+import topology_sim
+import transport
+
+
+def emulate(tmp_path):
+    """
+    Build the example hardware's emulated fabric, recording the commands
+    rather than running them
+    """
+    commands = []
+
+    def runner(command, stdin=None):
+        commands.append((command, stdin.decode("utf8").splitlines() if stdin else []))
+        return ""
+
+    hardware = topology_sim.get_config("example-configs/hardware.yaml")
+    emulator.Emulator(hardware, run_dir=str(tmp_path), runner=runner).up()
+    return [(" ".join(command), lines) for command, lines in commands]
+
+
+def batch_lines(commands, command):
+    """
+    Returns the batch input of every run of command
+    """
+    return [line for run, lines in commands if run == command for line in lines]
+
+
+def test_emulated_pods(tmp_path):
+    """
+    Each pod gets its namespaces, a veth per port, and its wan bridge
+    """
+    commands = emulate(tmp_path)
+    host = batch_lines(commands, "ip -batch -")
+    assert "netns add tsim-fabric" in host
+    assert "netns add tsim-bedroom4" in host
+    assert "link add wl0-ap0 netns tsim-office1 type veth peer name p6-6 " \
+        "netns tsim-fabric" in host
+    assert any(command.startswith("unshare --mount=" + str(tmp_path / "office1.mnt"))
+               for command, _ in commands)
+
+    office1 = batch_lines(commands, "ip -n tsim-office1 -batch -")
+    assert "link add name br-lan type bridge vlan_filtering 1" in office1
+    assert "link set dev mesh0 master br-lan" in office1
+    assert "address add 192.168.78.98/32 dev br-lan" in office1
+
+
+def test_emulated_fabric(tmp_path):
+    """
+    One trunk port per pod joins the site's switch, and mesh ports join the mesh
+    """
+    fabric = batch_lines(emulate(tmp_path), "ip -n tsim-fabric -batch -")
+    # bedroom1 is pod 0, bedroom4 is pod 3, sites are numbered by name,
+    # and ports by their sorted names, ie. lan1-lan4, mesh0, wan
+    assert "link set dev p0-5 master site0" in fabric
+    assert not [line for line in fabric if line.startswith("link set dev p0-1 master")]
+    assert "link set dev p0-4 master mesh" in fabric
+    assert "link set dev p3-4 master site0" in fabric
+    assert "link set dev p3-0 up" in fabric
+
+
+def test_fabric_ports_dont_collide(tmp_path):
+    """
+    Ports whose names only differ past the 15 character limit still get
+    fabric ends of their own
+    """
+    hardware = topology_sim.get_config("example-configs/hardware.yaml")
+    pod_info = hardware["sites"]["bedroom"]["pods"]["bedroom1"]
+    pod_info["ethernet"] = {"lan-longname-a1": {}, "lan-longname-a2": {}}
+    batches = []
+    emulator.Emulator(hardware, run_dir=str(tmp_path),
+                      runner=lambda command, stdin=None: batches.append(stdin or b"") or "").up()
+    ends = [line.split()[-3] for batch in batches for line in batch.decode("utf8").splitlines()
+            if " type veth " in line]
+    assert len(ends) == len(set(ends))
+    assert all(len(end) <= 15 for end in ends)
+
+
+def test_netns_transport():
+    """
+    Commands for a pod's host are run inside its emulated namespaces
+    """
+    index = topology_sim.HardwareIndex(topology_sim.get_config("example-configs/hardware.yaml"))
+    netns = transport.NetnsTransport(index, run_dir="/run/test")
+    assert netns.command("192.168.78.98", "true") == [
+        "nsenter", "--mount=/run/test/office1.mnt", "--net=/run/netns/tsim-office1",
+        "sh", "-c", "true"]
@@ -0,0 +1,114 @@
+"""
+pytest tests for fabric health checks, against local listeners and a stand-in ping
+"""
+
+import asyncio
+import socket
+import time
+
+import health
+
+IPUTILS = """PING 10.0.0.1 (10.0.0.1) 56(84) bytes of data.
+
+--- 10.0.0.1 ping statistics ---
+3 packets transmitted, 2 received, 33.3333% packet loss, time 401ms
+rtt min/avg/max/mdev = 0.041/0.052/0.063/0.011 ms
+"""
+
+BUSYBOX = """PING 10.0.0.1 (10.0.0.1): 56 data bytes
+
+--- 10.0.0.1 ping statistics ---
+3 packets transmitted, 3 packets received, 0% packet loss
+round-trip min/avg/max = 0.101/0.202/0.303 ms
+"""
+
+
+def test_parse_ping():
+    """
+    Loss and average rtt are read from iputils and busybox ping
+    """
+    assert health.parse_ping(IPUTILS) == (33.3333, 0.052)
+    assert health.parse_ping(BUSYBOX) == (0.0, 0.202)
+    assert health.parse_ping("3 packets transmitted, 0 received, 100% packet loss") == \
+        (100.0, None)
+
+
+def closed_port():
+    """
+    A local port that nothing is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_check_probes_concurrently(monkeypatch):
+    """
+    Reachable and unreachable targets are reported within one timeout window,
+    and tunnels are pinged from their remote end
+    """
+    def ping_command(host, options):  # pylint: disable=unused-argument
+        if host == "10.0.0.2":
+            return ["sleep", "10"]
+        return ["echo", "0%", "packet", "loss,", "min/avg/max", "=", "0.1/0.2/0.3", "ms"]
+
+    monkeypatch.setattr(health, "ping_command", ping_command)
+    remote = []
+
+    async def run():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(),
+                                            "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        targets = [
+            {"kind": "pod", "name": "up", "host": "127.0.0.1", "port": port, "remote": None},
+            {"kind": "pod", "name": "closed", "host": "127.0.0.1", "port": closed_port(),
+             "remote": None},
+            {"kind": "tunnel", "name": "a -> b", "host": "10.0.0.2", "port": None,
+             "remote": "10.0.0.1"},
+            {"kind": "tunnel", "name": "a -> c", "host": "10.0.0.3", "port": None,
+             "remote": "10.0.0.1"}]
+        results = await health.check_all(
+            targets, lambda host, command: remote.append(host) or ["sh", "-c", command],
+            health.HealthOptions(timeout=1))
+        server.close()
+        return results
+
+    start = time.monotonic()
+    results = asyncio.run(run())
+    assert time.monotonic() - start < 3
+    assert [result["ok"] for result in results] == [True, False, False, True]
+    assert results[0]["rtt_ms"] == 0.2
+    assert results[1]["error"].startswith("tcp: ")
+    assert results[2]["error"] == "icmp: timed out after 2s"
+    assert remote == ["10.0.0.1", "10.0.0.1"]
+    assert "a -> c" in health.format_results(results)
+
+
+def test_every_target_is_probed_at_once(monkeypatch):
+    """
+    However many targets there are, every probe is in flight at once,
+    rather than in rounds, so that they all finish within one timeout
+    """
+    targets = [{"kind": "tunnel", "name": f"pod{number}", "host": f"10.0.{number}.1",
+                "port": None, "remote": None} for number in range(150)]
+    in_flight = []
+    most = []
+    # created within the loop that check runs, as python 3.8's events bind to one
+    everyone = []
+
+    async def icmp_probe(_command, _timeout):
+        if not everyone:
+            everyone.append(asyncio.Event())
+        in_flight.append(None)
+        most.append(len(in_flight))
+        if len(in_flight) == len(targets):
+            everyone[0].set()
+        # a probe only finishes once every other one has started
+        await asyncio.wait_for(everyone[0].wait(), 5)
+        in_flight.pop()
+        return 0.0, 0.1
+
+    monkeypatch.setattr(health, "icmp_probe", icmp_probe)
+    results = health.check(targets, None, health.HealthOptions(timeout=1))
+    assert max(most) == len(targets)
+    assert all(result["ok"] for result in results)
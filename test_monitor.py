@@ -0,0 +1,140 @@
+"""
+pytest tests for the GRE tunnel monitor, against a fake sysfs and stand-in pods
+"""
+
+import json
+import os
+import sys
+import urllib.request
+
+import pytest
+
+import changer
+import monitor
+import topology_sim
+import transport
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), "example-configs")
+
+
+def counters(rx_bytes, tx_bytes, dropped=0):
+    """
+    A tunnel's counters
+    """
+    return {**{counter: 0 for counter in monitor.COUNTERS},
+            "rx_bytes": rx_bytes, "tx_bytes": tx_bytes, "tx_dropped": dropped}
+
+
+def test_ring_buffer_keeps_the_latest_entries():
+    """
+    Once full, the oldest entries are overwritten
+    """
+    buffer = monitor.RingBuffer(3, 2)
+    for value in range(5):
+        buffer.append([value, value * 10])
+    assert buffer.entries() == [(2, 20), (3, 30), (4, 40)]
+
+
+def test_sample_reads_tunnel_counters(tmp_path, monkeypatch):
+    """
+    Each applied tunnel's counters are read from sysfs, labelled with its bridge,
+    and tunnels that don't exist are left out
+    """
+    statistics = tmp_path / "net" / "gretap1" / "statistics"
+    statistics.mkdir(parents=True)
+    for counter, value in counters(1000, 2000).items():
+        (statistics / counter).write_text(f"{value}\n")
+    applied = tmp_path / "applied.json"
+    applied.write_text(json.dumps({
+        "bridges": {"eth_cable_1": {"virtual_members": ["veth0", "gretap1", "gretap2"]}},
+        "tunnels": {"gretap1": {"remote": "10.0.0.2"}, "gretap2": {"remote": "10.0.0.3"}}}))
+    monkeypatch.setattr(monitor, "SYS_CLASS_NET", str(tmp_path / "net"))
+    monkeypatch.setattr(monitor, "ping_all", lambda remotes: {remote: 0.5 for remote in remotes})
+    tunnels = monitor.sample(str(applied))["tunnels"]
+    assert list(tunnels) == ["gretap1"]
+    assert tunnels["gretap1"] == {"bridge": "eth_cable_1", "remote": "10.0.0.2",
+                                  "rtt_ms": 0.5, **counters(1000, 2000)}
+
+
+def pod_sample(time, rx_bytes, tx_bytes, rtt_ms=1.0, dropped=0):
+    """
+    A sample from a pod with a single tunnel
+    """
+    return {"time": time, "tunnels": {"gretap1": {
+        "bridge": "eth_cable_1", "remote": "10.0.0.2", "rtt_ms": rtt_ms,
+        **counters(rx_bytes, tx_bytes, dropped)}}}
+
+
+def test_bridge_throughput_and_loss():
+    """
+    Throughput allows for counter resets, and unanswered pings count as loss
+    """
+    mon = monitor.Monitor(capacity=4, window=60)
+    mon.add_sample("garage1", pod_sample(100, 0, 0))
+    mon.add_sample("garage1", pod_sample(110, 1000, 5000, rtt_ms=None, dropped=2))
+    # the tunnel was recreated
+    mon.add_sample("garage1", pod_sample(120, 500, 1000, dropped=3))
+    mon.add_sample("office1", pod_sample(120, 0, 0))
+    stats = mon.tunnels()[("garage1", "gretap1")]
+    assert stats["rx_bps"] == 1500 * 8 / 20
+    assert stats["tx_bps"] == 6000 * 8 / 20
+    assert stats["dropped"] == 3
+    assert stats["loss"] == 1 / 3
+    assert mon.bridges()["eth_cable_1"]["tunnels"] == 2
+
+    metrics = mon.prometheus()
+    assert 'topology_sim_tunnel_tx_bits_per_second{pod="garage1",tunnel="gretap1",' \
+        'bridge="eth_cable_1",remote="10.0.0.2"} 2400' in metrics
+    assert 'topology_sim_bridge_bits_per_second{bridge="eth_cable_1"} 2400' in metrics
+
+
+def test_run_streams_pods_to_metrics(tmp_path):
+    """
+    Samples printed by each pod's sampler are recorded, copied to the output,
+    and served as metrics
+    """
+    samples = [pod_sample(100, 0, 0), pod_sample(101, 100, 200)]
+    script = "import json, sys; print('\\n'.join(json.dumps(s) for s in json.loads(sys.argv[1])))"
+    commands = {pod: [sys.executable, "-c", script, json.dumps(samples)]
+                for pod in ("garage1", "office1")}
+    output = tmp_path / "samples.jsonl"
+    mon = monitor.run(commands, monitor.MonitorOptions(output=str(output), duration=10))
+    assert len(output.read_text().splitlines()) == 4
+    server = monitor.serve_metrics(mon, 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            metrics = response.read().decode("utf8")
+    finally:
+        server.shutdown()
+    assert 'topology_sim_bridge_bits_per_second{bridge="eth_cable_1"} 3200' in metrics
+
+
+def test_monitor_needs_a_sink(capsys):
+    """
+    monitor is refused unless its samples have somewhere to go
+    """
+    with pytest.raises(SystemExit):
+        topology_sim.get_args(["monitor"])
+    assert "--metrics-port" in capsys.readouterr().err
+    assert topology_sim.get_args(["monitor", "--monitor-output", "-"]).monitor_output == "-"
+
+
+def test_monitor_is_deployed_alone(monkeypatch):
+    """
+    Only monitor.py is pushed to the tunneling pods, and it's told where the
+    changer records the config it applied
+    """
+    pushed = []
+    runs = []
+    monkeypatch.setattr(transport.SSHTransport, "push_if_changed",
+                        lambda _ssh, host, local_path, *_: pushed.append((host, local_path)))
+    monkeypatch.setattr(monitor, "run", lambda commands, _options: runs.append(commands))
+    index = topology_sim.HardwareIndex(topology_sim.get_config(f"{EXAMPLES}/hardware.yaml"))
+    topology_sim.do_monitor(index, topology_sim.get_args(["monitor", "--monitor-output", "-"]))
+    tunneling_pods = sorted(set(index.site_to_tunneling_pod.values()))
+    assert sorted(pushed) == sorted((index.pod_host(pod), "monitor.py")
+                                    for pod in tunneling_pods)
+    assert sorted(runs[0]) == tunneling_pods
+    assert all(command[-1].endswith(f"--applied-config {changer.APPLIED_CONFIG}")
+               for command in runs[0].values())
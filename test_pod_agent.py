@@ -0,0 +1,217 @@
+"""
+pytest tests for the pod agent and the controller's agent client
+"""
+
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import changer
+import configure
+import pod_agent
+import pod_state
+import podlog
+import profiler
+import topology_sim
+import transport
+from test_changer import FakePod, pod_config
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), "example-configs")
+
+
+@pytest.fixture(name="agent")
+def fixture_agent(monkeypatch, tmp_path):
+    """
+    A local stand-in agent for a fake pod, listening on a unix socket
+    """
+    pod = FakePod(phys=["phy0", "phy1"]).install(monkeypatch, tmp_path)
+    address = f"unix:{tmp_path / 'agent.sock'}"
+    server = pod_agent.make_server(address)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield address, pod
+    server.shutdown()
+    server.server_close()
+
+
+def test_agent_apply(agent):
+    """
+    A config applied through the agent reports each operation and the final state
+    """
+    address, pod = agent
+    client = transport.AgentClient(address)
+    assert client.request({"op": "ping"})["status"] == "ok"
+    response = client.request({"op": "apply", "config": pod_config("bedroom4")})
+    assert response["status"] == "ok"
+    assert "+ bridge eth_cable_3" in response["changes"]
+    assert all(operation["status"] == "ok" for operation in response["operations"])
+    assert [phase["name"] for phase in response["phases"]] == ["discover", "plan", "apply"]
+    assert response["state"]["members"]["eth_cable_3"] == ["br-lan.4", "veth0"]
+    assert pod.links["eth_cable_3"]["linkinfo"]["info_kind"] == "bridge"
+
+    # the same connection is reused for the next request
+    response = client.request({"op": "apply", "config": pod_config("bedroom4")})
+    assert response["changes"] == []
+    client.close()
+
+
+def test_agent_pool(agent):
+    """
+    The pool reports unreachable agents as errors, rather than raising
+    """
+    address, _ = agent
+    hardware = topology_sim.get_config("example-configs/hardware.yaml")
+    pods = hardware["sites"]["bedroom"]["pods"]
+    pods["bedroom4"]["agent"] = address
+    pods["bedroom3"]["agent"] = address + ".missing"
+    index = topology_sim.HardwareIndex(hardware)
+    pool = transport.AgentPool(index)
+    responses = pool.request_all({"bedroom4": {"op": "apply", "config": pod_config("bedroom4")},
+                                  "bedroom3": {"op": "ping"}})
+    pool.close()
+    assert responses["bedroom4"]["status"] == "ok"
+    assert responses["bedroom3"]["status"] == "error"
+
+
+def test_agent_token(agent, monkeypatch):
+    """
+    Requests without the agent's token are refused
+    """
+    monkeypatch.setattr(pod_agent.AgentState, "token", "secret")
+    address, _ = agent
+    assert transport.AgentClient(address).request({"op": "ping"})["status"] == "error"
+    assert transport.AgentClient(address, "secret").request({"op": "ping"})["status"] == "ok"
+
+
+def test_controller_sends_agent_token(agent, monkeypatch, tmp_path):
+    """
+    Pods are configured with the controller's --agent-token, or their own
+    agent_token from the hardware config
+    """
+    monkeypatch.setattr(pod_agent.AgentState, "token", "secret")
+    address, _ = agent
+    hardware = topology_sim.get_config(f"{EXAMPLES}/hardware.yaml")
+    pods = hardware["sites"]["bedroom"]["pods"]
+    pods["bedroom3"]["agent"] = pods["bedroom4"]["agent"] = address
+    pods["bedroom3"]["agent_token"] = "stale"
+    index = topology_sim.HardwareIndex(hardware)
+    args = topology_sim.get_args(["create", "--transport", "agent", "--agent-token", "secret"])
+    args.profiler = profiler.Profiler()
+    args.changer_hash = pod_agent.AgentState.changer_hash
+    args.pod_log = podlog.PodLog(str(tmp_path / "pods.jsonl"), live=False)
+    payloads = {pod: {"config": pod_config(pod)} for pod in ["bedroom3", "bedroom4"]}
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("logs")
+    results = configure.apply_payloads(index, payloads, args)
+    assert results["bedroom4"]["status"] == "ok"
+    assert results["bedroom3"]["error"] == "invalid token"
+
+
+def test_agent_reached_at_its_default_address(monkeypatch, tmp_path):
+    """
+    An agent started with --listen tcp:<port> and --token is reached at the
+    controller's default address, the port on the pod's host, with
+    --agent-token
+    """
+    pod = FakePod(phys=["phy0", "phy1"]).install(monkeypatch, tmp_path)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(pod_agent, "DEFAULT_PORT", port)
+    monkeypatch.setattr(pod_agent.AgentState, "token", None)
+    server = pod_agent.make_agent(pod_agent.get_args(["--listen", f"tcp:{port}",
+                                                      "--token", "secret"]))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    hardware = topology_sim.get_config(f"{EXAMPLES}/hardware.yaml")
+    hardware["sites"]["bedroom"]["pods"]["bedroom4"]["host"] = "127.0.0.1"
+    index = topology_sim.HardwareIndex(hardware)
+    payloads = {"bedroom4": {"config": pod_config("bedroom4")}}
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("logs")
+    try:
+        for token, status in [("wrong", "error"), ("secret", "ok")]:
+            args = topology_sim.get_args(["create", "--transport", "agent",
+                                          "--agent-token", token])
+            args.profiler = profiler.Profiler()
+            args.changer_hash = pod_agent.AgentState.changer_hash
+            args.pod_log = podlog.PodLog(str(tmp_path / "pods.jsonl"), live=False)
+            assert configure.apply_payloads(index, payloads, args)["bedroom4"]["status"] == \
+                status
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert pod.links["eth_cable_3"]["linkinfo"]["info_kind"] == "bridge"
+
+
+def test_agent_listens_on_loopback(monkeypatch):
+    """
+    The agent only listens beyond the pod itself when it has a token
+    """
+    assert pod_agent.get_args([]).listen == "tcp:127.0.0.1:7070"
+    assert pod_agent.get_args(["--listen", "unix:/tmp/agent.sock"]).token is None
+    assert pod_agent.get_args(["--listen", "tcp:7070", "--token", "secret"]).token == "secret"
+    for listen in ["tcp:7070", "tcp:0.0.0.0:7070", "tcp:192.168.78.2:7070"]:
+        with pytest.raises(SystemExit):
+            pod_agent.get_args(["--listen", listen])
+    monkeypatch.setattr(pod_agent.AgentState, "token", "secret")
+    assert pod_agent.valid_token("secret")
+    assert not any(map(pod_agent.valid_token, ["secre", "sécret", None, 1]))
+
+
+def test_stale_agents_refuse_to_apply(agent):
+    """
+    An agent whose changer.py isn't the controller's refuses to apply,
+    rather than applying the config with a different changer
+    """
+    address, pod = agent
+    client = transport.AgentClient(address)
+    current = client.request({"op": "ping"})["changer_hash"]
+    assert current == pod_state.file_hash(changer.__file__)
+    response = client.request({"op": "apply", "config": pod_config("bedroom4"),
+                               "changer_hash": "0" * 64})
+    assert response["status"] == "error"
+    assert response["error"].startswith(f"stale agent: it runs changer.py {current[:12]}")
+    assert "eth_cable_3" not in pod.links
+    response = client.request({"op": "apply", "config": pod_config("bedroom4"),
+                               "changer_hash": current})
+    assert response["status"] == "ok"
+    client.close()
+
+
+def test_agent_pool_limits(tmp_path, monkeypatch):
+    """
+    The pool sends up to workers requests at once, and an agent that doesn't
+    answer within the timeout is reported as an error
+    """
+    hardware = topology_sim.get_config(f"{EXAMPLES}/hardware.yaml")
+    silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    silent.bind(str(tmp_path / "silent.sock"))
+    # connections are queued by the kernel, but never answered
+    silent.listen(8)
+    for pod_info in hardware["sites"]["bedroom"]["pods"].values():
+        pod_info["agent"] = f"unix:{tmp_path / 'silent.sock'}"
+    index = topology_sim.HardwareIndex(hardware)
+    pool = transport.AgentPool(index, timeout=0.5, workers=4)
+    start = time.monotonic()
+    responses = pool.request_all({pod: {"op": "ping"} for pod in ["bedroom1", "bedroom2"]})
+    pool.close()
+    silent.close()
+    assert time.monotonic() - start < 2
+    assert all("timed out" in response["error"] for response in responses.values())
+
+    in_flight = []
+    most = []
+
+    def request(_pod, _request):
+        in_flight.append(None)
+        most.append(len(in_flight))
+        time.sleep(0.05)
+        in_flight.pop()
+        return {"status": "ok"}
+
+    monkeypatch.setattr(pool, "request", request)
+    pool.request_all({pod: {"op": "ping"} for pod in index.pods})
+    assert len(index.pods) > 4 and max(most) == 4
@@ -0,0 +1,61 @@
+"""
+pytest tests for streaming pods' output into the pod log
+"""
+
+import io
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+import podlog
+import transport
+
+
+def test_output_is_streamed_as_it_happens():
+    """
+    Each line is passed on as soon as it's output, rather than when the
+    command exits, and a command that overruns is killed
+    """
+    seen = []
+    start = time.monotonic()
+    script = "import sys, time\n" \
+        "print(len(sys.stdin.read()), flush=True)\n" \
+        "time.sleep(0.3)\n" \
+        "sys.stderr.write('failed\\npartial')\n"
+    proc = transport.run_streaming([sys.executable, "-c", script], b"x" * 200000, 5,
+                                   lambda *line: seen.append((*line, time.monotonic() - start)))
+    assert proc.stdout == b"200000\n" and proc.stderr == b"failed\npartial"
+    assert [line[:2] for line in seen] == [("stdout", "200000"), ("stderr", "failed"),
+                                           ("stderr", "partial")]
+    assert seen[0][2] < 0.25 <= seen[1][2]
+    with pytest.raises(subprocess.TimeoutExpired):
+        transport.run_streaming(["sleep", "5"], b"", 0.2, print)
+    assert time.monotonic() - start < 2
+
+
+def test_log_is_tagged_and_rotated(tmp_path):
+    """
+    Lines are logged as JSON tagged with their pod and phase, the log is
+    rotated once it's too big, and progress is drawn on the live stream
+    """
+    path = tmp_path / "pods.jsonl"
+    live = io.StringIO()
+    pod_log = podlog.PodLog(str(path), max_bytes=2000, backups=2, live=live)
+    pod_log.begin(["pod1", "pod2"])
+    pod_log.phase("pod1", "run changer")
+    pod_log.line("pod1", "stdout", "no changes")
+    assert pod_log.progress().startswith("0/2 pods finished: 1 run changer, 1 waiting")
+    pod_log.done("pod1", True, "pod: pod1 done")
+    assert "1/2 pods finished: 1 waiting" in live.getvalue()
+    for number in range(40):
+        pod_log.line("pod2", "stderr", f"line {number}")
+    pod_log.end()
+    pod_log.close()
+    assert (tmp_path / "pods.jsonl.1").exists() and not (tmp_path / "pods.jsonl.3").exists()
+    entries = [json.loads(line) for line in path.read_text(encoding="utf8").splitlines()]
+    assert entries[-1]["line"] == "line 39"
+    assert {key for entry in entries for key in entry} == {"t", "pod", "phase", "stream", "line"}
+    assert entries[-1]["t"] >= entries[0]["t"]
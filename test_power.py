@@ -0,0 +1,143 @@
+"""
+pytest tests for smart plug power control, against local stand-in plugs
+"""
+
+import asyncio
+import json
+import struct
+
+import power
+
+
+class StandInPlugs:
+    """
+    Local tasmota (http) and tp-link (smart home protocol) plugs
+    """
+    def __init__(self, delay=0):
+        self.relays = {}
+        self.requests = []
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.servers = []
+
+    async def start(self, name, kind, state="off"):
+        """Start a plug, returning its power config"""
+        self.relays[name] = state
+        handler = self.tasmota if kind == "tasmota" else self.tp_link
+
+        async def serve(reader, writer):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(self.delay)
+                await handler(name, reader, writer)
+            finally:
+                self.in_flight -= 1
+                writer.close()
+
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        self.servers.append(server)
+        return {"host": "127.0.0.1", "type": kind, "port": server.sockets[0].getsockname()[1]}
+
+    async def tasmota(self, name, reader, writer):
+        """Answer a tasmota http command"""
+        command = (await reader.readuntil(b"\r\n\r\n")).split()[1].decode()
+        self.requests.append((name, command))
+        if command.lower().endswith(("%20on", "%20off")):
+            self.relays[name] = command.rpartition("%20")[2].lower()
+        body = json.dumps({"POWER": self.relays[name].upper()}).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n" + body)
+
+    async def tp_link(self, name, reader, writer):
+        """Answer a tp-link smart home protocol request"""
+        length = struct.unpack(">I", await reader.readexactly(4))[0]
+        request = json.loads(power.tp_link_decrypt(await reader.readexactly(length)))
+        self.requests.append((name, request))
+        if "set_relay_state" in request["system"]:
+            self.relays[name] = "on" if request["system"]["set_relay_state"]["state"] else "off"
+            response = {"system": {"set_relay_state": {"err_code": 0}}}
+        else:
+            response = {"system": {"get_sysinfo": {
+                "relay_state": int(self.relays[name] == "on"), "err_code": 0}}}
+        writer.write(power.tp_link_encrypt(json.dumps(response).encode()))
+
+    def close(self):
+        """Stop every plug"""
+        for server in self.servers:
+            server.close()
+
+
+def run_plugs(plugs, kinds, targets, options=None):
+    """
+    Start stand-in plugs of kinds, then set them to targets
+    """
+    async def run():
+        power_config = {name: await plugs.start(name, kind, state)
+                        for name, (kind, state) in kinds.items()}
+        try:
+            return await power.set_power_all(targets, power_config, options)
+        finally:
+            plugs.close()
+    return asyncio.run(run())
+
+
+def test_tp_link_protocol_round_trip():
+    """
+    The tp-link autokey cipher decrypts what it encrypts
+    """
+    request = b'{"system":{"get_sysinfo":{}}}'
+    encrypted = power.tp_link_encrypt(request)
+    assert struct.unpack(">I", encrypted[:4])[0] == len(request)
+    assert power.tp_link_decrypt(encrypted[4:]) == request
+
+
+def test_plugs_are_switched_or_skipped():
+    """
+    Plugs already in the target state are queried but not switched
+    """
+    plugs = StandInPlugs()
+    results = run_plugs(plugs, {"a": ("tasmota", "off"), "b": ("tasmota", "on"),
+                                "c": ("tp-link", "off"), "d": ("tp-link", "on")},
+                        {"a": "on", "b": "on", "c": "on", "d": "off"})
+    assert [result["result"] for result in results] == \
+        ["switched", "skipped", "switched", "switched"]
+    assert plugs.relays == {"a": "on", "b": "on", "c": "on", "d": "off"}
+    assert [command for name, command in plugs.requests if name == "b"] == ["/cm?cmnd=Power"]
+    assert "RESULT" in power.format_results(results).splitlines()[0]
+
+
+def test_requests_in_flight_are_bounded():
+    """
+    No more than concurrency plugs are talked to at once
+    """
+    plugs = StandInPlugs(delay=0.05)
+    kinds = {f"dut{index}": ("tasmota", "off") for index in range(8)}
+    results = run_plugs(plugs, kinds, {name: "on" for name in kinds},
+                        power.PowerOptions(concurrency=3))
+    assert all(result["result"] == "switched" for result in results)
+    assert plugs.max_in_flight == 3
+
+
+def test_unreachable_plug_is_retried_then_fails():
+    """
+    A plug that doesn't answer fails after its retries, without holding up the rest
+    """
+    plugs = StandInPlugs()
+
+    async def run():
+        power_config = {"up": await plugs.start("up", "tasmota"),
+                        "down": {"host": "127.0.0.1", "type": "tp-link", "port": 1},
+                        "odd": {"host": "127.0.0.1", "type": "x10"}}
+        try:
+            return await power.set_power_all(
+                {"down": "on", "up": "on", "odd": "on"}, power_config,
+                power.PowerOptions(timeout=0.5, retries=2))
+        finally:
+            plugs.close()
+
+    down, up, odd = asyncio.run(run())
+    assert (down["result"], down["attempts"]) == ("failed", 3)
+    assert down["error"]
+    assert up["result"] == "switched"
+    assert (odd["result"], odd["attempts"]) == ("failed", 0)
@@ -0,0 +1,40 @@
+"""
+Tests for merging controller and changer timings into a Chrome trace
+"""
+
+import json
+
+import profiler
+
+
+def test_chrome_trace_merges_changer_profiles():
+    """
+    A changer's phases and commands land on its pod's track, within the
+    span that ran it, and are summarized along with the controller's phases
+    """
+    prof = profiler.Profiler()
+    with prof.span(profiler.CONTROLLER, "apply"):
+        with prof.span("pod1", "configure"):
+            pass
+    finished = prof.start + 2
+    profile = {"seconds": 1.5, "processes": 1,
+               "phases": [{"name": "plan", "start": 0.5, "seconds": 0.25, "processes": 1}],
+               "commands": [{"type": "ip link", "start": 0.5, "seconds": 0.1}],
+               "counts": {"ip link": {"count": 1, "seconds": 0.1}}}
+    prof.add_changer_output("pod1", finished, b"no changes\nprofile: " +
+                            json.dumps(profile).encode("utf8") + b"\n")
+    prof.add_changer_output("pod2", finished, b"no changes\n")
+
+    trace = prof.chrome_trace()
+    threads = {event["args"]["name"]: event["tid"] for event in trace["traceEvents"]
+               if event["ph"] == "M"}
+    assert list(threads) == ["controller", "pod1"]
+    command = [event for event in trace["traceEvents"] if event["name"] == "ip link"][0]
+    assert command["tid"] == threads["pod1"]
+    assert command["ts"] == 1000000 and command["dur"] == 100000
+
+    summary = trace["summary"]
+    assert {phase["name"] for phase in summary["phases"]} == {"apply", "changer plan"}
+    assert [pod["pod"] for pod in summary["pods"]] == ["pod1"]
+    assert summary["commands"] == [{"type": "ip link", "count": 1, "seconds": 0.1}]
+    assert "slowest pods:" in profiler.format_summary(summary)
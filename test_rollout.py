@@ -0,0 +1,69 @@
+"""
+pytest tests for rolling configs out in waves
+"""
+
+import argparse
+import os
+
+import profiler
+import rollout
+import topology_sim
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), "example-configs")
+
+
+def example_index():
+    """
+    Index the example hardware config
+    """
+    return topology_sim.HardwareIndex(topology_sim.get_config(f"{EXAMPLES}/hardware.yaml"))
+
+
+def test_leaves_go_before_their_uplinks():
+    """
+    Every site's leaves are applied at once, then the pods carrying their
+    traffic, with the tunneling pods last
+    """
+    hardware = topology_sim.get_config(f"{EXAMPLES}/hardware.yaml")
+    # a transit pod, meshed to the tunneling pod, that isn't the tunneling pod
+    hardware["sites"]["garage"]["pods"]["garage2"]["wan_bridge"]["members"].append("mesh0")
+    graph = rollout.dependencies(hardware)
+    assert graph["bedroom4"] == {"bedroom1"}
+    assert graph["garage2"] == {"garage1"}
+    assert graph["garage1"] == set()
+    hardware["sites"]["garage"]["pods"]["garage3"] = \
+        dict(hardware["sites"]["garage"]["pods"]["garage2"], wan_bridge={"members": ["wan"]})
+    graph = rollout.dependencies(hardware)
+    assert rollout.waves(graph, graph) == [
+        ["bedroom2", "bedroom3", "bedroom4", "garage3", "office1"],
+        ["bedroom1", "garage2"],
+        ["garage1"],
+    ]
+    # uplinks whose leaves are unchanged needn't wait for anything
+    assert rollout.waves(graph, ["garage1", "bedroom1"]) == [["bedroom1", "garage1"]]
+
+
+def test_sites_are_held_back_after_a_failure(monkeypatch, capsys):
+    """
+    A site whose leaf failed, or became unreachable, keeps its uplinks
+    as they were, while the other sites carry on
+    """
+    index = example_index()
+    applied = []
+
+    def apply_payloads(_index, payloads, _args):
+        applied.append(sorted(payloads))
+        return {pod: {"status": "error" if pod == "bedroom4" else "ok", "failed": []}
+                for pod in payloads}
+
+    monkeypatch.setattr(rollout, "apply_payloads", apply_payloads)
+    monkeypatch.setattr(rollout, "unreachable", lambda index, pods, *_: {
+        pod: "100% loss" for pod in pods if pod == "garage2"})
+    args = argparse.Namespace(profiler=profiler.Profiler(), transport="ssh")
+    results = rollout.apply_in_waves(index, {pod: {} for pod in index.pods}, args, object())
+    # both sites' uplinks were held back, so there was nothing left to apply
+    assert applied == [["bedroom2", "bedroom3", "bedroom4", "garage2", "office1"]]
+    assert results["bedroom1"]["error"] == "held back, as pod: bedroom4 failed"
+    assert results["garage1"]["error"] == "held back, as pod: garage2 became unreachable"
+    assert results["office1"]["status"] == "ok"
+    assert "pod: garage2, host: 192.168.78." in capsys.readouterr().out
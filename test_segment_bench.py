@@ -0,0 +1,193 @@
+"""
+pytest tests for the segment throughput benchmark, over the loopback interface
+"""
+
+import os
+import socket
+import subprocess
+import threading
+
+import segment_bench
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    """
+    A local UDP port that nothing is bound to
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_generator_measures_traffic_and_mtu():
+    """
+    Traffic sent to a server is counted, and DF probes up to the loopback MTU are answered
+    """
+    sock = segment_bench.udp_socket()
+    sock.bind(("127.0.0.1", 0))
+    target = sock.getsockname()
+    results = {}
+    server = threading.Thread(target=lambda: results.update(
+        segment_bench.serve(sock, timeout=10, idle=0.3)))
+    server.start()
+    mtu = segment_bench.probe_mtu(target, [1200, 1472, 8000, 70000], timeout=1)
+    sent = segment_bench.send(target, 1000, 0.3, rate=20)
+    server.join()
+    sock.close()
+
+    assert mtu["1472"] == {"sent": 3, "acked": 3, "error": None}
+    assert mtu["8000"]["acked"] == 3
+    assert mtu["70000"]["error"] and not mtu["70000"]["acked"]
+    assert segment_bench.largest_delivered(mtu) == 8000
+    # paced at 20 Mbit/s, 1000 byte datagrams are 2500 per second
+    assert 300 < sent["sent"] < 1000
+    assert results["packets"] == sent["sent"]
+    assert results["bytes"] == sent["bytes"]
+    assert results["mbps"] > 0 and results["pps"] > 0
+    assert results["reordered"] == 0
+
+
+def test_jitter():
+    """
+    Jitter follows the change in transit time, not the clock offset between hosts
+    """
+    stats = segment_bench.ReceiveStats()
+    for sequence in range(100):
+        stats.add(sequence, sequence * 1000000, 100, 5000000000 + sequence * 1000000)
+    assert stats.summary()["jitter_ms"] == 0
+    stats.add(100, 100 * 1000000, 100, 5000000000 + 100 * 1000000 + 1600000)
+    assert stats.summary()["jitter_ms"] == 0.1
+    stats.add(50, 50 * 1000000, 100, 5000000000 + 101 * 1000000)
+    assert stats.summary()["reordered"] == 1
+
+
+def test_bridge_clients():
+    """
+    Each sim_wired_client on the bridge is an endpoint, with its own address
+    """
+    config = {"bridges": {"cable": {"members": [
+        {"type": "sim_wired_client", "pod": "office1", "namespace": "client1"},
+        {"type": "dut", "name": "ap1", "port": "wan"},
+        {"type": "sim_wired_client", "pod": "office2", "namespace": "client2"}]}}}
+    generated = {"office1": {"namespaces": {"client1": {"port": "veth1"}}},
+                 "office2": {"namespaces": {"client2": {"port": "veth7"}}}}
+    endpoints = segment_bench.bridge_clients(config, generated, "cable",
+                                             lambda pod: f"{pod}.lan")
+    assert [(str(endpoint), endpoint.host, endpoint.port, endpoint.address)
+            for endpoint in endpoints] == [
+                ("office1/client1", "office1.lan", "veth1", "198.18.0.1"),
+                ("office2/client2", "office2.lan", "veth7", "198.18.0.2")]
+
+
+class LocalTransport:
+    """
+    Runs pod commands locally, outside of namespaces, where addresses are recorded
+    rather than added
+    """
+    def __init__(self):
+        self.addresses = []
+
+    @staticmethod
+    def local(command):
+        """
+        The command without its ip netns exec wrapper
+        """
+        if command.startswith("ip netns exec "):
+            command = command.split(" ", 4)[4]
+        return command
+
+    def command(self, host, command):  # pylint: disable=unused-argument
+        """
+        The command line that runs command locally
+        """
+        return ["sh", "-c", self.local(command)]
+
+    def run(self, host, command, timeout=None):
+        """
+        Run command locally
+        """
+        command = self.local(command)
+        if command.startswith("ip "):
+            self.addresses.append((host, command))
+            return subprocess.CompletedProcess(command, 0, b"", b"")
+        return subprocess.run(self.command(host, command), capture_output=True,
+                              timeout=timeout, check=False)
+
+
+def test_run_measures_each_client_against_the_first():
+    """
+    Every other client sends to the first, and the temporary addresses are removed afterwards
+    """
+    transport = LocalTransport()
+    endpoints = [segment_bench.Endpoint("office1", "office1.lan", "client1", "veth1",
+                                        "127.0.0.1"),
+                 segment_bench.Endpoint("office2", "office2.lan", "client2", "veth7",
+                                        "127.0.0.1")]
+    options = segment_bench.BenchOptions(duration=0.3, size=1000, rate=10, tool="python")
+    options.port = free_port()
+    options.mtu_sizes = (1200, 1472)
+    results = segment_bench.run(transport, endpoints, options, SCRIPT_DIR)
+
+    assert len(results) == 1
+    result = results[0]
+    assert "error" not in result
+    assert (result["server"], result["client"], result["tool"]) == \
+        ("office1/client1", "office2/client2", "python")
+    assert result["sent"] == result["received"] > 0
+    assert result["loss_pct"] == 0
+    assert result["max_df_size"] == 1472
+    assert [command.split(" ")[2] for _, command in transport.addresses
+            if command.startswith("ip addr")] == ["replace", "replace", "del", "del"]
+
+
+def test_run_readies_each_namespace(monkeypatch):
+    """
+    Each client's loopback and port are brought up, as they arrive in the
+    namespace down, before its address is added, and the address is
+    removed afterwards
+    """
+    commands = []
+
+    class Transport:  # pylint: disable=too-few-public-methods
+        """Records the commands run"""
+        @staticmethod
+        def run(host, command, timeout=None):  # pylint: disable=unused-argument
+            """Record the command"""
+            commands.append((host, command))
+            return subprocess.CompletedProcess(command, 0, b"", b"")
+
+    monkeypatch.setattr(segment_bench, "bench_pair", lambda *_: {"mtu": {}})
+    endpoints = [segment_bench.Endpoint("pod1", "host1", "ns1", "veth1", "198.18.0.1"),
+                 segment_bench.Endpoint("pod2", "host2", "ns2", "veth2", "198.18.0.2")]
+    segment_bench.run(Transport(), endpoints, segment_bench.BenchOptions(tool="python"),
+                      SCRIPT_DIR)
+    assert commands == [
+        ("host1", "ip netns exec ns1 ip link set dev lo up"),
+        ("host1", "ip netns exec ns1 ip link set dev veth1 up"),
+        ("host1", "ip netns exec ns1 ip addr replace 198.18.0.1/15 dev veth1"),
+        ("host2", "ip netns exec ns2 ip link set dev lo up"),
+        ("host2", "ip netns exec ns2 ip link set dev veth2 up"),
+        ("host2", "ip netns exec ns2 ip addr replace 198.18.0.2/15 dev veth2"),
+        ("host1", "ip netns exec ns1 ip addr del 198.18.0.1/15 dev veth1"),
+        ("host2", "ip netns exec ns2 ip addr del 198.18.0.2/15 dev veth2"),
+    ]
+
+
+def test_tool_falls_back_without_iperf3():
+    """
+    auto picks the built in generator unless every pod has iperf3
+    """
+    class Transport:  # pylint: disable=too-few-public-methods
+        """Has iperf3 on one host only"""
+        @staticmethod
+        def run(host, command, timeout=None):  # pylint: disable=unused-argument
+            """Only host1 has iperf3"""
+            return subprocess.CompletedProcess(command, 0 if host == "host1" else 1)
+
+    endpoints = [segment_bench.Endpoint("pod1", "host1", "ns1", "veth1", "198.18.0.1"),
+                 segment_bench.Endpoint("pod2", "host2", "ns2", "veth2", "198.18.0.2")]
+    assert segment_bench.choose_tool(Transport(), endpoints, "auto") == "python"
+    assert segment_bench.choose_tool(Transport(), endpoints[:1], "auto") == "iperf3"
+    assert segment_bench.choose_tool(Transport(), endpoints, "iperf3") == "iperf3"
@@ -0,0 +1,74 @@
+"""
+Tests for the pod side USB serial lookup, against a fake sysfs
+"""
+
+import importlib.util
+import os
+
+import pytest
+
+SPEC = importlib.util.spec_from_file_location("serial_to_tty", "serial-to-tty.py")
+serial_to_tty = importlib.util.module_from_spec(SPEC)
+SPEC.loader.exec_module(serial_to_tty)
+
+
+def plug(root, port, tty, serial):
+    """
+    Add a USB serial adapter, with serial number serial, to the fake sysfs
+    """
+    device = root / "devices" / "usb1" / port
+    (device / f"{port}:1.0" / tty).mkdir(parents=True)
+    (device / "serial").write_text(f"{serial}\n")
+    os.symlink(device / f"{port}:1.0" / tty, root / "bus" / tty)
+    (root / "dev" / tty).write_text("")
+
+
+def unplug(root, port, tty):
+    """
+    Remove a USB serial adapter from the fake sysfs
+    """
+    os.remove(root / "bus" / tty)
+    os.remove(root / "dev" / tty)
+    os.remove(root / "devices" / "usb1" / port / "serial")
+
+
+@pytest.fixture(name="sysfs")
+def fixture_sysfs(tmp_path, monkeypatch):
+    """
+    An empty fake sysfs and /dev
+    """
+    (tmp_path / "bus").mkdir()
+    (tmp_path / "dev").mkdir()
+    monkeypatch.setattr(serial_to_tty, "USB_SERIAL_PATH", str(tmp_path / "bus"))
+    monkeypatch.setattr(serial_to_tty, "DEV_PATH", str(tmp_path / "dev"))
+    monkeypatch.setattr(serial_to_tty, "CACHE_PATH", str(tmp_path / "cache.json"))
+    return tmp_path
+
+
+def test_serial_to_tty_is_cached_until_hotplug(sysfs, monkeypatch):
+    """
+    Serial numbers are read from the usb-serial bus's USB devices, and only
+    read again once an adapter has been plugged or unplugged
+    """
+    plug(sysfs, "1-1", "ttyUSB0", "A1")
+    plug(sysfs, "1-2", "ttyUSB1", "B2")
+    assert serial_to_tty.cached_serial_to_tty() == {"A1": "ttyUSB0", "B2": "ttyUSB1"}
+
+    reads = []
+    read_serial = serial_to_tty.read_serial
+    monkeypatch.setattr(serial_to_tty, "read_serial",
+                        lambda tty: reads.append(tty) or read_serial(tty))
+    assert serial_to_tty.cached_serial_to_tty() == {"A1": "ttyUSB0", "B2": "ttyUSB1"}
+    assert not reads
+
+    unplug(sysfs, "1-1", "ttyUSB0")
+    assert serial_to_tty.cached_serial_to_tty() == {"B2": "ttyUSB1"}
+    assert reads == ["ttyUSB1"]
+
+    # another adapter plugged in as the same tty is told apart by /dev's
+    # mtime, set here as the test may run within a tick of the clock
+    mtime = os.stat(sysfs / "dev").st_mtime_ns
+    unplug(sysfs, "1-2", "ttyUSB1")
+    plug(sysfs, "1-3", "ttyUSB1", "C3")
+    os.utime(sysfs / "dev", ns=(mtime + 1, mtime + 1))
+    assert serial_to_tty.cached_serial_to_tty() == {"C3": "ttyUSB1"}
@@ -0,0 +1,63 @@
+"""
+Tests for expanding and ordering the steps of a sweep
+"""
+
+import copy
+
+import yaml
+
+import sweep
+import topology_sim
+from allocator import Allocations
+
+
+def example_config():
+    """
+    Load the example user config
+    """
+    return topology_sim.get_config("example-configs/config.yaml")
+
+
+def test_vary_steps_through_every_combination(tmp_path):
+    """
+    A generator spec expands to every combination of its bridges' alternatives,
+    and specs can list configs relative to themselves
+    """
+    config = example_config()
+    (tmp_path / "base.yaml").write_text(yaml.safe_dump(config))
+    (tmp_path / "vary.yaml").write_text(yaml.safe_dump({
+        "base": "base.yaml",
+        "vary": {"eth_cable_1": [config["bridges"]["eth_cable_2"], None],
+                 "eth_cable_3": [None, config["bridges"]["eth_cable_3"], None]}}))
+    (tmp_path / "list.yaml").write_text(yaml.safe_dump({"configs": ["base.yaml"]}))
+    steps = sweep.load_steps([str(tmp_path / "vary.yaml"), str(tmp_path / "list.yaml")])
+    assert len(steps) == 7
+    assert steps[-1] == (str(tmp_path / "base.yaml"), config)
+    name, first = steps[0]
+    assert name.endswith("vary.yaml[eth_cable_1=0, eth_cable_3=0]")
+    assert first["bridges"]["eth_cable_1"] == config["bridges"]["eth_cable_2"]
+    assert "eth_cable_3" not in first["bridges"]
+    assert "eth_cable_1" not in steps[3][1]["bridges"]
+
+
+def test_steps_are_ordered_by_changes():
+    """
+    Steps that differ least are run one after another
+    """
+    hardware = topology_sim.get_config("example-configs/hardware.yaml")
+    index = topology_sim.HardwareIndex(hardware)
+    configs = []
+    for removed in [[], ["eth_cable_1", "eth_cable_2", "eth_cable_3"], ["eth_cable_3"],
+                    ["eth_cable_2", "eth_cable_3"]]:
+        config = copy.deepcopy(example_config())
+        for bridge in removed:
+            del config["bridges"][bridge]
+        configs.append(config)
+    allocations = Allocations()
+    steps = [(topology_sim.gen_config(config, index, allocations),
+              topology_sim.power_targets(config, hardware)) for config in configs]
+    assert sweep.distance(steps[0], steps[0]) == 0
+    assert sweep.distance(steps[0], steps[2]) < sweep.distance(steps[0], steps[1])
+    order = sweep.order_steps(steps)
+    assert order in ([0, 2, 3, 1], [1, 3, 2, 0])
+    assert sweep.power_changes(steps[0][1], steps[0][1]) == {}
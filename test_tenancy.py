@@ -0,0 +1,202 @@
+"""
+pytest tests for multi-tenant reservations
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import pytest
+
+import pod_state
+import tenancy
+import topology_sim
+
+NOW = time.time()
+EXAMPLES = os.path.join(os.path.dirname(__file__), "example-configs")
+
+
+def example_index():
+    """
+    Index the example hardware config
+    """
+    return topology_sim.HardwareIndex(topology_sim.get_config(f"{EXAMPLES}/hardware.yaml"))
+
+
+def tenant_config(*bridges):
+    """
+    A tenant's config, with some of the example config's bridges
+    """
+    config = topology_sim.get_config(f"{EXAMPLES}/config.yaml")
+    return {"bridges": {bridge: config["bridges"][bridge] for bridge in bridges},
+            "sim_wireless_clients": [], "power_on": []}
+
+
+def claims(duts, pods=(), vlans="100-199", gre_keys="1000-1999"):
+    """
+    What a tester claims when reserving
+    """
+    return {"duts": duts, "pods": list(pods), "vlans": vlans, "gre_keys": gre_keys,
+            "hours": 8}
+
+
+def two_tenants():
+    """
+    Leases for alice, testing eth_cable_1, and bob, testing eth_cable_3
+    """
+    leases = {}
+    index = example_index()
+    tenancy.reserve(leases, index, "alice", claims(["bedroom_model-g", "garage_model-c"]), NOW)
+    tenancy.reserve(leases, index, "bob", claims(["bedroom_model-d"], ["bedroom4"], "200-299",
+                                                 "2000-2999"), NOW)
+    return leases
+
+
+def test_claims_are_exclusive():
+    """
+    No two tenants may lease the same DUT or pod, or overlapping ranges,
+    and a tenant may renew its own lease
+    """
+    leases = two_tenants()
+    index = example_index()
+    with pytest.raises(tenancy.ReservationError) as error:
+        tenancy.reserve(leases, index, "carol",
+                        claims(["garage_model-c"], ["bedroom4"], "150-250", "3000"), NOW)
+    assert str(error.value).splitlines() == [
+        "dut: garage_model-c is leased by alice",
+        "vlans: 150-250 overlaps alice's 100-199",
+        "pod: bedroom4 is leased by bob",
+        "vlans: 150-250 overlaps bob's 200-299",
+    ]
+    with pytest.raises(tenancy.ReservationError, match="dut: model-z not found"):
+        tenancy.reserve(leases, index, "carol", claims(["model-z"], (), "300", "3000"), NOW)
+    with pytest.raises(tenancy.ReservationError, match="isn't within 2-4094"):
+        tenancy.reserve(leases, index, "carol", claims([], (), "4000-4095", "3000"), NOW)
+
+    tenancy.reserve(leases, index, "alice", claims(["garage_model-c"], (), "100-109"), NOW + 60)
+    assert leases["alice"]["vlans"] == [100, 109]
+    # an expired lease no longer holds its claims
+    tenancy.reserve(leases, index, "carol", claims(["bedroom_model-d"], (), "300", "3000"),
+                    NOW + 9 * 3600)
+
+
+def test_configs_stay_within_their_lease():
+    """
+    A tenant's config may only use the DUTs and pods it leased, and not
+    the bridge or namespace names that another tenant uses
+    """
+    leases = two_tenants()
+    leases["bob"]["config"] = tenant_config("eth_cable_3")
+    with pytest.raises(tenancy.ReservationError) as error:
+        tenancy.check_config(leases, "alice", tenant_config("eth_cable_1", "eth_cable_2",
+                                                            "eth_cable_3"))
+    assert str(error.value).splitlines() == [
+        "dut: bedroom_model-d isn't leased to alice",
+        "pod: bedroom4 isn't leased to alice",
+        "bridge: eth_cable_3 is already used by bob",
+        "namespace: bedroom4_sim_wired_client is already used by bob",
+    ]
+    tenancy.check_config(leases, "alice", tenant_config("eth_cable_1"))
+    with pytest.raises(tenancy.ReservationError, match="has no lease"):
+        tenancy.check_config(leases, "carol", tenant_config())
+
+
+def test_tenants_dont_share_a_wan():
+    """
+    Bridges with WAN access join their site's wan bridge, so no two tenants
+    may have WAN access at the same site
+    """
+    leases = two_tenants()
+    leases["bob"]["config"] = tenant_config("eth_cable_3")
+    leases["bob"]["config"]["bridges"]["eth_cable_3"]["wan"] = "bedroom"
+    with pytest.raises(tenancy.ReservationError, match="^wan: bedroom is already used by bob$"):
+        tenancy.check_config(leases, "alice", tenant_config("internet_connection"))
+    leases["bob"]["config"]["bridges"]["eth_cable_3"]["wan"] = "garage"
+    tenancy.check_config(leases, "alice", tenant_config("internet_connection"))
+
+
+def test_tenants_keep_their_ids():
+    """
+    Each tenant's bridges take IDs from its ranges, and are generated the
+    same whether or not other tenants have topologies
+    """
+    leases = two_tenants()
+    index = example_index()
+    leases["alice"]["config"] = tenant_config("eth_cable_1")
+    allocations = topology_sim.Allocations()
+    alone = topology_sim.gen_config(tenancy.merged_config(leases), index, allocations)
+    leases["bob"]["config"] = tenant_config("eth_cable_3")
+    shared = topology_sim.gen_config(tenancy.merged_config(leases), index,
+                                     topology_sim.Allocations(allocations.to_dict()))
+    for pod, pod_config in alone.items():
+        for section in ["bridges", "tunnels"]:
+            for name, info in pod_config[section].items():
+                assert shared[pod][section][name] == info
+    assert shared["bedroom1"]["bridges"]["eth_cable_1"]["vid"] == 100
+    assert shared["bedroom1"]["bridges"]["eth_cable_3"]["vid"] == 200
+    # only alice's bridge spans sites
+    assert {info["key"] for info in shared["bedroom1"]["tunnels"].values()} == {1000}
+
+
+def test_create_and_release_touch_only_the_tenant(tmp_path, monkeypatch, capsys):
+    """
+    A tenant's create and release switch only its DUTs, and a create of
+    the whole fabric is refused while it's leased
+    """
+    monkeypatch.chdir(tmp_path)
+    leases = two_tenants()
+    pod_state.save_leases(leases)
+    index = example_index()
+    applied = []
+    switched = []
+    monkeypatch.setattr(topology_sim, "converge", lambda index, generated, args: (
+        applied.append(generated) or (sorted(generated), {})))
+    monkeypatch.setattr(topology_sim, "set_power", lambda targets, *_: switched.append(targets))
+    monkeypatch.setattr(topology_sim, "power_options", lambda args: None)
+    args = argparse.Namespace(tenant="alice", full=False, skip_health=True, transport="ssh",
+                              profile=None)
+
+    topology_sim.do_create(index, tenant_config("eth_cable_1"), args)
+    assert switched == [{"bedroom_model-g": "on", "garage_model-c": "on"}]
+    assert "eth_cable_1" in applied[0]["garage1"]["bridges"]
+    assert pod_state.load_leases()["alice"]["config"] == tenant_config("eth_cable_1")
+
+    topology_sim.do_release(index, args)
+    assert switched[1] == {"bedroom_model-g": "off", "garage_model-c": "off"}
+    assert "eth_cable_1" not in applied[1]["garage1"]["bridges"]
+    assert sorted(pod_state.load_leases()) == ["bob"]
+
+    with pytest.raises(SystemExit):
+        topology_sim.do_create(index, tenant_config("eth_cable_1"),
+                               argparse.Namespace(tenant=None))
+    assert "leased to: bob" in capsys.readouterr().out
+
+
+def test_overlapping_creates_both_survive(tmp_path, monkeypatch):
+    """
+    Two tenants creating at the same time take turns with the controller's
+    state, so neither's topology is lost
+    """
+    monkeypatch.chdir(tmp_path)
+    pod_state.save_leases(two_tenants())
+    index = example_index()
+    applied = []
+    monkeypatch.setattr(topology_sim, "converge", lambda index, generated, args: (
+        applied.append(generated) or (sorted(generated), {})))
+    monkeypatch.setattr(topology_sim, "set_power", lambda *_: None)
+    monkeypatch.setattr(topology_sim, "power_options", lambda args: None)
+    # widen the window between loading the leases and saving them
+    monkeypatch.setattr(topology_sim, "preflight", lambda *_: time.sleep(0.3))
+    creates = [threading.Thread(target=topology_sim.do_create, args=(
+        index, tenant_config(bridge), argparse.Namespace(
+            tenant=tenant, full=False, skip_health=True, transport="ssh", profile=None)))
+        for tenant, bridge in [("alice", "eth_cable_1"), ("bob", "eth_cable_3")]]
+    for create in creates:
+        create.start()
+    for create in creates:
+        create.join()
+    leases = pod_state.load_leases()
+    assert leases["alice"]["config"] == tenant_config("eth_cable_1")
+    assert leases["bob"]["config"] == tenant_config("eth_cable_3")
+    assert {"eth_cable_1", "eth_cable_3"} <= set(applied[-1]["bedroom1"]["bridges"])
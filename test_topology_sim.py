@@ -2,6 +2,22 @@
 pytest tests
 """
 
+import argparse
+import json
+import subprocess
+import time
+
+import pytest
+
+import allocator
+import configure
+import pod_state
+import podlog
+import profiler
+import topology_sim
+import transport
+import tunnel_layout
+
 
 def test_pytest():
     """
@@ -15,3 +31,453 @@ def test_pytest_again():
     another example test
     """
     assert 1 != 2  # pylint: disable=comparison-of-constants
+
+
+def example_hardware():
+    """
+    Load the example hardware config
+    """
+    return topology_sim.get_config("example-configs/hardware.yaml")
+
+
+def test_hardware_index_lookups():
+    """
+    The index resolves DUT ports, pods and sites without walking the config
+    """
+    index = topology_sim.HardwareIndex(example_hardware())
+    member = {"type": "dut", "dut_name": "garage_model-c", "dut_port": "eth1"}
+    assert index.get_port(member) == ("garage2", "lan2")
+    assert index.get_pod_site("garage2") == "garage"
+    assert index.tunneling_pod("garage") == "garage1"
+    assert index.pod_host("office1") == "192.168.78.98"
+    assert not index.duplicates
+
+
+def test_hardware_index_unknown_entries():
+    """
+    Unknown DUTs, pods and members raise the existing exceptions
+    """
+    index = topology_sim.HardwareIndex(example_hardware())
+    with pytest.raises(topology_sim.InvalidMember):
+        index.get_pod({"type": "dut", "dut_name": "nope", "dut_port": "eth0"})
+    with pytest.raises(topology_sim.InvalidPod):
+        index.get_pod_site("nope")
+    with pytest.raises(topology_sim.InvalidDUT):
+        index.serial_for_dut("nope")
+
+
+def test_hardware_index_reports_duplicates():
+    """
+    A DUT port wired to two pod ports is reported and the first entry wins
+    """
+    hardware = example_hardware()
+    hardware["sites"]["office"]["pods"]["office1"]["ethernet"]["lan4"] = {
+        "dut_name": "garage_model-c", "dut_port": "eth1"}
+    hardware["sites"]["office"]["pods"]["office1"]["console"] = {
+        "tty": {"ttyUSB0": {"dut_name": "office_model-a"}}}
+    index = topology_sim.HardwareIndex(hardware)
+    assert len(index.duplicates) == 1
+    assert index.get_port({"dut_name": "garage_model-c", "dut_port": "eth1"}) == \
+        ("garage2", "lan2")
+    assert index.serial_for_dut("office_model-a") == ("192.168.78.98", "tty", "ttyUSB0")
+
+
+def test_tunnel_layouts():
+    """
+    Each layout joins every site, with the fewest tunnels it allows
+    """
+    sites = ["a", "b", "c", "d"]
+    costs = {("a", "b"): 5, ("a", "c"): 1, ("b", "c"): 1, ("c", "d"): 1}
+
+    def cost(site1, site2):
+        return costs.get(tuple(sorted((site1, site2))), 10)
+
+    assert len(tunnel_layout.tunnel_pairs("mesh", sites, cost)) == 6
+    assert tunnel_layout.tunnel_pairs("hub", sites, cost, "b") == \
+        [("a", "b"), ("b", "c"), ("b", "d")]
+    # without a WAN site, the cheapest site to reach the others is the hub
+    assert tunnel_layout.tunnel_pairs("hub", sites, cost) == \
+        [("a", "c"), ("b", "c"), ("c", "d")]
+    assert tunnel_layout.tunnel_pairs("tree", sites, cost) == \
+        [("a", "c"), ("b", "c"), ("c", "d")]
+    with pytest.raises(ValueError):
+        tunnel_layout.tunnel_pairs("ring", sites, cost)
+
+
+def three_site_config(**layouts):
+    """
+    A config with a single bridge spanning the example's three sites
+    """
+    bridge = {"members": [{"type": "dut", "dut_name": name, "dut_port": "eth0"}
+                          for name in ["bedroom_model-d", "garage_model-c", "office_model-a"]],
+              "wan": None}
+    bridge.update(layouts.pop("bridge", {}))
+    return {"bridges": {"segment": bridge}, "sim_wireless_clients": [], "power_on": [],
+            **layouts}
+
+
+def test_gen_config_tunnel_layouts():
+    """
+    A full mesh isolates its tunnels, while a hub forwards between them
+    """
+    hardware = example_hardware()
+    hardware["tunnel_costs"] = {"bedroom": {"garage": 1, "office": 1}, "garage": {"office": 9}}
+    index = topology_sim.HardwareIndex(hardware)
+
+    mesh = topology_sim.gen_config(three_site_config(), index)
+    assert [len(mesh[pod]["tunnels"]) for pod in ["bedroom1", "garage1", "office1"]] == [2, 2, 2]
+    assert all(tunnel["isolated"] for tunnel in mesh["office1"]["tunnels"].values())
+
+    for config in [three_site_config(tunnel_layout="tree"),
+                   three_site_config(bridge={"tunnel_layout": "hub"})]:
+        generated = topology_sim.gen_config(config, index)
+        assert [len(generated[pod]["tunnels"])
+                for pod in ["bedroom1", "garage1", "office1"]] == [2, 1, 1]
+        assert not any(tunnel["isolated"] for tunnel in generated["bedroom1"]["tunnels"].values())
+        assert sorted(generated["bedroom1"]["bridges"]["segment"]["virtual_members"]) == \
+            sorted(generated["bedroom1"]["tunnels"])
+
+
+def example_config():
+    """
+    Load the example user config
+    """
+    return topology_sim.get_config("example-configs/config.yaml")
+
+
+def bridge_ids(generated):
+    """
+    Returns the VLAN IDs and tunnel interface -> GRE key of each pod's bridges
+    """
+    return {pod: {"vids": {bridge: info["vid"] for bridge, info in pod_config["bridges"].items()},
+                  "tunnels": {name: info["key"] for name, info in pod_config["tunnels"].items()}}
+            for pod, pod_config in generated.items()}
+
+
+def test_allocation_is_per_site_and_per_pair():
+    """
+    VLAN IDs are only unique per site, and GRE keys per pair of pods
+    """
+    index = topology_sim.HardwareIndex(example_hardware())
+    config = example_config()
+    config["bridges"]["office_cable"] = {"members": [
+        {"type": "dut", "dut_name": "office_model-a", "dut_port": "eth0"},
+        {"type": "dut", "dut_name": "office_model-j", "dut_port": "eth0"}], "wan": None}
+    generated = topology_sim.generate(config, index)
+    # the office has a VLAN ID space of its own
+    assert generated.config["office1"]["bridges"]["office_cable"]["vid"] == 2
+    assert generated.config["bedroom1"]["bridges"]["eth_cable_1"]["vid"] == 2
+    assert generated.namespace_to_pod["bedroom4_sim_wired_client"] == "bedroom4"
+
+
+def test_allocation_is_stable():
+    """
+    Bridges keep their IDs when other bridges are removed, reordered or added
+    """
+    index = topology_sim.HardwareIndex(example_hardware())
+    allocations = allocator.Allocations()
+    before = bridge_ids(topology_sim.gen_config(example_config(), index, allocations))
+
+    config = example_config()
+    config["bridges"]["eth_cable_4"] = config["bridges"].pop("eth_cable_1")
+    config["bridges"] = dict(reversed(list(config["bridges"].items())))
+    allocations = allocator.Allocations(json.loads(json.dumps(allocations.to_dict())))
+    after = bridge_ids(topology_sim.gen_config(config, index, allocations))
+    assert after["bedroom4"]["vids"]["eth_cable_2"] == before["bedroom4"]["vids"]["eth_cable_2"]
+    assert after["bedroom4"]["vids"]["eth_cable_3"] == before["bedroom4"]["vids"]["eth_cable_3"]
+    assert after["garage1"]["tunnels"]["gretap2"] == before["garage1"]["tunnels"]["gretap2"]
+    # the new bridge doesn't take the IDs that the removed bridge had last time
+    assert after["bedroom4"]["vids"]["eth_cable_4"] == 5
+    assert after["garage1"]["tunnels"]["gretap3"] == 3
+    assert "gretap1" not in after["garage1"]["tunnels"]
+
+
+def test_allocation_exhausted():
+    """
+    Running out of IDs within a scope, or within a key's range, is an error
+    """
+    pool = allocator.Pool("VLAN IDs", 2, 3)
+    assert [pool.get("site", "a"), pool.get("site", "b"), pool.get("other", "c")] == [2, 3, 2]
+    with pytest.raises(allocator.AllocationError):
+        pool.get("site", "c")
+    # a key is kept to the range given, ie. its tenant's
+    pool = allocator.Pool("VLAN IDs", 2, 4094, {"site": {"a": 2}})
+    assert [pool.get("site", "a", (10, 11)), pool.get("site", "b", (10, 11))] == [10, 11]
+    with pytest.raises(allocator.AllocationError, match="10-11 are all in use"):
+        pool.get("site", "c", (10, 11))
+
+
+def test_allocation_scales():
+    """
+    Allocating a scope's IDs one by one takes linear time, as each search
+    resumes where the last one left off, while still avoiding previous IDs
+    """
+    probes = []
+
+    class CountedSet(set):
+        """A set that counts its membership tests"""
+        def __contains__(self, item):
+            probes.append(item)
+            return super().__contains__(item)
+
+    count = 2000
+    pool = allocator.Pool("GRE keys", 1, 2**32 - 1,
+                          {"pair": {f"old{number}": number * 2 + 1 for number in range(count)}})
+    scope = pool.scope("pair")
+    scope["used"], scope["reserved"] = CountedSet(), CountedSet(scope["reserved"])
+    keys = [pool.get("pair", f"new{number}") for number in range(count)]
+    assert keys[:3] == [2, 4, 6] and len(set(keys)) == count
+    # each ID up to the last allocated is tested a bounded number of times,
+    # where searching from the start each time would test count**2 / 2
+    assert len(probes) <= 4 * max(keys)
+
+
+class FakeSSHTransport:
+    """
+    Stands in for SSHTransport, taking a configurable time per host
+    """
+    def __init__(self, delays, exit_codes=None):
+        self.delays = delays
+        self.exit_codes = exit_codes or []
+        self.commands = []
+        self.connect_timeouts = []
+        self.on_output = None
+
+    def ensure_master(self, host, timeout=None):  # pylint: disable=unused-argument
+        """Pretend to connect"""
+        self.connect_timeouts.append(timeout)
+
+    def push_file(self, host, local_path, remote_path, timeout=None):
+        """Pretend to copy a file"""
+        return self.run(host, f"cat > {remote_path} < {local_path}", b"", timeout)
+
+    def run(self, host, command, stdin=b"", timeout=None):
+        """Pretend to run a command, taking the host's delay"""
+        self.commands.append((host, command, stdin))
+        if timeout is not None and self.delays.get(host, 0) > timeout:
+            time.sleep(timeout)
+            raise subprocess.TimeoutExpired(command, timeout)
+        time.sleep(self.delays.get(host, 0))
+        exit_code = self.exit_codes.pop(0) if self.exit_codes else 0
+        if self.on_output:
+            self.on_output(host, "stdout", "no changes")
+        return subprocess.CompletedProcess(command, exit_code, b"no changes\n", b"")
+
+
+def test_configure_pods_ssh(tmp_path, monkeypatch, capsys):
+    """
+    Pods are configured concurrently, reported in completion order,
+    and a slow pod times out without holding up the others
+    """
+    index = topology_sim.HardwareIndex(example_hardware())
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+    payloads = {pod: {"config": {"pod": pod}, "push_changer": False} for pod in index.pods}
+    pods = FakeSSHTransport({index.pod_host("bedroom4"): 0.3, index.pod_host("office1"): 5})
+    start = time.monotonic()
+    args = argparse.Namespace(workers=len(index.pods), timeout=1, full=False,
+                              changer_hash="abc", profile=None, profiler=profiler.Profiler(),
+                              pod_log=podlog.PodLog(live=False))
+    results = configure.configure_pods_ssh(index, payloads, args, pods)
+    args.pod_log.close()
+    assert time.monotonic() - start < 2
+    assert results.pop("office1") == {"status": "error", "error": "timed out after 1s",
+                                      "failed": [], "exit_code": None}
+    assert {result["exit_code"] for result in results.values()} == {0}
+    assert {result["status"] for result in results.values()} == {"ok"}
+    lines = capsys.readouterr().out.splitlines()
+    assert "bedroom4" in lines[-2]
+    assert "office1" in lines[-1] and "timed out" in lines[-1]
+    # the config is streamed over stdin, rather than shipped in a tarball
+    assert [command[1:] for command in pods.commands
+            if command[0] == index.pod_host("garage1")] == \
+        [(f"echo 'abc  {configure.POD_DIR}/changer.py' | sha256sum -c - >/dev/null 2>&1"
+          f" || exit 75; python3 {configure.POD_DIR}/changer.py", b'{"pod": "garage1"}')]
+    # output is tagged with the pod and the phase it was output in
+    entries = [json.loads(line) for line in
+               (tmp_path / "logs" / "pods.jsonl").read_text(encoding="utf8").splitlines()]
+    garage1 = [(entry["phase"], entry["stream"], entry["line"]) for entry in entries
+               if entry["pod"] == "garage1"]
+    assert garage1[:3] == [("connect", "phase", "connect"),
+                           ("run changer", "phase", "run changer"),
+                           ("run changer", "stdout", "no changes")]
+    assert garage1[3][1] == "result" and garage1[3][2] in lines
+    # the pod that timed out is the slowest
+    assert args.profiler.summary()["pods"][0]["pod"] == "office1"
+
+
+def test_pods_sharing_a_host(tmp_path, monkeypatch):
+    """
+    Pods behind the same host, ie. port forwarded, each get their own output,
+    and connecting counts towards each pod's timeout
+    """
+    hardware = example_hardware()
+    for pod_info in hardware["sites"]["bedroom"]["pods"].values():
+        pod_info["host"] = "10.0.0.1"
+    index = topology_sim.HardwareIndex(hardware)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+    pods = sorted(hardware["sites"]["bedroom"]["pods"])
+    payloads = {pod: {"config": {"pod": pod}, "push_changer": False} for pod in pods}
+    ssh = FakeSSHTransport({})
+    args = argparse.Namespace(workers=len(pods), timeout=1, full=False, changer_hash="abc",
+                              profile=None, profiler=profiler.Profiler(),
+                              pod_log=podlog.PodLog(live=False))
+    configure.configure_pods_ssh(index, payloads, args, ssh)
+    args.pod_log.close()
+    entries = [json.loads(line) for line in
+               (tmp_path / "logs" / "pods.jsonl").read_text(encoding="utf8").splitlines()]
+    assert sorted(entry["pod"] for entry in entries if entry["stream"] == "stdout") == pods
+    assert len(ssh.connect_timeouts) == len(pods)
+    assert all(0 < timeout <= 1 for timeout in ssh.connect_timeouts)
+
+
+def test_ssh_transport_shares_connections():
+    """
+    Every command to a host goes through the same control socket
+    """
+    ssh = transport.SSHTransport(control_dir="/tmp/ctl")
+    args = ssh.command("10.0.0.1", "true")
+    assert "ControlPath=/tmp/ctl/root@10.0.0.1" in args
+    assert "ControlMaster=no" in args
+    assert args[-2:] == ["10.0.0.1", "true"]
+
+
+def test_changer_failures_are_reported():
+    """
+    The result line that the changer prints is what a pod's outcome is
+    judged by, and a changer that couldn't print one is an error
+    """
+    index = topology_sim.HardwareIndex(example_hardware())
+    failure = {"command": "/sbin/ip link del br-lan.4", "status": "failed",
+               "error": "Cannot find device"}
+    stdout = b"- vlan br-lan.4\nresult: " + json.dumps(
+        {"status": "rolled_back", "failed": [failure],
+         "rollback": {"status": "ok", "changes": 2, "failed": []}}).encode("utf8") + b"\n"
+    rolled_back = configure.proc_result(subprocess.CompletedProcess([], 1, stdout, b""))
+    assert rolled_back["status"] == "rolled_back"
+    crashed = configure.proc_result(subprocess.CompletedProcess(
+        [], 1, b"", b"Traceback\nKeyError: 'bridges'\n"))
+    assert crashed == {"status": "error", "error": "KeyError: 'bridges'", "failed": [],
+                       "exit_code": 1}
+    assert configure.format_failures(
+        index, {"garage1": crashed, "bedroom4": rolled_back}).splitlines() == [
+            f"pod: bedroom4, host: {index.pod_host('bedroom4')} failed: "
+            "/sbin/ip link del br-lan.4: Cannot find device, rolled back to its previous config",
+            f"pod: garage1, host: {index.pod_host('garage1')} KeyError: 'bridges'"]
+
+
+def test_configure_pod_ssh_pushes_stale_changer(tmp_path):
+    """
+    When the pod's changer.py doesn't match, it is pushed and the changer rerun
+    """
+    pods = FakeSSHTransport({}, exit_codes=[configure.STALE_CHANGER])
+    args = argparse.Namespace(timeout=1, full=False, changer_hash="abc", profile=None,
+                              profiler=profiler.Profiler(),
+                              pod_log=podlog.PodLog(str(tmp_path / "pods.jsonl"), live=False))
+    proc = configure.configure_pod_ssh(
+        pods, "pod", "10.0.0.1", {"config": {}, "push_changer": False}, args)
+    assert proc.returncode == 0
+    assert [command[1].split()[0] for command in pods.commands] == \
+        ["echo", "cat", "echo"]
+
+
+class FakeSerialTransport:
+    """
+    Stands in for SSHTransport, reporting the same USB serial adapter on every pod
+    """
+    def __init__(self):
+        self.pushed = []
+
+    def push_if_changed(self, host, local_path, remote_path, timeout=None):
+        """Pretend to check, and copy, the pod's copy of a script"""
+        self.pushed.append((host, local_path, remote_path, timeout))
+        return subprocess.CompletedProcess([], 0, b"", b"")
+
+    @staticmethod
+    def run(host, command, stdin=b"", timeout=None):  # pylint: disable=unused-argument
+        """Pretend to run serial-to-tty.py"""
+        return subprocess.CompletedProcess(command, 0, b'{"A1": "ttyUSB0"}', b"")
+
+
+def test_serials_are_looked_up_on_every_pod(monkeypatch, capsys):
+    """
+    Every pod's serial -> tty map is printed, with the DUT on each console,
+    and consoles that weren't found are reported
+    """
+    index = topology_sim.HardwareIndex(example_hardware())
+    index.pods["garage1"]["console"] = {"serial": {"A1": {"dut_name": "garage_model-f"},
+                                                   "Z9": {"dut_name": "garage_model-a"}}}
+    pods = FakeSerialTransport()
+    monkeypatch.setattr(transport, "pod_transport", lambda _index, _transport: pods)
+    args = argparse.Namespace(transport="ssh", workers=4, timeout=1)
+    topology_sim.do_serials(index, args)
+    assert len(pods.pushed) == len(index.pods)
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == len(index.pods) + 1
+    assert "serial: A1, tty: ttyUSB0, dut: garage_model-f" in "\n".join(lines)
+    assert "serial: Z9 not found, dut: garage_model-a" in "\n".join(lines)
+
+
+def test_plan_payloads():
+    """
+    Only pods whose config or changer changed are applied
+    """
+    generated = {"pod1": {"bridges": {}}, "pod2": {"bridges": {}}}
+    last_applied = {
+        "pod1": {"payload_hash": pod_state.payload_hash(generated["pod1"], "v1"),
+                 "changer_hash": "v1"},
+        "pod2": {"payload_hash": "stale", "changer_hash": "v1"},
+    }
+    payloads = pod_state.plan_payloads(generated, last_applied, "v1")
+    assert list(payloads) == ["pod2"]
+    assert not payloads["pod2"]["push_changer"]
+
+    payloads = pod_state.plan_payloads(generated, last_applied, "v2")
+    assert list(payloads) == ["pod1", "pod2"]
+    assert payloads["pod1"]["push_changer"]
+
+    assert list(pod_state.plan_payloads(generated, last_applied, "v1", force=True)) == \
+        ["pod1", "pod2"]
+
+
+def test_watch_applies_only_what_an_edit_changed(tmp_path, monkeypatch, capsys):
+    """
+    Each edit applies only the pods whose config it changed, and switches
+    only the DUTs whose power it changed, and a broken edit applies nothing
+    """
+    hardware_path = tmp_path / "hardware.yaml"
+    config_path = tmp_path / "config.yaml"
+    with open("example-configs/hardware.yaml", encoding="utf8") as file_handle:
+        hardware_path.write_text(file_handle.read(), encoding="utf8")
+    with open("example-configs/config.yaml", encoding="utf8") as file_handle:
+        config_text = file_handle.read()
+    config_path.write_text(config_text, encoding="utf8")
+    monkeypatch.chdir(tmp_path)
+    applied = []
+    switched = []
+    monkeypatch.setattr(topology_sim, "converge", lambda index, generated, args: (
+        applied.append(sorted(generated)) or (sorted(generated), {})))
+    monkeypatch.setattr(topology_sim, "set_power", lambda targets, *_: switched.append(targets))
+    monkeypatch.setattr(topology_sim, "power_options", lambda args: None)
+    args = argparse.Namespace(config=str(config_path), hardware=str(hardware_path))
+
+    topology = topology_sim.WatchedTopology(args)
+    topology.apply()
+    everything = sorted(topology.generated)
+    assert applied == [everything]
+    assert switched and len(switched[0]) == len(topology.power)
+
+    config = topology_sim.get_config(str(config_path))
+    pods = {member["pod"] for member in config["bridges"]["eth_cable_3"]["members"]
+            if "pod" in member}
+    del config["bridges"]["eth_cable_3"]
+    config_path.write_text(json.dumps(config), encoding="utf8")
+    topology.apply([str(config_path)])
+    assert pods <= set(applied[1]) and set(applied[1]) < set(everything)
+    assert len(switched) == 1
+
+    config_path.write_text("bridges: [", encoding="utf8")
+    topology.apply([str(config_path)])
+    assert len(applied) == 2
+    assert "not applied, keeping the previous topology" in capsys.readouterr().out
@@ -0,0 +1,62 @@
+"""
+pytest tests for watching config files
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import watch
+
+
+@pytest.mark.parametrize("watcher_class", [watch.Inotify, watch.StatWatcher])
+def test_edits_are_seen(tmp_path, watcher_class):
+    """
+    Files written in place, or replaced by a rename, are reported,
+    and other files in the same directory aren't
+    """
+    config = tmp_path / "config.yaml"
+    config.write_text("bridges: {}\n", encoding="utf8")
+    watcher = watcher_class([str(config)])
+    try:
+        assert watcher.wait(0.2) == set()
+        (tmp_path / "other.yaml").write_text("x\n", encoding="utf8")
+        assert watcher.wait(0.2) == set()
+
+        config.write_text("bridges: {a: {}}\n", encoding="utf8")
+        assert watcher.wait(1) == {str(config)}
+
+        replacement = tmp_path / ".config.yaml.swp"
+        replacement.write_text("bridges: {b: {}}\n", encoding="utf8")
+        os.replace(replacement, config)
+        assert str(config) in watcher.wait(1)
+    finally:
+        watcher.close()
+
+
+def test_edits_are_debounced(tmp_path):
+    """
+    A burst of writes is applied once, after it settles
+    """
+    paths = [tmp_path / "config.yaml", tmp_path / "hardware.yaml"]
+    for path in paths:
+        path.write_text("{}\n", encoding="utf8")
+    watcher = watch.file_watcher([str(path) for path in paths])
+    changes = []
+
+    def edit():
+        time.sleep(0.1)
+        for number in range(3):
+            for path in paths:
+                path.write_text(f"{{n: {number}}}\n", encoding="utf8")
+
+    editor = threading.Thread(target=edit)
+    editor.start()
+    try:
+        watch.watch(watcher, changes.append, duration=0.6)
+    finally:
+        watcher.close()
+    editor.join()
+    assert changes == [sorted(str(path) for path in paths)]
@@ -2,28 +2,27 @@
 Centralized control plane
 """
 
+# modules that only some commands need are imported by those commands,
+# so that interactive commands such as client and serial start quickly
+# pylint: disable=import-outside-toplevel
+# pylint: disable=too-many-lines
 
 import argparse
 import copy
 import json
 import os
-import shutil
+import subprocess
 import sys
-import tarfile
 import time
-import urllib.error
-import urllib.request
-import yaml
 
-VETH_NUM = 0
-TUNNEL_NUM = 1
-NAMESPACE_TO_POD = {}
+import tunnel_layout
+from allocator import Allocations
 
 
 def get_config(config_path):
     """Read yaml config file"""
-    with open(config_path, encoding="utf8") as file_handle:
-        return yaml.safe_load(file_handle)
+    from config_cache import load_yaml
+    return load_yaml(config_path)
 
 
 class InvalidDUT(Exception):
@@ -32,77 +31,147 @@ class InvalidDUT(Exception):
     """
 
 
-def serial_for_dut(dut_name, hardware):
-    """
-    Returns (pod host, tty) of the passed dut name
-    if dut_name is not found, an exception is raised
-    """
-    for _, site_config in hardware["sites"].items():
-        for _, pod_config in site_config["pods"].items():
-            if "console" in pod_config:
-                console_config = pod_config["console"]
-                for id_type in ["serial", "tty"]:
-                    if id_type in console_config:
-                        for ID, id_info in console_config[id_type].items():
-                            if id_info["dut_name"] == dut_name:
-                                return pod_config["host"], id_type, ID
-    raise InvalidDUT(dut_name)
-
-
 class InvalidPod(Exception):
     """
     Raised when a pod name is not found
     """
 
 
-def get_pod_site(pod, hardware):
-    """
-    Return the site where a pod lives
-    """
-    for site, site_config in hardware["sites"].items():
-        for curr_pod in site_config["pods"]:
-            if curr_pod == pod:
-                return site
-    raise InvalidPod(pod)
-
-
 class InvalidMember(Exception):
     """
     Raised when a specified DUT/port is not in the hardware config
     """
 
 
-def get_pod(member, hardware):
+class HardwareIndex:  # pylint: disable=too-many-instance-attributes
     """
-    Returns the pod that connects to a DUT/port
+    Lookup tables built once from the administrator defined hardware config,
+    so that generation and CLI commands don't walk every site/pod per lookup.
+    Duplicate wiring entries are reported when the index is built,
+    and the first entry encountered wins.
     """
-    for _, site_config in hardware["sites"].items():
-        for pod, pod_config in site_config["pods"].items():
-            for _, dev_info in pod_config["ethernet"].items():
-                if member["dut_name"] == dev_info["dut_name"] and \
-                        member["dut_port"] == dev_info["dut_port"]:
-                    return pod
-    raise InvalidMember("DUT:{member['dut_name']}, PORT:{member['dut_port']}")
+    def __init__(self, hardware):
+        self.hardware = hardware
+        # pod -> site
+        self.pod_to_site = {}
+        # pod -> pod config
+        self.pods = {}
+        # (dut_name, dut_port) -> (pod, netdev)
+        self.member_to_port = {}
+        # dut_name -> (pod host, id type, id)
+        self.dut_to_console = {}
+        # site -> pods
+        self.site_to_pods = {}
+        # site -> tunneling pod
+        self.site_to_tunneling_pod = {}
+        self.duplicates = []
+
+        for site, site_config in hardware["sites"].items():
+            self.site_to_tunneling_pod[site] = site_config["tunneling_pod"]
+            self.site_to_pods[site] = []
+            for pod, pod_config in site_config["pods"].items():
+                self._add_pod(site, pod, pod_config)
+
+        for duplicate in self.duplicates:
+            print(f"duplicate hardware entry: {duplicate}")
+
+    def _add_pod(self, site, pod, pod_config):
+        """
+        Index a single pod's site, ethernet wiring and console wiring
+        """
+        if pod in self.pod_to_site:
+            self.duplicates.append(
+                f"pod: {pod} in site: {site} already defined in site: {self.pod_to_site[pod]}")
+            return
+        self.pod_to_site[pod] = site
+        self.pods[pod] = pod_config
+        self.site_to_pods[site].append(pod)
+
+        for dev, dev_info in pod_config["ethernet"].items():
+            key = (dev_info["dut_name"], dev_info["dut_port"])
+            if key in self.member_to_port:
+                self.duplicates.append(
+                    f"DUT:{key[0]}, PORT:{key[1]} wired to pod: {pod}, netdev: {dev} "
+                    f"and pod: {self.member_to_port[key][0]}, "
+                    f"netdev: {self.member_to_port[key][1]}")
+                continue
+            self.member_to_port[key] = (pod, dev)
+
+        console_config = pod_config.get("console", {})
+        for id_type in ["serial", "tty"]:
+            for console_id, id_info in console_config.get(id_type, {}).items():
+                dut_name = id_info["dut_name"]
+                if dut_name in self.dut_to_console:
+                    self.duplicates.append(
+                        f"DUT:{dut_name} console on pod: {pod}, {id_type}: {console_id} "
+                        f"and host: {self.dut_to_console[dut_name][0]}, "
+                        f"{self.dut_to_console[dut_name][1]}: {self.dut_to_console[dut_name][2]}")
+                    continue
+                self.dut_to_console[dut_name] = (pod_config["host"], id_type, console_id)
+
+    def serial_for_dut(self, dut_name):
+        """
+        Returns (pod host, id type, id) of the passed dut name
+        if dut_name is not found, an exception is raised
+        """
+        try:
+            return self.dut_to_console[dut_name]
+        except KeyError:
+            raise InvalidDUT(dut_name) from None
 
+    def get_pod_site(self, pod):
+        """
+        Return the site where a pod lives
+        """
+        try:
+            return self.pod_to_site[pod]
+        except KeyError:
+            raise InvalidPod(pod) from None
 
-def get_netdev(member, hardware):
-    """
-    Returns the pod's netdev that connects to a DUT/port
-    or simulated wired client
-    """
-    if member["type"] == "dut":
-        for _, site_config in hardware["sites"].items():
-            for _, pod_config in site_config["pods"].items():
-                for dev, dev_info in pod_config["ethernet"].items():
-                    if member["dut_name"] == dev_info["dut_name"] and \
-                            member["dut_port"] == dev_info["dut_port"]:
-                        return dev
-        raise InvalidMember("DUT:{member['dut_name']}, PORT:{member['dut_port']}")
+    def pod_host(self, pod):
+        """
+        Return the control network address of a pod
+        """
+        try:
+            return self.pods[pod]["host"]
+        except KeyError:
+            raise InvalidPod(pod) from None
+
+    def tunneling_pod(self, site):
+        """
+        Return the pod that terminates GRE tunnels for a site
+        """
+        return self.site_to_tunneling_pod[site]
+
+    def tunnel_cost(self, site1, site2):
+        """
+        Cost of a tunnel between two sites, per the optional tunnel_costs
+        section of the hardware config. Unlisted pairs cost 1
+        """
+        costs = self.hardware.get("tunnel_costs") or {}
+        return (costs.get(site1) or {}).get(site2, (costs.get(site2) or {}).get(site1, 1))
+
+    def get_port(self, member):
+        """
+        Returns (pod, netdev) that connects to a DUT/port
+        """
+        try:
+            return self.member_to_port[(member["dut_name"], member["dut_port"])]
+        except KeyError:
+            raise InvalidMember(
+                f"DUT:{member['dut_name']}, PORT:{member['dut_port']}") from None
 
-    if member["type"] == "sim_wired_client":
-        return f"veth{VETH_NUM}"
+    def get_pod(self, member):
+        """
+        Returns the pod that connects to a DUT/port
+        """
+        return self.get_port(member)[0]
 
-    raise TypeError(f"member type: {member['type']} unknown")
+    def get_netdev(self, member):
+        """
+        Returns the pod's netdev that connects to a DUT/port
+        """
+        return self.get_port(member)[1]
 
 
 class TunnelConfig:  # pylint: disable=too-few-public-methods
@@ -116,38 +185,7 @@ class TunnelConfig:  # pylint: disable=too-few-public-methods
         self.right_bridge_name = right_bridge_name
 
 
-def create_tunnel(tunnel_config, hardware, ret):
-    """
-    Create a GRE tunnel configurations for both endpoints.
-    This entails the GRE tunnel configuration and
-    including the gre interfaces in their correct bridge
-    """
-    global TUNNEL_NUM  # pylint: disable=global-statement
-    left_site_info = hardware["sites"][tunnel_config.left_site]
-    left_pod = left_site_info["tunneling_pod"]
-    right_site_info = hardware["sites"][tunnel_config.right_site]
-    right_pod = right_site_info["tunneling_pod"]
-    ret[left_pod]["tunnels"][f"gretap{TUNNEL_NUM}"] = {
-        "type": "gretap",
-        "key": TUNNEL_NUM,
-        "local": left_site_info["pods"][left_pod]["host"],
-        "remote": right_site_info["pods"][right_pod]["host"],
-    }
-
-    ret[right_pod]["tunnels"][f"gretap{TUNNEL_NUM}"] = {
-        "type": "gretap",
-        "key": TUNNEL_NUM,
-        "local": right_site_info["pods"][right_pod]["host"],
-        "remote": left_site_info["pods"][left_pod]["host"],
-    }
-    ret[left_pod]["bridges"][tunnel_config.left_bridge_name]["virtual_members"].append(
-        f"gretap{TUNNEL_NUM}")
-    ret[right_pod]["bridges"][tunnel_config.right_bridge_name]["virtual_members"].append(
-        f"gretap{TUNNEL_NUM}")
-    TUNNEL_NUM += 1
-
-
-def get_bridge_name(pod, configured_bridge_name, bridge_config, hardware):
+def get_bridge_name(pod, configured_bridge_name, bridge_config, index):
     """
     Determine the correct bridge name.
     Don't use the bridge name supplied by the user
@@ -156,9 +194,8 @@ def get_bridge_name(pod, configured_bridge_name, bridge_config, hardware):
     """
     # default to the user configured bridge name
     bridge_name = configured_bridge_name
-    site = get_pod_site(pod, hardware)
-    if bridge_config["wan"] == site:
-        bridge_name = hardware["sites"][site]["pods"][pod]["wan_bridge"]["name"]
+    if bridge_config["wan"] == index.get_pod_site(pod):
+        bridge_name = index.pods[pod]["wan_bridge"]["name"]
     return bridge_name
 
 
@@ -166,14 +203,17 @@ class GeneratedConfig:
     """
     Used to construct the intermediate config
     """
-    def __init__(self, hardware):
-        self.pod_to_site = {}
-        self.bridge_to_vlan = {}
-        self.vlan_number = 1
+    def __init__(self, index, default_layout="mesh", allocations=None):
         self.config = {}
-        self.hardware = hardware
-
-    def add_pod(self, pod, pod_info, site):
+        self.index = index
+        # layout of bridges that don't choose their own
+        self.default_layout = default_layout
+        # VLAN IDs, GRE keys and interface numbers
+        self.allocations = allocations or Allocations()
+        # simulated client namespace -> pod
+        self.namespace_to_pod = {}
+
+    def add_pod(self, pod, pod_info):
         """
         Include a pod in the generated config
         """
@@ -186,48 +226,89 @@ class GeneratedConfig:
         self.config[pod] = copy.deepcopy(pod_config)
         self.config[pod]["wan_bridge"] = copy.deepcopy(pod_info["wan_bridge"])
         self.config[pod]["trunk_ports"] = copy.deepcopy(pod_info["trunk_ports"])
-        self.pod_to_site[pod] = site
+
+    def get_pod_bridge(self, pod, bridge, bridge_config):
+        """
+        Returns the pod's config for a bridge, creating it if need be.
+        Each bridge is assigned a VLAN ID that is unique within each of its sites,
+        from its vlan_range, if it has one
+        """
+        bridge_name = get_bridge_name(pod, bridge, bridge_config, self.index)
+        if bridge_name not in self.config[pod]["bridges"]:
+            site = self.index.get_pod_site(pod)
+            self.config[pod]["bridges"][bridge_name] = {
+                "vid": self.allocations.vlans.get(site, bridge, bridge_config.get("vlan_range"))
+                if bridge_name == bridge else 1,
+                "physical_members": [],
+                "virtual_members": [],
+            }
+        return self.config[pod]["bridges"][bridge_name]
+
+    def add_tunnel(self, bridge, tunnel_config, isolated=True, keys=None):
+        """
+        Create a GRE tunnel configurations for both endpoints.
+        This entails the GRE tunnel configuration and
+        including the gre interfaces in their correct bridge.
+        A bridge's key only needs to be unique between its pair of pods,
+        and is taken from keys, (first, last), if given.
+        isolated tunnels may not forward to other tunnels on the same bridge
+        """
+        left_pod = self.index.tunneling_pod(tunnel_config.left_site)
+        right_pod = self.index.tunneling_pod(tunnel_config.right_site)
+        key = self.allocations.gre_keys.get(" ".join(sorted([left_pod, right_pod])), bridge,
+                                            keys)
+        for pod, peer, bridge_name in [(left_pod, right_pod, tunnel_config.left_bridge_name),
+                                       (right_pod, left_pod, tunnel_config.right_bridge_name)]:
+            tunnel = f"gretap{self.allocations.tunnels.get(pod, f'{bridge} {peer}')}"
+            self.config[pod]["tunnels"][tunnel] = {
+                "type": "gretap",
+                "key": key,
+                "local": self.index.pod_host(pod),
+                "remote": self.index.pod_host(peer),
+                "isolated": isolated,
+            }
+            self.config[pod]["bridges"][bridge_name]["virtual_members"].append(tunnel)
 
     def add_bridge_to_sites(self, bridge, bridge_config, sorted_bridge_sites):
         """
         Interconnected bridge across sites
         """
         for site in sorted_bridge_sites:
-            for pod in self.hardware["sites"][site]["pods"]:
-                bridge_name = get_bridge_name(
-                    pod, bridge, bridge_config, self.hardware)
-                if bridge_name not in self.config[pod]["bridges"]:
-                    self.config[pod]["bridges"][bridge_name] = {
-                        "vid": self.bridge_to_vlan[bridge] if bridge_name == bridge else 1,
-                        "physical_members": [],
-                        "virtual_members": [],
-                    }
-
-        for index, site1 in enumerate(sorted_bridge_sites):
-            for site2 in sorted_bridge_sites[index + 1:]:
-                site1_bridge = get_bridge_name(
-                    self.hardware["sites"][site1]["tunneling_pod"],
-                    bridge, bridge_config, self.hardware)
-                site2_bridge = get_bridge_name(
-                    self.hardware["sites"][site2]["tunneling_pod"],
-                    bridge, bridge_config, self.hardware)
-                create_tunnel(TunnelConfig(site1, site2, site1_bridge, site2_bridge),
-                              self.hardware, self.config)
+            for pod in self.index.site_to_pods[site]:
+                self.get_pod_bridge(pod, bridge, bridge_config)
+
+        layout = bridge_config.get("tunnel_layout") or self.default_layout
+        for site1, site2 in tunnel_layout.tunnel_pairs(
+                layout, sorted_bridge_sites, self.index.tunnel_cost, bridge_config["wan"]):
+            site1_bridge = get_bridge_name(
+                self.index.tunneling_pod(site1), bridge, bridge_config, self.index)
+            site2_bridge = get_bridge_name(
+                self.index.tunneling_pod(site2), bridge, bridge_config, self.index)
+            self.add_tunnel(bridge, TunnelConfig(site1, site2, site1_bridge, site2_bridge),
+                            tunnel_layout.isolated(layout), bridge_config.get("gre_key_range"))
+
+    def add_wired_client(self, pod, namespace):
+        """
+        Add a namespace with one end of a veth pair, and return the other end
+        """
+        veth_num = 2 * self.allocations.veths.get(pod, namespace)
+        self.config[pod]["veth_pairs"][f"veth{veth_num}"] = f"veth{veth_num + 1}"
+        self.config[pod]["namespaces"][namespace] = {
+            "client_type": "wired", "port": f"veth{veth_num + 1}"
+        }
+        self.namespace_to_pod[namespace] = pod
+        return f"veth{veth_num}"
 
     def add_bridge_config(self, bridge, bridge_config):
         """
         Add a bridge's config to the self.generated_config
         """
-        global VETH_NUM  # pylint: disable=global-statement
-        # each bridge is assigned a globally unique vlan number
-        self.vlan_number = self.vlan_number + 1
-        self.bridge_to_vlan[bridge] = self.vlan_number
         sites = set()
         for member in bridge_config["members"]:
             if member["type"] == "dut":
                 member_list = "physical_members"
                 try:
-                    pod = get_pod(member, self.hardware)
+                    pod, netdev = self.index.get_port(member)
                 except InvalidMember:
                     print(
                         f"Configured member name:{member['dut_name']}, port:{member['dut_port']} not found in the self.hardware config")  # pylint: disable=line-too-long  # noqa: E501
@@ -235,259 +316,836 @@ class GeneratedConfig:
             elif member["type"] == "sim_wired_client":
                 member_list = "virtual_members"
                 pod = member["pod"]
+                netdev = self.add_wired_client(pod, member["namespace"])
+            else:
+                raise TypeError(f"member type: {member['type']} unknown")
 
-            sites.add(self.pod_to_site[pod])
-            bridge_name = get_bridge_name(pod, bridge, bridge_config, self.hardware)
-            if bridge_name not in self.config[pod]["bridges"]:
-                self.config[pod]["bridges"][bridge_name] = {
-                    "vid": self.vlan_number if bridge_name == bridge else 1,
-                    "physical_members": [],
-                    "virtual_members": [],
-                }
-            self.config[pod]["bridges"][bridge_name][member_list].append(
-                get_netdev(member, self.hardware))
-
-            if member["type"] == "sim_wired_client":
-                next_veth = VETH_NUM + 1
-                self.config[pod]["veth_pairs"][f"veth{VETH_NUM}"] = f"veth{next_veth}"
-                VETH_NUM = next_veth
-                self.config[pod]["namespaces"][member["namespace"]] = {
-                    "client_type": "wired", "port": f"veth{VETH_NUM}"
-                }
-                VETH_NUM += 1
-                NAMESPACE_TO_POD[member["namespace"]] = pod
+            sites.add(self.index.get_pod_site(pod))
+            self.get_pod_bridge(pod, bridge, bridge_config)[member_list].append(netdev)
         if bridge_config["wan"]:
             sites.add(bridge_config["wan"])
 
         self.add_bridge_to_sites(bridge, bridge_config, sorted(list(sites)))
 
 
-def gen_config(config, hardware):
+def generate(config, index, allocations=None):
     """
     Generate an intermediate config from the administrator defined
     hardware config and the user config. This intermediate config
     is used by the changer script, which is run on the pods, to
     set the system's network configuration.
+    Bridges are generated in name order, so that IDs don't depend on
+    the order of the user config.
     """
-    generated_config = GeneratedConfig(hardware)
+    generated_config = GeneratedConfig(index, config.get("tunnel_layout") or "mesh", allocations)
     # first, create a place holder for each pod in the generated config
-    for site, site_info in hardware["sites"].items():
-        for pod, pod_info in site_info["pods"].items():
-            generated_config.add_pod(pod, pod_info, site)
+    for pod, pod_info in index.pods.items():
+        generated_config.add_pod(pod, pod_info)
     # now, go bridge by bridge, filling the generated config in
-    for bridge, bridge_config in config["bridges"].items():
+    for bridge, bridge_config in sorted(config["bridges"].items()):
         generated_config.add_bridge_config(bridge, bridge_config)
 
     for swc in config["sim_wireless_clients"]:
         generated_config.config[swc["pod"]]["namespaces"][swc["namespace"]] = \
             {"client_type": "wireless", "phy": swc["phy"]}
-        NAMESPACE_TO_POD[swc["namespace"]] = swc["pod"]
-    return generated_config.config
+        generated_config.namespace_to_pod[swc["namespace"]] = swc["pod"]
+    return generated_config
 
 
-def create_tarball(pod, pod_config):
+def gen_config(config, index, allocations=None):
     """
-    Create a tarball to be delivered to a pod
-    Each tarball is named after the pod name,
-    and contains:
-    - the intermediate config for the pod
-    - the changer script
+    Returns the intermediate config of each pod, keyed by pod
     """
-    tarball_name = f"/tmp/{pod}.tar.gz"
-    dir_path = f"/tmp/{pod}"
-    if os.path.isdir(dir_path):
-        shutil.rmtree(dir_path)
-    os.mkdir(dir_path)
-    shutil.copyfile("changer.py", f"{dir_path}/changer.py")
-    with open(f"{dir_path}/config.json", 'w', encoding="utf8") as file_handle:
-        json.dump(pod_config, file_handle, indent=4)
-    with tarfile.open(tarball_name, "w:gz") as tar:
-        tar.add(dir_path, arcname=os.path.basename(dir_path))
-    return tarball_name
+    return generate(config, index, allocations).config
 
 
-class TPLinkError(Exception):
-    """Raised when configuration of a tp-link power plug fails"""
+def power_options(args):
+    """
+    How smart plugs are switched, per the command line args
+    """
+    import power
+    return power.PowerOptions(concurrency=args.power_workers, timeout=args.power_timeout,
+                              retries=args.power_retries)
 
 
-def tp_link_set_power(host, state):
+def set_power(targets, power_config, options=None):
     """
-    Power on/off a device controlled by a tp-link smart plug host
+    Switch the smart plugs of DUTs, where targets maps dut -> "on"/"off",
+    and print a summary of the results
     """
-    out = os.popen(f"./hs100 {host} {state}").read()
-    if '{"system":{"set_relay_state":{"err_code":0}}}' not in out:
-        raise TPLinkError
+    for dut in targets:
+        if dut not in power_config:
+            raise InvalidDUT(f"dut:{dut} not found in power config")
+    import power
+    results = power.apply_power(targets, power_config, options)
+    print(power.format_results(results))
+    return results
 
 
-def tasmota_set_power(host, state):
+def power_targets(config, hardware):
     """
-    Power on/off a device controlled by a tasmota smart plug host
+    Returns dut -> "on"/"off" for every DUT with a smart plug: on when
+    it's configured to be tested, and off otherwise
     """
-    with urllib.request.urlopen(f"http://{host}/cm?cmnd=Power%20{state}") as opened:
-        opened.read()
+    on = set()  # pylint: disable=invalid-name
+    for dut in config["power_on"]:
+        on.add(dut)
+    for _, switch_info in config["bridges"].items():
+        for member_info in switch_info["members"]:
+            if member_info["type"] == "dut":
+                dut = member_info["dut_name"]
+                on.add(dut)
+    return {dut: "on" if dut in on else "off" for dut in hardware["power"]}
 
 
-def power_off(dut, power_config):
+def do_power(config, hardware, options=None):
     """
-    Power off a dut
+    Turn off all DUTs not being tested, and
+    turn on DUTs that are configured to be tested.
+    The function is will not turn off a dut
+    that is currently running and is configured
+    to run.
     """
-    if dut not in power_config:
-        raise InvalidDUT(f"dut:{dut} not found in power config")
-
-    host = power_config[dut]["host"]
-    host_type = power_config[dut]["type"]
-    if host_type == "tasmota":
-        try:
-            tasmota_set_power(host, "off")
-        except urllib.error.URLError:
-            print(f"unable to reach smart plug: {host} for dut: {dut}")
-    elif host_type == "tp-link":
-        try:
-            tp_link_set_power(host, "off")
-        except TPLinkError:
-            print(f"unable to reach smart plug: {host} for dut: {dut}")
-    else:
-        print(f"unknown power plug type: {host_type} for dut: {dut}")
+    return set_power(power_targets(config, hardware), hardware["power"], options)
 
 
-def power_on(dut, power_config):
+def health_options(args):
     """
-    Power on a dut
+    How hosts are probed, per the command line args
     """
-    if dut not in power_config:
-        raise InvalidDUT(f"dut:{dut} not found in power config")
+    import health
+    return health.HealthOptions(concurrency=args.health_workers, timeout=args.health_timeout,
+                                count=args.health_count)
 
-    host = power_config[dut]["host"]
-    host_type = power_config[dut]["type"]
-    if host_type == "tasmota":
-        try:
-            tasmota_set_power(host, "on")
-        except urllib.error.URLError:
-            print(f"unable to reach smart plug: {host} for dut: {dut}")
-    elif host_type == "tp-link":
-        try:
-            tp_link_set_power(host, "on")
-        except TPLinkError:
-            print(f"unable to reach smart plug: {host} for dut: {dut}")
+
+def do_health(index, args):
+    """
+    Print the health of the fabric, exiting with 1 if anything is unhealthy
+    """
+    import health
+    results = health.check_fabric(index, args.transport, health_options(args))
+    if args.json:
+        print(json.dumps(results, indent=4))
     else:
-        print(f"unknown power plug type: {host_type} for dut: {dut}")
+        print(health.format_results(results))
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
 
 
-def do_power(config, hardware):
+def do_status(index, config, args):
     """
-    Turn off all DUTs not being tested, and
-    turn on DUTs that are configured to be tested.
-    The function is will not turn off a dut
-    that is currently running and is configured
-    to run.
+    Snapshot every pod's live state and print how it drifted from the config,
+    exiting with 1 if any pod drifted or couldn't be read
     """
-    on = set()  # pylint: disable=invalid-name
-    for dut in config["power_on"]:
-        on.add(dut)
-    for _, switch_info in config["bridges"].items():
-        for member_info in switch_info["members"]:
-            if member_info["type"] == "dut":
-                dut = member_info["dut_name"]
-                on.add(dut)
-    power_conf = hardware["power"]
-    for dut in power_conf:
-        if dut in on:
-            power_on(dut, power_conf)
-        else:
-            power_off(dut, power_conf)
+    import drift
+    from pod_state import load_allocations, load_leases
+    if args.transport == "expect":
+        print("status needs the ssh, netns or agent transport")
+        sys.exit(1)
+    if leased():
+        import tenancy
+        config = tenancy.merged_config(load_leases())
+    generated = gen_config(config, index, Allocations(load_allocations()))
+    report = drift.check(index, generated, args)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print(drift.format_report(report))
+    if any(result["status"] != "in_sync" for result in report):
+        sys.exit(1)
 
 
-def get_args():
+def preflight(index, args):
+    """
+    Block create unless every pod can be reached
+    """
+    if args.skip_health or args.transport == "netns":
+        return
+    import health
+    results = health.check_fabric(index, args.transport, health_options(args), ["pod"])
+    failed = [result for result in results if not result["ok"]]
+    if failed:
+        print(health.format_results(failed))
+        print(f"create blocked: {len(failed)} pods failed pre-flight checks, "
+              "pass --skip-health to create anyway")
+        sys.exit(1)
+
+
+def get_args(argv=None):
     """
-    Process command line args
+    Process command line args, or argv
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("command", help="command: destroy/create/serial/client",
-                        type=str)
+    parser.add_argument("command", type=str,
+                        help="command: destroy/create/watch/sweep/status/health/monitor/"
+                        "bench-segment/serial/serials/client/reserve/release/leases")
     parser.add_argument("--config", help="config file")
     parser.add_argument("--hardware", help="hardware config file")
     parser.add_argument("--namespace", help="namespace of client")
     parser.add_argument("--dut", help="dut name for serial connection")
+    parser.add_argument("--transport", choices=["ssh", "agent", "expect", "netns"],
+                        help="how pods are configured: multiplexed ssh, a long running "
+                        "pod agent, the legacy connect.expect script, or pods emulated "
+                        "by emulator.py. Defaults to the hardware config's transport, or ssh")
+    parser.add_argument("--agent-token",
+                        help="shared secret that the pod agents were started with, "
+                        "unless a pod has its own agent_token in the hardware config")
+    parser.add_argument("--full", action="store_true",
+                        help="tear down and rebuild pods, rather than applying changes "
+                        "(not supported by the expect transport)")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="maximum number of pods configured at once")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds allowed to configure each pod")
+    parser.add_argument("--force", action="store_true",
+                        help="configure every pod, even those whose config is unchanged, "
+                        "ie. after pods were rebooted")
+    parser.add_argument("--power-workers", type=int, default=16,
+                        help="maximum number of smart plugs switched at once")
+    parser.add_argument("--power-timeout", type=float, default=3,
+                        help="seconds allowed for each smart plug request")
+    parser.add_argument("--power-retries", type=int, default=2,
+                        help="times a failed smart plug is retried")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="time each phase of create, on the controller and on each pod, "
+                        "and write them to PATH as a Chrome trace")
+    parser.add_argument("--sweep", nargs="+", metavar="PATH",
+                        help="configs, or generator specs, that sweep steps through")
+    parser.add_argument("--hook", help="shell command run at each step of a sweep, "
+                        "ie. to run tests")
+    parser.add_argument("--report", metavar="PATH",
+                        help="write a sweep's results to PATH as JSON")
+    parser.add_argument("--keep-order", action="store_true",
+                        help="sweep through steps in the order given")
+    parser.add_argument("--health-timeout", type=float, default=2,
+                        help="seconds allowed for all health checks")
+    parser.add_argument("--health-workers", type=int,
+                        help="maximum number of hosts probed at once by health checks, "
+                        "all of them by default, so that they finish within one timeout")
+    parser.add_argument("--health-count", type=int, default=3,
+                        help="pings sent to each host by health checks")
+    parser.add_argument("--skip-health", action="store_true",
+                        help="create without checking that every pod is reachable first, "
+                        "or between rollout waves")
+    parser.add_argument("--rollout", choices=["waves", "parallel"], default="waves",
+                        help="apply pods in waves, leaves before the uplinks they reach the "
+                        "controller through, checking reachability between waves, or all "
+                        "pods at once")
+    parser.add_argument("--log-max-bytes", type=int, default=10 * 2**20,
+                        help="size at which logs/pods.jsonl, the output of every pod, "
+                        "is rotated")
+    parser.add_argument("--log-backups", type=int, default=5,
+                        help="rotated pod logs kept")
+    parser.add_argument("--snapshot-max-age", type=float, default=120,
+                        help="seconds for which a pod's snapshot, taken by status, is planned "
+                        "from by create, rather than the pod reading its state again")
+    parser.add_argument("--json", action="store_true",
+                        help="print status, health, leases or bench-segment results as JSON")
+    parser.add_argument("--interval", type=float, default=5,
+                        help="seconds between monitor samples")
+    parser.add_argument("--metrics-port", type=int,
+                        help="port that monitor serves Prometheus metrics on, at /metrics")
+    parser.add_argument("--monitor-output", metavar="PATH",
+                        help="append monitor samples to PATH as JSON lines, or - for stdout")
+    parser.add_argument("--duration", type=float,
+                        help="seconds to monitor or watch for, rather than until interrupted, "
+                        "or to send bench-segment traffic for, 5 by default")
+    parser.add_argument("--tenant", help="tester whose lease reserve, release and create act on")
+    parser.add_argument("--duts", nargs="+", default=[], metavar="DUT",
+                        help="DUTs that reserve leases to the tenant")
+    parser.add_argument("--pods", nargs="+", default=[], metavar="POD",
+                        help="pods whose clients reserve leases to the tenant")
+    parser.add_argument("--vlans", metavar="FIRST-LAST",
+                        help="VLAN IDs that reserve leases to the tenant")
+    parser.add_argument("--gre-keys", metavar="FIRST-LAST",
+                        help="GRE keys that reserve leases to the tenant")
+    parser.add_argument("--lease-hours", type=float, default=8,
+                        help="hours until a reservation expires, unless it's renewed")
+    parser.add_argument("--bridge", help="bridge whose sim_wired_clients bench-segment uses")
+    parser.add_argument("--size", type=int, default=1400,
+                        help="UDP payload bytes of bench-segment traffic")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Mbit/s of bench-segment traffic, or 0 for as fast as possible")
+    parser.add_argument("--tool", choices=["auto", "python", "iperf3"], default="auto",
+                        help="bench-segment traffic generator: auto uses iperf3 when every "
+                        "pod has it")
+
+    args = parser.parse_args(argv)
+    if args.command == "monitor" and args.metrics_port is None and not args.monitor_output:
+        parser.error("monitor needs somewhere to send samples: --metrics-port, "
+                     "--monitor-output, or both")
+    return args
+
+
+def converge(index, generated, args):
+    """
+    Apply generated configs to the pods whose payload changed since they were
+    last applied, and record which pods are now known to be up to date.
+    Pods with a recent snapshot are planned from it, and pods are applied in
+    waves, leaves before the uplinks they depend on, unless asked not to.
+    Returns the pods that were applied, and the results of those that failed
+    """
+    import drift
+    import rollout
+    import pod_state
+    from configure import apply_payloads
+    from profiler import CONTROLLER
+    from podlog import PodLog
+    profiler = args.profiler
+    with profiler.span(CONTROLLER, "plan payloads"):
+        args.changer_hash = pod_state.file_hash("changer.py")
+        applied = pod_state.load_pod_state()
+        payloads = pod_state.plan_payloads(generated, applied, args.changer_hash,
+                                           args.force or args.full)
+        if not args.full:
+            drift.attach_snapshots(payloads, args.snapshot_max_age)
+    for pod in generated:
+        if pod not in payloads:
+            print(f"pod: {pod}, host: {index.pod_host(pod)} unchanged, skipped")
+
+    args.pod_log = PodLog(max_bytes=args.log_max_bytes, backups=args.log_backups)
+    try:
+        with profiler.span(CONTROLLER, "apply"):
+            if args.rollout == "waves":
+                results = rollout.apply_in_waves(
+                    index, payloads, args,
+                    None if args.skip_health or args.transport == "netns" else
+                    health_options(args))
+            else:
+                results = apply_payloads(index, payloads, args)
+    finally:
+        args.pod_log.close()
+    drift.forget_snapshots(payloads)
+    for pod, payload in payloads.items():
+        if results[pod]["status"] == "ok":
+            applied[pod] = {"payload_hash": payload["hash"],
+                            "changer_hash": args.changer_hash}
+        else:
+            # unknown state, so the pod is always applied next time
+            applied.pop(pod, None)
+    pod_state.save_pod_state(applied)
+    return sorted(payloads), {pod: result for pod, result in results.items()
+                              if result["status"] != "ok"}
+
+
+def write_profile(args):
+    """
+    Write the profile and print its summary, if asked to
+    """
+    from profiler import format_summary
+    if args.profile:
+        args.profiler.write(args.profile)
+        print("\n".join(format_summary(args.profiler.summary())))
+        print(f"profile written to {args.profile}")
+
+
+def do_create(index, config, args):
+    """
+    Synthesize the configured virtual L2 config, holding the state lock
+    from loading the controller's state until it's saved
+    """
+    from pod_state import state_lock
+    with state_lock():
+        if args.tenant:
+            do_tenant_create(index, config, args)
+        else:
+            fabric_create(index, config, args)
+
+
+def fabric_create(index, config, args):
+    """
+    Synthesize the configured virtual L2 config on the whole fabric
+    """
+    from configure import format_failures
+    from pod_state import load_allocations, save_allocations
+    from profiler import CONTROLLER, Profiler
+    exclusive("create", "create with --tenant, or release them first")
+    os.makedirs("logs", exist_ok=True)
+    args.profiler = profiler = Profiler()
+    with profiler.span(CONTROLLER, "preflight"):
+        preflight(index, args)
+    with profiler.span(CONTROLLER, "generate config"):
+        allocations = Allocations(load_allocations())
+        generated = gen_config(config, index, allocations)
+        save_allocations(allocations.to_dict())
+    # power on the DUTS being tested
+    with profiler.span(CONTROLLER, "power"):
+        do_power(config, index.hardware, power_options(args))
+    _, failed = converge(index, generated, args)
+    write_profile(args)
+    if failed:
+        print(format_failures(index, failed))
+        sys.exit(1)
+
+
+def leased():
+    """
+    Returns the tenants whose leases are active
+    """
+    import tenancy
+    from pod_state import load_leases
+    return sorted(tenancy.active(load_leases()))
+
+
+def exclusive(command, hint="release them first"):
+    """
+    Exit if any tenant has a lease, as command acts on the whole fabric
+    """
+    tenants = leased()
+    if tenants:
+        print(f"{command} acts on the whole fabric, which is leased to: "
+              f"{', '.join(tenants)}, {hint}")
+        sys.exit(1)
 
-    return parser.parse_args()
+
+def tenant_power(index, leases, tenant, config=None):
+    """
+    Returns dut -> "on"/"off" for the tenant's DUTs with smart plugs:
+    on when config tests them, and off otherwise
+    """
+    targets = power_targets(config or {"bridges": {}, "power_on": []}, index.hardware)
+    return {dut: target for dut, target in targets.items() if dut in leases[tenant]["duts"]}
 
 
-def do_create(hardware, config):
+def converge_tenants(index, leases, power, args):
     """
-    Synthesize the configured virtual L2 config
+    Apply every active tenant's topology, leaving the others' as they are,
+    and switch only the DUTs in power, and those of expired leases, off
     """
+    import tenancy
+    from configure import format_failures
+    from pod_state import load_allocations, save_allocations, save_leases
+    from profiler import CONTROLLER, Profiler
+    power = {**{dut: "off" for dut in tenancy.expire(leases)
+                if dut in index.hardware["power"]}, **power}
+    save_leases(leases)
+    os.makedirs("logs", exist_ok=True)
+    args.profiler = profiler = Profiler()
+    with profiler.span(CONTROLLER, "generate config"):
+        allocations = Allocations(load_allocations())
+        generated = gen_config(tenancy.merged_config(leases), index, allocations)
+        save_allocations(allocations.to_dict())
+    with profiler.span(CONTROLLER, "power"):
+        if power:
+            set_power(power, index.hardware["power"], power_options(args))
+    _, failed = converge(index, generated, args)
+    write_profile(args)
+    if failed:
+        print(format_failures(index, failed))
+        sys.exit(1)
+
+
+def do_tenant_create(index, config, args):
+    """
+    Synthesize a tenant's topology, within its lease
+    """
+    import tenancy
+    from pod_state import load_leases
+    if args.full:
+        print("create --full would tear down every tenant's topology")
+        sys.exit(1)
+    leases = load_leases()
     try:
-        os.makedirs("logs")
-    except FileExistsError:
+        tenancy.check_config(leases, args.tenant, config)
+    except tenancy.ReservationError as error:
+        print(error)
+        sys.exit(1)
+    preflight(index, args)
+    leases[args.tenant]["config"] = config
+    converge_tenants(index, leases, tenant_power(index, leases, args.tenant, config), args)
+
+
+def do_reserve(index, args):
+    """
+    Lease DUTs, pods, VLAN IDs and GRE keys to a tenant, or renew its lease
+    """
+    import tenancy
+    from pod_state import load_leases, save_leases, state_lock
+    if not args.tenant or not args.vlans or not args.gre_keys:
+        print("reserve needs --tenant, --vlans and --gre-keys")
+        sys.exit(1)
+    with state_lock():
+        leases = load_leases()
+        try:
+            lease = tenancy.reserve(leases, index, args.tenant, {
+                "duts": args.duts, "pods": args.pods, "vlans": args.vlans,
+                "gre_keys": args.gre_keys, "hours": args.lease_hours})
+        except tenancy.ReservationError as error:
+            print(error)
+            sys.exit(1)
+        save_leases(leases)
+    print(f"tenant: {args.tenant} leased {len(lease['duts'])} DUTs and "
+          f"{len(lease['pods'])} pods for {args.lease_hours} hours")
+
+
+def do_release(index, args):
+    """
+    End a tenant's lease, tearing its topology down and powering its DUTs off
+    """
+    from pod_state import load_leases, state_lock
+    with state_lock():
+        leases = load_leases()
+        if not args.tenant or args.tenant not in leases:
+            print(f"tenant: {args.tenant} has no lease")
+            sys.exit(1)
+        power = tenant_power(index, leases, args.tenant)
+        del leases[args.tenant]
+        converge_tenants(index, leases, power, args)
+
+
+def do_leases(_index, args):
+    """
+    Print the active leases
+    """
+    import tenancy
+    from pod_state import load_leases
+    leases = tenancy.active(load_leases())
+    if args.json:
+        print(json.dumps(leases, indent=4))
+    else:
+        print(tenancy.format_leases(leases))
+
+
+class WatchedTopology:
+    """
+    What watch last applied: each pod's generated config and the DUTs' power
+    targets, kept in memory so that an edit only switches the DUTs, and applies
+    the pods, that it changed
+    """
+    def __init__(self, args):
+        from pod_state import load_allocations
+        self.args = args
+        self.allocations = Allocations(load_allocations())
+        self.generated = {}
+        self.power = None
+
+    def load(self):
+        """
+        Returns the hardware index, generated configs, power targets and
+        smart plugs, per the config and hardware files
+        """
+        from config_cache import load_config
+        hardware = load_config(self.args.hardware)
+        config = load_config(self.args.config)
+        index = HardwareIndex(hardware)
+        return index, gen_config(config, index, self.allocations), \
+            power_targets(config, hardware), hardware["power"]
+
+    def apply(self, paths=()):
+        """
+        Converge on the files as they are now. Files that can't be loaded, ie.
+        saved part way through an edit, leave the previous topology in place
+        """
+        import pod_state
+        import sweep
+        from configure import format_failures
+        from profiler import Profiler
+        start = time.monotonic()
+        try:
+            index, generated, power, power_config = self.load()
+        except SystemExit:
+            # the problem was already printed
+            print("not applied, keeping the previous topology")
+            return
+        except Exception as error:  # pylint: disable=broad-except
+            print(f"not applied, keeping the previous topology: {error}")
+            return
+        switch = sweep.power_changes(self.power, power)
+        if switch:
+            set_power(switch, power_config, power_options(self.args))
+        self.args.profiler = Profiler()
+        with pod_state.state_lock():
+            applied, failed = converge(index, {
+                pod: pod_config for pod, pod_config in generated.items()
+                if self.generated.get(pod) != pod_config}, self.args)
+            pod_state.save_allocations(self.allocations.to_dict())
+        # pods that failed are applied again on the next edit
+        self.generated = {pod: None if pod in failed else pod_config
+                          for pod, pod_config in generated.items()}
+        self.power = power
+        if failed:
+            print(format_failures(index, failed))
+        print(f"{', '.join(paths) or 'started'}: {len(applied)} pods applied, "
+              f"{len(switch)} DUTs switched in {time.monotonic() - start:.3f}s")
+
+
+def do_watch(index, args):
+    """
+    Stay resident, applying the config and hardware files whenever they're saved
+    """
+    import watch
+    exclusive("watch")
+    os.makedirs("logs", exist_ok=True)
+    preflight(index, args)
+    # watched from the start, so that edits made during the first apply aren't missed
+    watcher = watch.file_watcher([args.config, args.hardware])
+    topology = WatchedTopology(args)
+    try:
+        topology.apply()
+        print(f"watching {args.config} and {args.hardware}")
+        watch.watch(watcher, topology.apply, args.duration)
+    except KeyboardInterrupt:
         pass
+    finally:
+        watcher.close()
 
-    generated = gen_config(config, hardware)
-    # power on the DUTS being tested
-    do_power(config, hardware)
-
-    pids = {}
-    for _, site_info in hardware["sites"].items():
-        for pod, pod_info in site_info["pods"].items():
-            create_tarball(pod, generated[pod])
-            pid = os.fork()
-            if not pid:
-                new_stdout = os.open(f"logs/{pod}.stdout", os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
-                os.dup2(new_stdout, 1)
-                new_stderr = os.open(f"logs/{pod}.stderr", os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
-                os.dup2(new_stderr, 2)
-                os.execl("./connect.expect", "connect.expect",
-                         "configure", pod_info["host"], pod)
-            else:
-                pids[pid] = {
-                    "name": pod,
-                    "host": pod_info["host"]
-                }
-    for pid, pid_info in pids.items():
-        (pid, exit_code) = os.waitpid(pid, 0)
-        if exit_code:
-            print(
-                f"pod: {pid_info['name']}, host: {pid_info['host']} resulted in {exit_code} exit_code")  # pylint: disable=line-too-long  # noqa: E501
+
+def run_hook(hook, number, name):
+    """
+    Run a sweep's hook for a step, returning its exit code
+    """
+    env = {**os.environ, "TOPOLOGY_SIM_STEP": str(number), "TOPOLOGY_SIM_CONFIG": name}
+    return subprocess.run(hook, shell=True, env=env, check=False).returncode
+
+
+def sweep_step(index, step, previous_power, args):
+    """
+    Converge on a single step of a sweep: switch only the DUTs whose power
+    changed, and apply only the pods whose config changed.
+    Returns the step's results
+    """
+    import sweep
+    from pod_state import state_lock
+    from profiler import CONTROLLER
+    name, generated, targets = step
+    start = time.monotonic()
+    switch = sweep.power_changes(previous_power, targets)
+    with args.profiler.span(CONTROLLER, "power"):
+        if switch:
+            set_power(switch, index.hardware["power"], power_options(args))
+    with state_lock():
+        applied, failed = converge(index, generated, args)
+    return {"config": name, "converge_seconds": round(time.monotonic() - start, 3),
+            "pods_applied": len(applied), "failed_pods": sorted(failed),
+            "power_changes": len(switch), "hook_exit_code": None, "hook_seconds": None}
+
+
+def do_sweep(index, args):
+    """
+    Step through a sequence of topologies, ordered to minimize the changes
+    between them, running the hook at each step
+    """
+    import pod_state
+    import sweep
+    from profiler import Profiler
+    exclusive("sweep")
+    os.makedirs("logs", exist_ok=True)
+    args.profiler = Profiler()
+    preflight(index, args)
+    # one set of allocations, so that a bridge keeps its IDs from step to step
+    with pod_state.state_lock():
+        allocations = Allocations(pod_state.load_allocations())
+        steps = [(name, gen_config(config, index, allocations),
+                  power_targets(config, index.hardware))
+                 for name, config in sweep.load_steps(args.sweep)]
+        pod_state.save_allocations(allocations.to_dict())
+    order = list(range(len(steps))) if args.keep_order else \
+        sweep.order_steps([step[1:] for step in steps])
+
+    results = []
+    previous_power = None
+    for number, step_index in enumerate(order, 1):
+        name = steps[step_index][0]
+        print(f"step {number}/{len(order)}: {name}")
+        results.append(sweep_step(index, steps[step_index], previous_power, args))
+        previous_power = steps[step_index][2]
+        if args.hook:
+            start = time.monotonic()
+            results[-1]["hook_exit_code"] = run_hook(args.hook, number, name)
+            results[-1]["hook_seconds"] = round(time.monotonic() - start, 3)
+    print(sweep.format_report(results))
+    if args.report:
+        with open(args.report, "w", encoding="utf8") as file_handle:
+            json.dump(results, file_handle, indent=4)
+    write_profile(args)
+
+
+def do_client(index, config, args):
+    """
+    Open a shell in a simulated client's namespace
+    """
+    from config_cache import cached
+    from transport import pod_transport
+    namespace, transport = args.namespace, args.transport
+    pod = cached("namespaces", [args.config, args.hardware],
+                 lambda: generate(config, index).namespace_to_pod)[namespace]
+    if transport == "expect":
+        os.execl("./connect.expect", "connect.expect", "ns", index.pod_host(pod), namespace)
+    pod_transport(index, transport).exec_interactive(
+        index.pod_host(pod), f"ip netns exec {namespace} sh")
+
+
+def do_serial(index, dut, transport):
+    """
+    Attach to a DUT's serial console, in a screen session on its pod
+    """
+    from transport import POD_DIR, pod_transport
+    host, id_type, console_id = index.serial_for_dut(dut)
+    if transport == "expect":
+        os.execl("./connect.expect", "connect.expect", "serial", host, id_type, console_id)
+    ssh = pod_transport(index, transport)
+    ssh.push_if_changed(host, "serial-to-tty.py", f"{POD_DIR}/serial-to-tty.py")
+    session = f"{id_type}-{console_id}"
+    ssh.exec_interactive(
+        host, f"screen -x {session} || screen -S {session} -h 100000 "
+        f"/dev/$(python3 {POD_DIR}/serial-to-tty.py {id_type} {console_id}) 115200")
+
+
+def pod_serials(transport, host, timeout):
+    """
+    Returns the serial -> tty map of a pod's USB serial adapters
+    """
+    from configure import PodCommandError
+    from transport import POD_DIR
+    proc = transport.push_if_changed(host, "serial-to-tty.py", f"{POD_DIR}/serial-to-tty.py",
+                                     timeout)
+    if not proc.returncode:
+        proc = transport.run(host, f"python3 {POD_DIR}/serial-to-tty.py", timeout=timeout)
+    if proc.returncode:
+        raise PodCommandError(proc.stderr.decode("utf8").strip() or
+                              f"resulted in {proc.returncode} exit_code")
+    return json.loads(proc.stdout)
+
+
+def print_serials(index, pod, serial_to_tty):
+    """
+    Print a pod's serial -> tty map, along with the DUT on each console
+    and any console that wasn't found
+    """
+    host = index.pod_host(pod)
+    consoles = index.pods[pod].get("console", {}).get("serial", {})
+    for serial, tty in sorted(serial_to_tty.items()):
+        dut = consoles.get(serial, {}).get("dut_name", "-")
+        print(f"pod: {pod}, host: {host}, serial: {serial}, tty: {tty}, dut: {dut}")
+    for serial, serial_info in sorted(consoles.items()):
+        if serial not in serial_to_tty:
+            print(f"pod: {pod}, host: {host}, serial: {serial} not found, "
+                  f"dut: {serial_info['dut_name']}")
+
+
+def do_serials(index, args):
+    """
+    Print the serial -> tty map of every pod, looked up in parallel
+    """
+    import concurrent.futures
+    from configure import PodCommandError
+    from transport import pod_transport
+    transport = pod_transport(index, args.transport)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        futures = {pod: executor.submit(pod_serials, transport, index.pod_host(pod), args.timeout)
+                   for pod in index.pods}
+    for pod, future in sorted(futures.items()):
+        try:
+            print_serials(index, pod, future.result())
+        except (PodCommandError, ValueError, subprocess.TimeoutExpired) as error:
+            print(f"pod: {pod}, host: {index.pod_host(pod)}: {error}")
+
+
+def do_monitor(index, args):
+    """
+    Sample the GRE tunnels of every tunneling pod, until interrupted
+    """
+    import concurrent.futures
+    import changer
+    import monitor
+    from transport import POD_DIR, pod_transport
+    ssh = pod_transport(index, args.transport)
+    hosts = {pod: index.pod_host(pod) for pod in sorted(set(index.site_to_tunneling_pod.values()))}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        list(executor.map(lambda host: ssh.push_if_changed(
+            host, "monitor.py", f"{POD_DIR}/monitor.py", args.timeout), hosts.values()))
+    # monitor.py reads the config the changer applied, from where it's told
+    commands = {pod: ssh.command(host, f"python3 {POD_DIR}/monitor.py sample "
+                                 f"--interval {args.interval} "
+                                 f"--applied-config {changer.APPLIED_CONFIG}")
+                for pod, host in hosts.items()}
+    monitor.run(commands, monitor.MonitorOptions(metrics_port=args.metrics_port,
+                                                 output=args.monitor_output,
+                                                 duration=args.duration))
+
+
+def do_bench_segment(index, config, args):
+    """
+    Measure traffic between the sim_wired_clients on a bridge
+    """
+    import power
+    import segment_bench
+    from pod_state import load_allocations
+    from transport import POD_DIR, pod_transport
+    generated = generate(config, index, Allocations(load_allocations()))
+    if args.bridge not in config["bridges"]:
+        print(f"bridge: {args.bridge} is not in the config")
+        sys.exit(1)
+    endpoints = segment_bench.bridge_clients(config, generated.config, args.bridge,
+                                             index.pod_host)
+    if len(endpoints) < 2:
+        print(f"bridge: {args.bridge} needs at least 2 sim_wired_clients, "
+              f"but has {len(endpoints)}")
+        sys.exit(1)
+    ssh = pod_transport(index, args.transport)
+    for host in sorted({endpoint.host for endpoint in endpoints}):
+        ssh.push_if_changed(host, "segment_bench.py", f"{POD_DIR}/segment_bench.py", args.timeout)
+    options = segment_bench.BenchOptions(duration=args.duration or 5, size=args.size,
+                                         rate=args.rate, tool=args.tool)
+    results = segment_bench.run(ssh, endpoints, options, POD_DIR)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(power.format_table(segment_bench.COLUMNS, [
+            {column: result.get(column) for column in segment_bench.COLUMNS}
+            for result in results]))
+
+
+def do_power_command(command, dut, power_config, options=None):
+    """
+    Act on the power related commands
+    """
+    if command == "toggle_power":
+        set_power({dut: "off"}, power_config, options)
+        # Remove power for at least 2 seconds
+        time.sleep(2)
+        set_power({dut: "on"}, power_config, options)
+    elif command == "power_off":
+        set_power({dut: "off"}, power_config, options)
+    elif command == "power_off_all":
+        exclusive(command)
+        set_power({curr_dut: "off" for curr_dut in power_config}, power_config, options)
+    elif command == "power_on_all":
+        exclusive(command)
+        set_power({curr_dut: "on" for curr_dut in power_config}, power_config, options)
+    elif command == "power_on":
+        set_power({dut: "on"}, power_config, options)
+    else:
+        print(f"unrecognized command: {command}")
 
 
 def main():
     """
     main function that parses command line args and acts accordingly
     """
+    from config_cache import load_config
     args = get_args()
-    config = get_config(args.config if args.config else "config.yaml")
-    hardware = get_config(args.hardware if args.hardware else "hardware.yaml")
+    args.config = args.config or "config.yaml"
+    args.hardware = args.hardware or "hardware.yaml"
+    config = load_config(args.config)
+    hardware = load_config(args.hardware)
+    index = HardwareIndex(hardware)
+    args.transport = args.transport or hardware.get("transport") or "ssh"
+    # commands that act on the fabric as a whole
+    fabric_commands = {"serials": do_serials, "watch": do_watch, "sweep": do_sweep,
+                       "health": do_health, "monitor": do_monitor, "reserve": do_reserve,
+                       "release": do_release, "leases": do_leases}
     if args.command == "create":
-        do_create(hardware, config)
+        do_create(index, config, args)
     elif args.command == "client":
-        # to populuate NAMESPACE_TO_POD
-        gen_config(config, hardware)
-
-        pod = NAMESPACE_TO_POD[args.namespace]
-        os.execl("./connect.expect",
-                 "connect.expect",
-                 "ns",
-                 hardware["sites"][get_pod_site(pod,
-                                                hardware)]["pods"][pod]["host"],
-                 args.namespace)
+        do_client(index, config, args)
     elif args.command == "serial":
-        host, id_type, ID = serial_for_dut(args.dut, hardware)
-        os.execl("./connect.expect", "connect.expect", "serial", host, id_type, ID)
-    elif args.command == "toggle_power":
-        power_off(args.dut, hardware["power"])
-        # Remove power for at least 2 seconds
-        time.sleep(2)
-        power_on(args.dut, hardware["power"])
-    elif args.command == "power_off":
-        power_off(args.dut, hardware["power"])
-    elif args.command == "power_off_all":
-        power_config = hardware["power"]
-        for dut in power_config:
-            power_off(dut, power_config)
-    elif args.command == "power_on_all":
-        power_config = hardware["power"]
-        for dut in power_config:
-            power_on(dut, power_config)
-    elif args.command == "power_on":
-        power_on(args.dut, hardware["power"])
+        do_serial(index, args.dut, args.transport)
+    elif args.command in fabric_commands:
+        fabric_commands[args.command](index, args)
+    elif args.command == "status":
+        do_status(index, config, args)
+    elif args.command == "bench-segment":
+        do_bench_segment(index, config, args)
     else:
-        print(f"unrecognized command: {args.command}")
+        do_power_command(args.command, args.dut, hardware["power"], power_options(args))
@@ -0,0 +1,362 @@
+"""
+Transports that pods are reached over: persistent connections to pod agents,
+multiplexed ssh, and the pods emulated by emulator.py
+"""
+
+import json
+import os
+import selectors
+import socket
+import subprocess
+import time
+
+from pod_state import file_hash
+
+# where scripts are kept on the pods
+POD_DIR = "/tmp/topology-sim"
+
+
+class AgentError(Exception):
+    """
+    Raised when a pod agent can't be reached, or its response can't be parsed
+    """
+
+
+class AgentClient:
+    """
+    Persistent connection to a pod agent.
+    The address is of the form tcp:<host>:<port> or unix:<path>
+    """
+    def __init__(self, address, token=None, timeout=None):
+        self.address = address
+        self.token = token
+        self.timeout = timeout
+        self.sock = None
+        self.file = None
+
+    def connect(self):
+        """
+        Connect to the agent, if not already connected
+        """
+        if self.sock:
+            return
+        kind, _, address = self.address.partition(":")
+        if kind == "unix":
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            target = address
+        elif kind == "tcp":
+            host, _, port = address.rpartition(":")
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            target = (host, int(port))
+        else:
+            raise AgentError(f"unrecognized agent address: {self.address}")
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(target)
+        except OSError as error:
+            self.close()
+            raise AgentError(f"unable to reach agent: {self.address}: {error}") from error
+        self.file = self.sock.makefile("rwb")
+
+    def close(self):
+        """
+        Close the connection to the agent
+        """
+        if self.file:
+            self.file.close()
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.file = None
+
+    def request(self, request):
+        """
+        Send a request and return the agent's response.
+        A connection that went stale since the last request is reopened once.
+        """
+        if self.token is not None:
+            request = {**request, "token": self.token}
+        line = json.dumps(request).encode("utf8") + b"\n"
+        for attempt in range(2):
+            self.connect()
+            try:
+                self.file.write(line)
+                self.file.flush()
+                response = self.file.readline()
+            except OSError as error:
+                self.close()
+                raise AgentError(f"agent: {self.address}: {error}") from error
+            if response:
+                break
+            # the agent closed the connection
+            self.close()
+            if attempt:
+                raise AgentError(f"agent: {self.address} closed the connection")
+        try:
+            return json.loads(response)
+        except ValueError as error:
+            raise AgentError(f"agent: {self.address} sent: {response!r}") from error
+
+
+def agent_address(pod_info):
+    """
+    Returns the address of a pod's agent.
+    Defaults to the agent's default port on the pod's host, where an agent
+    started with --listen tcp:7070 --token listens, as by default it only
+    listens on the pod's loopback
+    """
+    if "agent" in pod_info:
+        return pod_info["agent"]
+    # imported here, as the agent brings the changer along with it
+    from pod_agent import DEFAULT_PORT  # pylint: disable=import-outside-toplevel
+    return f"tcp:{pod_info['host']}:{DEFAULT_PORT}"
+
+
+class AgentPool:
+    """
+    Persistent connections to the agents of all pods, of which up to workers
+    are sent requests at once. Each request is allowed timeout seconds.
+    A pod's agent_token, in the hardware config, overrides token
+    """
+    def __init__(self, index, token=None, timeout=None, workers=None):
+        self.workers = workers
+        self.clients = {
+            pod: AgentClient(agent_address(pod_info), pod_info.get("agent_token", token),
+                             timeout)
+            for pod, pod_info in index.pods.items()
+        }
+
+    def request(self, pod, request):
+        """
+        Send a request to a single pod's agent.
+        Unreachable agents result in an error response.
+        """
+        try:
+            return self.clients[pod].request(request)
+        except AgentError as error:
+            return {"status": "error", "error": str(error)}
+
+    def request_all(self, requests):
+        """
+        Send requests, keyed by pod, to their agents concurrently.
+        Returns the responses keyed by pod.
+        """
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+        workers = max(min(len(requests), self.workers or len(requests)), 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {pod: executor.submit(self.request, pod, request)
+                       for pod, request in requests.items()}
+            return {pod: future.result() for pod, future in futures.items()}
+
+    def apply_all(self, generated, full=False, live_states=None, changer_hash=None):
+        """
+        Apply each pod's generated config through its agent, planned from
+        the pod's snapshot in live_states, if it has one. Agents that don't
+        run the changer.py whose hash is changer_hash refuse to apply
+        """
+        live_states = live_states or {}
+        return self.request_all({
+            pod: {"op": "apply", "config": pod_config, "full": full,
+                  "state": live_states.get(pod), "changer_hash": changer_hash}
+            for pod, pod_config in generated.items()
+        })
+
+    def close(self):
+        """
+        Close all agent connections
+        """
+        for client in self.clients.values():
+            client.close()
+
+
+def feed(selector, key, stdin):
+    """
+    Write as much of stdin to a process as its pipe takes, closing the pipe
+    once it's all written. Returns what's left to write
+    """
+    try:
+        stdin = stdin[os.write(key.fd, stdin[:65536]):]
+    except BrokenPipeError:
+        stdin = stdin[:0]
+    if not stdin:
+        selector.unregister(key.fileobj)
+        key.fileobj.close()
+    return stdin
+
+
+def read_lines(selector, key, output, pending):
+    """
+    Read what a process output on one of its pipes, keeping it in output.
+    Returns the lines that it completed, where pending holds each pipe's
+    incomplete last line
+    """
+    data = os.read(key.fd, 65536)
+    if not data:
+        selector.unregister(key.fileobj)
+        lines = [pending[key.data]] if pending[key.data] else []
+        pending[key.data] = b""
+        return lines
+    output[key.data].append(data)
+    *lines, pending[key.data] = (pending[key.data] + data).split(b"\n")
+    return lines
+
+
+def run_streaming(command, stdin, timeout, on_line):
+    """
+    Run command, feeding it stdin, and call on_line(stream, line) with each
+    line that it outputs, as it's output, where stream is "stdout" or "stderr".
+    Its pipes are multiplexed by the calling thread, so streaming a pod's
+    output doesn't take threads of its own.
+    Returns the subprocess.CompletedProcess, as subprocess.run would
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    output = {"stdout": [], "stderr": []}
+    pending = {"stdout": b"", "stderr": b""}
+    stdin = memoryview(stdin)
+    with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE) as proc, selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ, "stdout")
+        selector.register(proc.stderr, selectors.EVENT_READ, "stderr")
+        os.set_blocking(proc.stdin.fileno(), False)
+        selector.register(proc.stdin, selectors.EVENT_WRITE, "stdin")
+        while selector.get_map():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                proc.kill()
+                raise subprocess.TimeoutExpired(command, timeout, b"".join(output["stdout"]),
+                                                b"".join(output["stderr"]))
+            for key, _ in selector.select(remaining):
+                if key.data == "stdin":
+                    stdin = feed(selector, key, stdin)
+                    continue
+                for line in read_lines(selector, key, output, pending):
+                    on_line(key.data, line.decode("utf8", "replace"))
+        proc.wait()
+    return subprocess.CompletedProcess(command, proc.returncode, b"".join(output["stdout"]),
+                                       b"".join(output["stderr"]))
+
+
+class SSHTransport:
+    """
+    Runs commands on pods over ssh. One control master connection is kept
+    per pod, and shared by create, client and serial, so that only the first
+    command run on a pod pays for the ssh handshake.
+    """
+    def __init__(self, control_dir=None, persist=600, connect_timeout=10, user="root"):
+        self.control_dir = control_dir or f"/tmp/topology-sim-ssh-{os.getuid()}"
+        self.persist = persist
+        self.connect_timeout = connect_timeout
+        self.user = user
+        # on_output(host, stream, line) is given the output of commands as it's output
+        self.on_output = None
+
+    def control_path(self, host):
+        """
+        Path of the control socket for a host
+        """
+        return os.path.join(self.control_dir, f"{self.user}@{host}")
+
+    def options(self, host):
+        """
+        ssh options shared by every connection to a host
+        """
+        return ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null",
+                "-o", "LogLevel=ERROR", "-o", f"ConnectTimeout={self.connect_timeout}",
+                "-o", f"ControlPath={self.control_path(host)}", "-l", self.user]
+
+    def ensure_master(self, host, timeout=None):
+        """
+        Start a control master for a host, unless one is already running.
+        The master is started separately from the commands that use it,
+        because a master spawned by a command holds that command's output
+        pipes open for as long as it persists.
+        """
+        if os.path.exists(self.control_path(host)):
+            return
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        with open(os.devnull, "wb") as devnull:
+            subprocess.run(["ssh", "-f", "-N", "-o", "ControlMaster=yes",
+                            "-o", f"ControlPersist={self.persist}"] + self.options(host) +
+                           [host], stdin=subprocess.DEVNULL, stdout=devnull, stderr=devnull,
+                           timeout=timeout, check=False)
+
+    def command(self, host, command, tty=False):
+        """
+        Returns the ssh command line that runs command on host,
+        using the control master if there is one
+        """
+        return ["ssh", "-t" if tty else "-T", "-o", "ControlMaster=no"] + \
+            self.options(host) + [host, command]
+
+    def run(self, host, command, stdin=b"", timeout=None):
+        """
+        Run a command on host, feeding it stdin, and stream its output to
+        on_output if it's set.
+        Returns the subprocess.CompletedProcess
+        """
+        self.ensure_master(host, timeout)
+        if self.on_output:
+            return run_streaming(self.command(host, command), stdin, timeout,
+                                 lambda stream, line: self.on_output(host, stream, line))
+        return subprocess.run(self.command(host, command), input=stdin,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              timeout=timeout, check=False)
+
+    def push_file(self, host, local_path, remote_path, timeout=None):
+        """
+        Copy a file to host over the shared connection
+        """
+        with open(local_path, "rb") as file_handle:
+            data = file_handle.read()
+        remote_dir = os.path.dirname(remote_path)
+        return self.run(host, f"mkdir -p {remote_dir} && cat > {remote_path}", data, timeout)
+
+    def push_if_changed(self, host, local_path, remote_path, timeout=None):
+        """
+        Copy a file to host, unless host's copy already matches.
+        Returns the subprocess.CompletedProcess of the check, or of the copy
+        """
+        proc = self.run(host, f"echo '{file_hash(local_path)}  {remote_path}' | "
+                        "sha256sum -c - >/dev/null 2>&1", timeout=timeout)
+        if proc.returncode:
+            proc = self.push_file(host, local_path, remote_path, timeout)
+        return proc
+
+    def exec_interactive(self, host, command):
+        """
+        Replace this process with an interactive session running command on host
+        """
+        self.ensure_master(host)
+        args = self.command(host, command, tty=True)
+        os.execvp(args[0], args)
+
+
+class NetnsTransport(SSHTransport):
+    """
+    Runs commands in the pods emulated by emulator.py, rather than over ssh
+    """
+    def __init__(self, index, run_dir=None):
+        # imported here, as only emulated pods need it
+        import emulator  # pylint: disable=import-outside-toplevel
+        super().__init__()
+        self.emulator = emulator
+        self.run_dir = run_dir or emulator.RUN_DIR
+        self.host_to_pod = {index.pod_host(pod): pod for pod in index.pods}
+
+    def ensure_master(self, host, timeout=None):
+        """
+        Emulated pods don't need a connection
+        """
+
+    def command(self, host, command, tty=False):
+        """
+        Returns the command line that runs command in the host's emulated pod
+        """
+        return self.emulator.pod_command(self.host_to_pod[host], command, self.run_dir)
+
+
+def pod_transport(index, transport):
+    """
+    Returns the transport that interactive commands are run over
+    """
+    return NetnsTransport(index) if transport == "netns" else SSHTransport()
@@ -0,0 +1,72 @@
+"""
+Choose which pairs of sites are joined by GRE tunnels for a bridge.
+- mesh: every pair of sites. Tunnel ports are isolated from each other,
+  otherwise there would be a loop when there are more than 2 sites.
+- hub: every site is joined to a single hub site, which forwards between them.
+- tree: a minimum cost spanning tree, per the hardware config's tunnel costs.
+Loop free layouts (hub and tree) must forward between tunnels, so their
+tunnel ports are not isolated.
+"""
+
+LAYOUTS = ("mesh", "hub", "tree")
+
+
+def mesh_pairs(sites):
+    """
+    Every pair of sites
+    """
+    return [(site1, site2) for index, site1 in enumerate(sites) for site2 in sites[index + 1:]]
+
+
+def hub_pairs(sites, hub):
+    """
+    Every site paired with the hub
+    """
+    return [tuple(sorted((hub, site))) for site in sites if site != hub]
+
+
+def tree_pairs(sites, cost):
+    """
+    Minimum cost spanning tree over sites (Prim's algorithm).
+    Ties are broken by site name, so the same tree is always chosen
+    """
+    if not sites:
+        return []
+    in_tree = {sites[0]}
+    pairs = []
+    while len(in_tree) < len(sites):
+        _, site1, site2 = min((cost(site1, site2), site1, site2)
+                              for site1 in sorted(in_tree)
+                              for site2 in sites if site2 not in in_tree)
+        in_tree.add(site2)
+        pairs.append(tuple(sorted((site1, site2))))
+    return sorted(pairs)
+
+
+def default_hub(sites, cost):
+    """
+    The site with the lowest total cost to every other site
+    """
+    return min(sites, key=lambda site: (sum(cost(site, other) for other in sites), site))
+
+
+def tunnel_pairs(layout, sites, cost, hub=None):
+    """
+    Returns the (site1, site2) pairs that need a tunnel.
+    sites are sorted, cost(site1, site2) is the cost of tunneling between two sites,
+    and hub is the hub site of the hub layout, ie. the WAN site.
+    """
+    if layout == "mesh":
+        return mesh_pairs(sites)
+    if layout == "hub":
+        return hub_pairs(sites, hub if hub in sites else default_hub(sites, cost))
+    if layout == "tree":
+        return tree_pairs(sites, cost)
+    raise ValueError(f"tunnel layout: {layout} unknown, expected one of {', '.join(LAYOUTS)}")
+
+
+def isolated(layout):
+    """
+    Whether tunnel ports must be isolated from each other to avoid a loop
+    """
+    return layout == "mesh"
@@ -0,0 +1,149 @@
+"""
+Watching config files for edits, with inotify where the platform has it,
+so that the watch command can apply them as soon as they're saved.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from config_cache import stat_key
+
+# inotify(7) flags
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CLOEXEC = 0o2000000
+# editors either write files in place, or write a new file and rename it over the old one
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+# struct inotify_event, followed by its name
+EVENT = struct.Struct("iIII")
+
+# seconds that edits must settle for before they're applied, as an editor's
+# save can be several writes
+DEBOUNCE = 0.05
+# seconds between checks of the files, when inotify isn't available
+POLL_INTERVAL = 0.1
+
+
+class Inotify:
+    """
+    Watches files for being written or replaced, by watching their directories
+    """
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> (directory, names of the watched files in it)
+        self.watches = {}
+        directories = {}
+        for path in paths:
+            directory, name = os.path.split(os.path.abspath(path))
+            directories.setdefault(directory, set()).add(name)
+        for directory, names in directories.items():
+            descriptor = libc.inotify_add_watch(self.fd, directory.encode("utf8"), WATCH_MASK)
+            if descriptor < 0:
+                error = ctypes.get_errno()
+                self.close()
+                raise OSError(error, f"can't watch {directory}")
+            self.watches[descriptor] = (directory, names)
+
+    def wait(self, timeout=None):
+        """
+        Returns the watched paths that were written within timeout seconds,
+        or an empty set if none were
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            descriptor, _, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+            offset += EVENT.size + length
+            directory, names = self.watches.get(descriptor, (None, ()))
+            if name.decode("utf8", "replace") in names:
+                changed.add(os.path.join(directory, name.decode("utf8")))
+        return changed
+
+    def close(self):
+        """
+        Stop watching
+        """
+        os.close(self.fd)
+
+
+class StatWatcher:
+    """
+    Watches files by polling their size and mtime, where inotify isn't available
+    """
+    def __init__(self, paths):
+        self.stats = {os.path.abspath(path): self.stat(path) for path in paths}
+
+    @staticmethod
+    def stat(path):
+        """
+        The size and mtime of a file, or None if it's missing, ie. mid rename
+        """
+        try:
+            return stat_key(path)
+        except FileNotFoundError:
+            return None
+
+    def wait(self, timeout=None):
+        """
+        Returns the watched paths that changed within timeout seconds,
+        or an empty set if none did
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, last in self.stats.items():
+                current = self.stat(path)
+                if current != last:
+                    self.stats[path] = current
+                    if current is not None:
+                        changed.add(path)
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            time.sleep(POLL_INTERVAL if deadline is None else
+                       max(min(POLL_INTERVAL, deadline - time.monotonic()), 0))
+
+    def close(self):
+        """
+        Stop watching
+        """
+
+
+def file_watcher(paths):
+    """
+    Returns an inotify watcher for paths, or a polling one if inotify isn't available
+    """
+    try:
+        return Inotify(paths)
+    except (OSError, AttributeError):
+        return StatWatcher(paths)
+
+
+def watch(watcher, on_change, duration=None):
+    """
+    Call on_change with the paths that changed, once their edits have settled,
+    until interrupted, or for duration seconds
+    """
+    deadline = None if duration is None else time.monotonic() + duration
+    while deadline is None or time.monotonic() < deadline:
+        changed = watcher.wait(None if deadline is None else
+                               max(deadline - time.monotonic(), 0))
+        if not changed:
+            continue
+        while True:
+            more = watcher.wait(DEBOUNCE)
+            if not more:
+                break
+            changed |= more
+        on_change(sorted(changed))